@@ -0,0 +1,412 @@
+"""
+Offline benchmark for message generation
+Runs generate_message and its fallback chain against the mock LLM server in a set of
+scenarios and appends p50/p95/p99 latency and messages/sec to a results file, so
+regressions between versions show up without LM Studio or an OpenAI account
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import message_generator
+import recipient_memory
+import recipients
+from llm_clients import close_clients
+from log_setup import configure_logging
+from metrics import FALLBACKS, LLM_TOKENS
+from mock_llm import MockLLMServer, mock_message
+from prompt_builder import SYSTEM_PROMPT, build_messages
+from recipient_memory import MESSAGE, MemoryStore, time_of_day
+from stream_guard import RECENT_OPENERS
+
+# Configuration
+BENCHMARK_RESULTS_FILE = os.getenv("BENCHMARK_RESULTS_FILE", "benchmark_results.jsonl")
+
+# Scenarios that talk to the mock directly and so run without the openai package
+CLIENTLESS_SCENARIOS = ("templates", "ttft_", "memory_")
+
+# Recipients the time-to-first-token scenarios rotate through, like a bot with several contacts
+TTFT_RECIPIENTS = [
+    ("darling", "romantic partner", "sweet and loving"),
+    ("Sam", "best friend", "funny and casual"),
+    ("Mum", "mother", "warm and grateful"),
+    ("Alex", "husband", "flirty and playful"),
+    ("Jo", "girlfriend", "romantic, funny, and cute"),
+]
+
+# A scenario runs one iteration and returns (latency of each message, messages produced)
+Scenario = Callable[["Bench"], Tuple[List[float], int]]
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    """Nearest-rank percentile of the samples."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * percent // 100))  # Ceiling
+    return ordered[int(rank) - 1]
+
+
+def _closed_port_url() -> str:
+    """URL of a local port nothing listens on, so connections are refused right away."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _tokens() -> float:
+    return sum(entry["value"] for entry in LLM_TOKENS.snapshot())
+
+
+def _fallbacks() -> float:
+    return sum(entry["value"] for entry in FALLBACKS.snapshot())
+
+
+class Bench:
+    """
+    Points the generator at mock servers for one scenario and restores it afterwards.
+
+    Args:
+        lm_studio: Mock serving as LM Studio, or None for an unreachable LM Studio
+        openai: Mock serving as OpenAI, or None to leave OpenAI unconfigured
+        streaming: Stream completions (LLM_STREAMING)
+    """
+
+    def __init__(
+        self,
+        lm_studio: Optional[MockLLMServer],
+        openai: Optional[MockLLMServer] = None,
+        streaming: bool = False
+    ):
+        self.lm_studio = lm_studio
+        self.openai = openai
+        self.streaming = streaming
+        self._saved: Dict[str, object] = {}
+
+    def __enter__(self) -> "Bench":
+        settings = {
+            "USE_LM_STUDIO": True,
+            "LM_STUDIO_BASE_URL": self.lm_studio.url if self.lm_studio else _closed_port_url(),
+            "LM_STUDIO_MODEL": "",
+            "OPENAI_API_KEY": "mock-key" if self.openai else "",
+            "OPENAI_BASE_URL": self.openai.url if self.openai else None,
+            "LLM_STREAMING": self.streaming,
+        }
+        for name, value in settings.items():
+            self._saved[name] = getattr(message_generator, name)
+            setattr(message_generator, name, value)
+        # Generation is measured without recall, so results stay comparable (see memory_recall)
+        self._memory_enabled = recipient_memory.MEMORY_ENABLED
+        recipient_memory.MEMORY_ENABLED = False
+        self.reset()
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, value in self._saved.items():
+            setattr(message_generator, name, value)
+        recipient_memory.MEMORY_ENABLED = self._memory_enabled
+        self.reset()
+        return False
+
+    def reset(self) -> None:
+        """Start from nothing: no clients, no cached models, closed circuits."""
+        close_clients()
+        message_generator.LM_STUDIO_BREAKER.reset()
+        message_generator.OPENAI_BREAKER.reset()
+        RECENT_OPENERS.clear()
+
+
+def _single(bench: Bench, messages: int, cold: bool = False) -> Tuple[List[float], int]:
+    latencies = []
+    for _ in range(messages):
+        if cold:
+            bench.reset()
+        start = time.perf_counter()
+        message_generator.generate_message(use_llm=True)
+        latencies.append(time.perf_counter() - start)
+    return latencies, messages
+
+
+def _batch(bench: Bench, size: int) -> Tuple[List[float], int]:
+    start = time.perf_counter()
+    produced = message_generator.generate_messages(size, use_llm=True)
+    elapsed = time.perf_counter() - start
+    return [elapsed / len(produced)] * len(produced), len(produced)
+
+
+def _concurrent(bench: Bench, count: int, concurrency: int) -> Tuple[List[float], int]:
+    """Generate for `count` recipients through generate_for_recipients, timing each message."""
+    latencies: List[float] = []
+    generate = recipients.generate_message_async
+
+    async def timed_generate(**params):
+        start = time.perf_counter()
+        try:
+            return await generate(**params)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    people = [recipients.Recipient(number=f"+1555{i:07d}", name=f"love {i}") for i in range(count)]
+    recipients.generate_message_async = timed_generate
+    try:
+        recipients.generate_for_recipients(people, concurrency=concurrency)
+    finally:
+        recipients.generate_message_async = generate
+    return latencies, count
+
+
+def _variables_first(messages: List[dict]) -> List[dict]:
+    """The same request laid out the old way: the per-recipient values before the instructions."""
+    request = messages[1]["content"]
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT.split("\n\n", 1)[0]},
+        {"role": "user", "content": request + "\n\n" + SYSTEM_PROMPT.split("\n\n", 1)[1]},
+    ]
+
+
+def _time_to_first_token(server: MockLLMServer, messages: List[dict]) -> float:
+    """Stream one completion straight from the mock and time its first content chunk."""
+    host, port = server.url.split("//")[1].split("/")[0].split(":")
+    connection = http.client.HTTPConnection(host, int(port))
+    body = json.dumps({"model": "mock-model", "messages": messages, "stream": True, "max_tokens": 200})
+    start = time.perf_counter()
+    try:
+        connection.request("POST", "/v1/chat/completions", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        for line in response:
+            if line.startswith(b"data: {") and b'"content"' in line:
+                elapsed = time.perf_counter() - start
+                response.read()  # Let the stream finish, as a real client would
+                return elapsed
+        raise RuntimeError("The stream ended without content")
+    finally:
+        connection.close()
+
+
+def _ttft_scenario(server: MockLLMServer, layout: Callable[..., List[dict]]) -> Scenario:
+    """One streamed request per iteration, to the next of TTFT_RECIPIENTS, with the prompt from layout."""
+    turns = itertools.cycle(TTFT_RECIPIENTS)
+    return lambda bench: ([_time_to_first_token(server, layout(*next(turns)))], 1)
+
+
+def _memory_scenario(entries: int) -> Tuple[Callable[[], Bench], Scenario]:
+    """
+    (bench factory, scenario) timing recall for a recipient with `entries` earlier messages,
+    kept memory-mapped in a temporary directory. The memory is filled by the bench factory,
+    so filling it isn't timed.
+    """
+    directory = tempfile.TemporaryDirectory(prefix="memory-bench-")
+    number = "+15550000000"
+    store: Dict[str, MemoryStore] = {}
+
+    def make_bench() -> Bench:
+        if not store:
+            store["memory"] = MemoryStore(directory.name)
+            rng = random.Random(6)
+            texts = [f"{mock_message(rng)} #{i}" for i in range(entries)]  # Numbered, so none is a duplicate
+            store["memory"].add(number, ["loves morning coffee", "is afraid of geese"])
+            for start in range(0, entries, 1000):
+                store["memory"].add(number, texts[start:start + 1000], MESSAGE)
+        return Bench(None)
+
+    hours = itertools.cycle((8, 14, 19, 23))
+
+    def run(bench: Bench) -> Tuple[List[float], int]:
+        start = time.perf_counter()
+        store["memory"].search(number, f"{time_of_day(next(hours))} sweet and loving")
+        return [time.perf_counter() - start], 1
+
+    return make_bench, run
+
+
+def _templates(bench: Bench, messages: int) -> Tuple[List[float], int]:
+    latencies = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        message_generator.generate_message(use_llm=False)
+        latencies.append(time.perf_counter() - start)
+    return latencies, messages
+
+
+def run_scenario(name: str, bench: Bench, run: Scenario, iterations: int) -> dict:
+    """Run a scenario `iterations` times and summarize it."""
+    with bench:
+        tokens, fallbacks = _tokens(), _fallbacks()
+        latencies: List[float] = []
+        produced = 0
+        start = time.perf_counter()
+        for _ in range(iterations):
+            samples, count = run(bench)
+            latencies.extend(samples)
+            produced += count
+        wall = time.perf_counter() - start
+    return {
+        "scenario": name,
+        "messages": produced,
+        "seconds": round(wall, 4),
+        "messages_per_sec": round(produced / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "tokens": int(_tokens() - tokens),
+        "fallbacks": int(_fallbacks() - fallbacks),
+    }
+
+
+def build_scenarios(args, servers: List[MockLLMServer]) -> List[Tuple[str, Callable[[], Bench], Scenario, int]]:
+    """
+    (name, bench factory, scenario, iterations) for every scenario.
+    The mock servers are started and appended to `servers`, to be stopped by the caller.
+    """
+    healthy = MockLLMServer(latency=args.latency, jitter=args.jitter, seed=1)
+    cloud = MockLLMServer(latency=args.latency * 2, jitter=args.jitter, seed=2)  # Farther away than LM Studio
+    flaky = MockLLMServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=3)
+    streamer = MockLLMServer(latency=args.latency, jitter=args.jitter, token_delay=args.token_delay, seed=4)
+    # A CPU-bound LM Studio: every prompt token it hasn't cached costs prefill time
+    prefill = MockLLMServer(latency=0.005, token_delay=args.token_delay, prefill_delay=args.prefill_delay, seed=5)
+    for server in (healthy, cloud, flaky, streamer, prefill):
+        servers.append(server.start())
+
+    n = args.iterations
+    return [
+        ("templates", lambda: Bench(None), lambda b: _templates(b, 10), n),
+        ("cold_client", lambda: Bench(healthy), lambda b: _single(b, 1, cold=True), n),
+        ("warm_client", lambda: Bench(healthy), lambda b: _single(b, 1), n),
+        ("lm_studio_down_fallback", lambda: Bench(None, cloud), lambda b: _single(b, 1), n),
+        ("lm_studio_errors_fallback", lambda: Bench(flaky, cloud), lambda b: _single(b, 1), n),
+        ("streaming", lambda: Bench(streamer, streaming=True), lambda b: _single(b, 1), n),
+        ("batch_10", lambda: Bench(healthy), lambda b: _batch(b, 10), max(1, n // 5)),
+        (
+            "concurrent",
+            lambda: Bench(healthy),
+            lambda b: _concurrent(b, args.recipients, args.concurrency),
+            max(1, n // 5)
+        ),
+        ("ttft_static_prefix", lambda: Bench(None), _ttft_scenario(prefill, build_messages), n),
+        (
+            "ttft_compact",
+            lambda: Bench(None),
+            _ttft_scenario(prefill, lambda *who: build_messages(*who, compact=True)),
+            n
+        ),
+        (
+            "ttft_variables_first",
+            lambda: Bench(None),
+            _ttft_scenario(prefill, lambda *who: _variables_first(build_messages(*who))),
+            n
+        ),
+        (f"memory_recall_{args.memory_entries}", *_memory_scenario(args.memory_entries), n),
+    ]
+
+
+def load_previous(path: str) -> Optional[dict]:
+    """The last run saved in the results file."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+
+def _change(now: float, before: Optional[float]) -> str:
+    return f"{(now - before) / before:+.0%}" if before else "-"
+
+
+def print_report(results: List[dict], previous: Optional[dict]) -> None:
+    """Print a table of the results, with the change since the previous run."""
+    before = {r["scenario"]: r for r in (previous or {}).get("results", [])}
+    print(f"{'scenario':<28}{'msgs':>6}{'msg/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'tokens':>8}"
+          f"{'msg/s Δ':>10}{'p95 Δ':>8}")
+    for r in results:
+        last = before.get(r["scenario"], {})
+        print(
+            f"{r['scenario']:<28}{r['messages']:>6}{r['messages_per_sec']:>10.1f}"
+            f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['tokens']:>8}"
+            f"{_change(r['messages_per_sec'], last.get('messages_per_sec')):>10}{_change(r['p95_ms'], last.get('p95_ms')):>8}"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark message generation against a mock LLM server")
+    parser.add_argument("--iterations", type=int, default=50, help="Runs per scenario (batch and concurrent use a fifth)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mock response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Extra random mock latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.3, help="Share of failing requests in the error scenario")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="Seconds between streamed chunks")
+    parser.add_argument("--prefill-delay", type=float, default=0.001, help="Seconds per uncached prompt token in the TTFT scenarios")
+    parser.add_argument("--recipients", type=int, default=20, help="Recipients per concurrent round")
+    parser.add_argument("--concurrency", type=int, default=recipients.GENERATION_CONCURRENCY)
+    parser.add_argument("--memory-entries", type=int, default=20000, help="Remembered messages in the recall scenario")
+    parser.add_argument("--scenario", action="append", help="Only run scenarios whose name contains this (repeatable)")
+    parser.add_argument("--output", default=BENCHMARK_RESULTS_FILE, help="Results file (JSON lines, appended)")
+    parser.add_argument("--no-save", action="store_true", help="Print the results without saving them")
+    args = parser.parse_args(argv)
+
+    configure_logging(level="ERROR")  # Fallback warnings are expected here
+
+    servers: List[MockLLMServer] = []
+    scenarios = build_scenarios(args, servers)
+    if args.scenario:
+        scenarios = [s for s in scenarios if any(part in s[0] for part in args.scenario)]
+    if not message_generator.OPENAI_AVAILABLE:
+        print("⚠️  openai is not installed - only the template and TTFT scenarios can run (pip install openai)")
+        scenarios = [s for s in scenarios if s[0].startswith(CLIENTLESS_SCENARIOS)]
+    if not recipient_memory.NUMPY_AVAILABLE:
+        print("⚠️  numpy is not installed - skipping the memory scenario (pip install numpy)")
+        scenarios = [s for s in scenarios if not s[0].startswith("memory_")]
+
+    results = []
+    try:
+        for name, make_bench, run, iterations in scenarios:
+            print(f"⏱️  {name}...", file=sys.stderr)
+            results.append(run_scenario(name, make_bench(), run, iterations))
+    finally:
+        for server in servers:
+            server.stop()
+
+    previous = load_previous(args.output)
+    print_report(results, previous)
+    if any(r["scenario"].startswith("ttft_") for r in results):
+        # The gain depends on the backend's cache (slots, eviction, prefill speed), so don't read it as LM Studio's
+        print("\nℹ️  ttft_* times come from mock_llm.py's simulated prompt cache "
+              f"({args.prefill_delay * 1000:g} ms per uncached token, one slot), not a real backend")
+    if not args.no_save:
+        run = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(terse=True),
+            "settings": {key: value for key, value in vars(args).items() if key not in ("output", "no_save")},
+            "results": results,
+        }
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(run) + "\n")
+        print(f"\n💾 Saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Circuit breakers for the LLM backends
+A backend that keeps failing is skipped instantly instead of making every
+message wait for its connect timeout, and is re-admitted once it recovers
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from metrics import REGISTRY
+from stream_guard import ContentViolation
+
+log = logging.getLogger(__name__)
+
+# Configuration
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))  # Failures in a row before opening
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "60"))  # Seconds open before a trial call
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "30"))  # Seconds between background probes
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+BREAKER_TRANSITIONS = REGISTRY.counter("whatsapp_bot_breaker_transitions_total", "Circuit breakers opening and closing")
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is refused because the backend's circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker for one backend.
+
+    Closed: calls go through; `failure_threshold` failures in a row open the circuit.
+    Open: calls are refused until `reset_timeout` has passed, then one trial call is let through.
+    Half-open: the trial call's result closes or re-opens the circuit.
+
+    Args:
+        name: Backend name used in log output
+        failure_threshold: Consecutive failures that open the circuit
+        reset_timeout: Seconds the circuit stays open before a trial call is allowed
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.trips = 0
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow_request(self) -> bool:
+        """Check whether a call may go to the backend now (claims the trial slot when half-open)."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial_in_flight:
+                self._state = HALF_OPEN
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError if the call should be skipped."""
+        if not self.allow_request():
+            raise CircuitOpenError(f"{self.name} circuit is open, skipping")
+
+    def record_success(self) -> None:
+        """Report a successful call; closes the circuit."""
+        with self._lock:
+            self.successes += 1
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+            if self._state != CLOSED:
+                log.info("🟢 Backend recovered, circuit closed", extra={"backend": self.name})
+                BREAKER_TRANSITIONS.inc(backend=self.name, state=CLOSED)
+            self._state = CLOSED
+
+    def record_failure(self) -> None:
+        """Report a failed call; may open the circuit."""
+        with self._lock:
+            self.failures += 1
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED and self._consecutive_failures >= self.failure_threshold
+            ):
+                self._trip(f"{self._consecutive_failures} failure(s)")
+            elif self._state == OPEN:
+                self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Give back the half-open trial slot of a call that was cancelled before it finished."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def trip(self, reason: str = "manual trip") -> None:
+        """Open the circuit right away (e.g. when a health probe finds the backend down)."""
+        with self._lock:
+            if self._state != OPEN:
+                self._trip(reason)
+            else:
+                self._opened_at = time.monotonic()  # Still down, so wait a full timeout again
+
+    def stats(self) -> Dict[str, object]:
+        """Current state and counters."""
+        with self._lock:
+            return {
+                "state": self._current_state(),
+                "trips": self.trips,
+                "successes": self.successes,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "consecutive_failures": self._consecutive_failures,
+            }
+
+    def reset(self) -> None:
+        """Close the circuit and forget all failures and counts (e.g. between benchmark runs)."""
+        with self._lock:
+            self._state = CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+            self.trips = self.successes = self.failures = self.rejected = 0
+
+    def _trip(self, reason: str) -> None:
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self.trips += 1
+        log.warning(
+            f"🔴 Circuit opened after {reason}, skipping the backend for {self.reset_timeout:.0f}s",
+            extra={"backend": self.name, "trips": self.trips}
+        )
+        BREAKER_TRANSITIONS.inc(backend=self.name, state=OPEN)
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+
+def guarded_by(breaker: CircuitBreaker):
+    """
+    Decorator routing every call of a function (sync or async) through a breaker.
+    Refused calls raise CircuitOpenError without touching the backend.
+    A ContentViolation (the model answered, just badly) counts as neither success nor failure.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                breaker.before_call()
+                try:
+                    result = await func(*args, **kwargs)
+                except ContentViolation:
+                    breaker.release()
+                    raise
+                except Exception:
+                    breaker.record_failure()
+                    raise
+                except BaseException:
+                    breaker.release()  # Cancelled - says nothing about the backend's health
+                    raise
+                breaker.record_success()
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+            except ContentViolation:
+                breaker.release()
+                raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            return result
+        return wrapper
+    return decorator
+
+
+class HealthProbe:
+    """
+    Background thread that checks backends and feeds the results into their breakers.
+    A failed probe opens the circuit before any message has to wait on the backend,
+    and a successful probe re-admits a backend as soon as it is back.
+
+    Args:
+        interval: Seconds between probe rounds
+    """
+
+    def __init__(self, interval: float = HEALTH_PROBE_INTERVAL):
+        self.interval = interval
+        self._probes: List[tuple] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, breaker: CircuitBreaker, probe: Callable[[], bool]) -> None:
+        """Probe a backend with a function returning True when it is healthy."""
+        self._probes.append((breaker, probe))
+
+    def check(self) -> None:
+        """Run every probe once."""
+        for breaker, probe in self._probes:
+            try:
+                healthy = probe()
+            except Exception:
+                healthy = False
+            if healthy:
+                if breaker.state != CLOSED:
+                    breaker.record_success()
+            else:
+                breaker.trip("failed health probe")
+
+    def start(self) -> None:
+        """Start probing in the background."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="health-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop probing."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
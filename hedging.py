@@ -0,0 +1,201 @@
+"""
+Hedged requests for the LLM backends
+Starts the preferred backend and, if it hasn't answered within its usual (p95)
+latency, races the next backend too - whichever finishes first wins
+"""
+import asyncio
+import functools
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Configuration
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # Latency percentile that triggers a hedge
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))  # Never hedge sooner than this (seconds)
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "15"))  # Hedge after this at the latest (seconds)
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "5"))  # Used until enough latencies are known
+# Stop hedging once more than this share of requests were hedged, to keep cloud spend bounded
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.2"))
+LATENCY_WINDOW = 200  # Recent successful calls kept per backend
+MIN_LATENCY_SAMPLES = 10
+
+
+class LatencyTracker:
+    """Rolling window of recent successful call latencies for one backend."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """Latency below which `percent` % of recent calls finished, or None with too few samples."""
+        with self._lock:
+            if len(self._samples) < MIN_LATENCY_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def hedge_delay(self) -> float:
+        """How long to wait on this backend before hedging, clamped to the configured range."""
+        delay = self.percentile(HEDGE_PERCENTILE)
+        if delay is None:
+            delay = HEDGE_DEFAULT_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, delay))
+
+
+def timed(tracker: LatencyTracker, when: Optional[Callable[..., bool]] = None):
+    """
+    Decorator recording the latency of every successful call (sync or async) in a tracker.
+    `when`, if given, is called with the call's arguments and decides whether it is recorded,
+    so calls of a different kind (e.g. batches) don't skew the hedge delay.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = await func(*args, **kwargs)
+                if when is None or when(*args, **kwargs):
+                    tracker.record(time.perf_counter() - start)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            if when is None or when(*args, **kwargs):
+                tracker.record(time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+class HedgeStats:
+    """Counts of hedged requests and which backend won them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0  # Hedged requests won by a backup backend
+        self.wins: Dict[str, int] = {}
+
+    def record(self, hedged: bool, winner: Optional[str], winner_index: int) -> None:
+        with self._lock:
+            self.requests += 1
+            if hedged:
+                self.hedged += 1
+                if winner_index > 0:
+                    self.hedge_wins += 1
+            if winner is not None:
+                self.wins[winner] = self.wins.get(winner, 0) + 1
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedged / self.requests if self.requests else 0.0
+
+    @property
+    def win_rate(self) -> float:
+        """Share of hedged requests where the backup beat the preferred backend."""
+        return self.hedge_wins / self.hedged if self.hedged else 0.0
+
+    def budget_left(self) -> bool:
+        """Whether another hedge keeps the hedge rate under HEDGE_MAX_RATE."""
+        with self._lock:
+            return (self.hedged + 1) / (self.requests + 1) <= HEDGE_MAX_RATE
+
+    def as_dict(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedge_rate,
+                "win_rate": self.win_rate,
+                "wins": dict(self.wins),
+            }
+
+
+async def hedged_race(
+    candidates: List[Tuple[str, Callable[[], Awaitable[str]], float]],
+    stats: HedgeStats,
+    deadline: Optional[float] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Race backends in order of preference, starting each one only when the ones before
+    it are slow (past their hedge delay) or have failed.
+
+    Args:
+        candidates: (name, coroutine factory, hedge delay in seconds) in order of preference
+        stats: Where hedge counts are recorded
+        deadline: Seconds after which everything is cancelled, or None to wait
+
+    Returns:
+        (result, winning backend name), or (None, None) if every backend failed or the deadline passed
+    """
+    loop = asyncio.get_running_loop()
+    give_up_at = None if deadline is None else loop.time() + deadline
+    running: Dict[asyncio.Task, Tuple[str, int]] = {}
+    next_index = 0
+    hedge_at = 0.0  # Loop time at which the next backend is started if nothing has answered
+    hedged = False
+    may_hedge = True  # False once the hedge budget ran out: untried backends are then only failover
+
+    def start_next() -> None:
+        nonlocal next_index, hedge_at
+        name, factory, delay = candidates[next_index]
+        running[asyncio.ensure_future(factory())] = (name, next_index)
+        hedge_at = loop.time() + delay
+        next_index += 1
+
+    try:
+        if candidates:
+            start_next()
+        while running:
+            timeout = None
+            can_hedge = next_index < len(candidates)
+            if can_hedge and may_hedge:
+                timeout = max(0.0, hedge_at - loop.time())
+            if give_up_at is not None:
+                remaining = give_up_at - loop.time()
+                if remaining <= 0:
+                    break
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name, index = running.pop(task)
+                if task.exception() is None:
+                    stats.record(hedged, name, index)
+                    return task.result(), name
+                log.warning("⚠️  Backend failed during hedged request", extra={"backend": name, "error": str(task.exception())})
+
+            if can_hedge and not running:
+                start_next()  # Everything in flight failed - move on right away
+            elif can_hedge and may_hedge and loop.time() >= hedge_at:
+                if stats.budget_left():
+                    hedged = True
+                    log.info(
+                        "🏁 Backend is slow, hedging",
+                        extra={"backend": candidates[next_index - 1][0], "hedge": candidates[next_index][0]}
+                    )
+                    start_next()
+                else:
+                    may_hedge = False  # Out of hedge budget - wait on what is running, fail over if it fails
+        stats.record(hedged, None, -1)
+        return None, None
+    finally:
+        for task in running:
+            task.cancel()  # Losers are cancelled so they stop using the backend
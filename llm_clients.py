@@ -0,0 +1,248 @@
+"""
+Shared LLM client registry for the WhatsApp Bot
+Keeps one long-lived, keep-alive OpenAI-compatible client per base URL and
+caches the model id detected from LM Studio so it isn't looked up per message
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import threading
+import time
+from typing import Awaitable, Dict, Optional, Tuple, TypeVar
+
+# OpenAI is optional, and importing it takes most of a second, so it is only
+# imported when the first client is created (see _import_openai)
+OPENAI_AVAILABLE = importlib.util.find_spec("openai") is not None
+openai = None
+httpx = None
+
+from metrics import stage
+
+log = logging.getLogger(__name__)
+
+# Configuration
+# How long a detected model id is trusted before LM Studio is asked again (seconds)
+MODEL_CACHE_TTL = float(os.getenv("LLM_MODEL_CACHE_TTL", "600"))
+# Connection pool settings shared by every client
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+
+# Model id used when LM Studio can't tell us which model is loaded
+FALLBACK_MODEL = "local-model"
+
+_lock = threading.Lock()
+_clients: Dict[Tuple[Optional[str], str], object] = {}
+# Keyed by event loop; the owner of a loop closes its clients with close_async_clients
+# before the loop finishes (run() does this for you)
+_async_clients: Dict[asyncio.AbstractEventLoop, Dict[Tuple[Optional[str], str], object]] = {}
+_models: Dict[Optional[str], Tuple[str, float]] = {}
+
+
+def _import_openai() -> None:
+    """Import openai and httpx (installed as a dependency of openai) on first use."""
+    global openai, httpx
+    if openai is None:
+        if not OPENAI_AVAILABLE:
+            raise ImportError("OpenAI library not installed. Run: pip install openai")
+        with stage("import_openai"):
+            import httpx as _httpx  # type: ignore
+            import openai as _openai  # type: ignore
+        httpx, openai = _httpx, _openai
+
+
+def _http_client(asynchronous: bool = False):
+    """Build an httpx client with keep-alive pooling and sane timeouts."""
+    client_class = httpx.AsyncClient if asynchronous else httpx.Client  # type: ignore
+    return client_class(
+        timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),  # type: ignore
+        limits=httpx.Limits(  # type: ignore
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def get_client(base_url: Optional[str], api_key: str):
+    """
+    Return the shared client for a backend, creating it on first use.
+
+    Args:
+        base_url: OpenAI-compatible endpoint (None for the OpenAI cloud default)
+        api_key: API key for the backend
+
+    Returns:
+        A long-lived openai.OpenAI client
+    """
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            _import_openai()
+            client = openai.OpenAI(  # type: ignore
+                base_url=base_url,
+                api_key=api_key,
+                http_client=_http_client(),
+                max_retries=0,  # The fallback chain handles retries
+            )
+            _clients[key] = client
+    return client
+
+
+def get_async_client(base_url: Optional[str], api_key: str):
+    """
+    Return the shared async client for a backend in the running event loop.
+    Async connections can't be shared between event loops, so there is one client per loop,
+    kept until close_async_clients is awaited on that loop.
+
+    Args:
+        base_url: OpenAI-compatible endpoint (None for the OpenAI cloud default)
+        api_key: API key for the backend
+
+    Returns:
+        A long-lived openai.AsyncOpenAI client
+    """
+    key = (base_url, api_key)
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop, {}).get(key)
+    if client is None:
+        with _lock:
+            loop_clients = _async_clients.setdefault(loop, {})
+            client = loop_clients.get(key)
+            if client is None:
+                _import_openai()
+                client = openai.AsyncOpenAI(  # type: ignore
+                    base_url=base_url,
+                    api_key=api_key,
+                    http_client=_http_client(asynchronous=True),
+                    max_retries=0,
+                )
+                loop_clients[key] = client
+    return client
+
+
+def _cached_model(base_url: Optional[str]) -> Optional[str]:
+    cached = _models.get(base_url)
+    if cached is not None and time.monotonic() - cached[1] < MODEL_CACHE_TTL:
+        return cached[0]
+    return None
+
+
+def _first_model_id(models_response) -> Optional[str]:
+    if models_response.data and len(models_response.data) > 0:
+        return models_response.data[0].id
+    return None
+
+
+def get_model(client, base_url: Optional[str]) -> str:
+    """
+    Return the model loaded on an LM Studio server, using a TTL cache.
+
+    Args:
+        client: Client returned by get_client for the same base_url
+        base_url: Endpoint the model id is cached under
+
+    Returns:
+        The detected model id, or FALLBACK_MODEL if none could be found
+    """
+    model = _cached_model(base_url)
+    if model is not None:
+        return model
+
+    try:
+        log.info("🔍 Detecting available model from LM Studio...")
+        with stage("model_detection"):
+            model = _first_model_id(client.models.list())
+    except Exception as e:
+        log.warning("⚠️  Could not list models, using default", extra={"error": str(e)})
+        return FALLBACK_MODEL
+    return _remember_model(base_url, model)
+
+
+async def get_model_async(client, base_url: Optional[str]) -> str:
+    """Async version of get_model, sharing the same cache."""
+    model = _cached_model(base_url)
+    if model is not None:
+        return model
+
+    try:
+        log.info("🔍 Detecting available model from LM Studio...")
+        with stage("model_detection"):
+            model = _first_model_id(await client.models.list())
+    except Exception as e:
+        log.warning("⚠️  Could not list models, using default", extra={"error": str(e)})
+        return FALLBACK_MODEL
+    return _remember_model(base_url, model)
+
+
+def _remember_model(base_url: Optional[str], model: Optional[str]) -> str:
+    if model is None:
+        log.warning("⚠️  No models found, using default")
+        return FALLBACK_MODEL  # Not cached so the next call looks again
+    log.info("✓ Found model", extra={"model": model})
+    with _lock:
+        _models[base_url] = (model, time.monotonic())
+    return model
+
+
+def invalidate_model(base_url: Optional[str]) -> None:
+    """Forget the cached model id so the next call re-detects it."""
+    with _lock:
+        _models.pop(base_url, None)
+
+
+def is_model_not_found(error: Exception) -> bool:
+    """Check whether an API error means the requested model isn't loaded."""
+    if openai is not None and isinstance(error, openai.NotFoundError):  # type: ignore
+        return True
+    text = str(error).lower()
+    return "model" in text and ("not found" in text or "not loaded" in text or "does not exist" in text)
+
+
+async def close_async_clients() -> None:
+    """Close the async clients of the running event loop. Await this before the loop finishes."""
+    with _lock:
+        loop_clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in loop_clients.values():
+        try:
+            await client.close()  # type: ignore
+        except Exception:
+            pass
+
+
+T = TypeVar("T")
+
+
+def run(coroutine: Awaitable[T]) -> T:
+    """
+    asyncio.run for code that uses async clients: they are closed before the loop finishes,
+    so a short-lived loop doesn't leave its connections and client behind.
+    """
+    async def main() -> T:
+        try:
+            return await coroutine
+        finally:
+            await close_async_clients()
+    return asyncio.run(main())
+
+
+def close_clients() -> None:
+    """
+    Close every pooled sync client and clear the caches.
+    Async clients of loops that are still running are forgotten; close them with close_async_clients.
+    """
+    with _lock:
+        for client in _clients.values():
+            try:
+                client.close()  # type: ignore
+            except Exception:
+                pass
+        _clients.clear()
+        _async_clients.clear()
+        _models.clear()
@@ -0,0 +1,263 @@
+"""
+Pre-generated message buffer for the WhatsApp Bot
+A background producer keeps a small queue of ready messages per recipient,
+so a scheduled send never has to wait on the LLM
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from message_generator import generate_messages
+from message_history import MessageHistory, jaccard, shingles
+from metrics import stage
+from outbox import Outbox
+
+log = logging.getLogger(__name__)
+
+# Configuration
+MESSAGE_BUFFER_SIZE = int(os.getenv("MESSAGE_BUFFER_SIZE", "3"))  # Messages kept ready per recipient
+MESSAGE_BUFFER_LOW_WATER = int(os.getenv("MESSAGE_BUFFER_LOW_WATER", "1"))  # Refill when at or below this
+# Messages older than this are thrown away so time-of-day greetings don't go stale (seconds)
+MESSAGE_BUFFER_MAX_AGE = float(os.getenv("MESSAGE_BUFFER_MAX_AGE", "1800"))
+MESSAGE_BUFFER_CHECK_INTERVAL = float(os.getenv("MESSAGE_BUFFER_CHECK_INTERVAL", "30"))
+MESSAGE_BUFFER_CONCURRENCY = int(os.getenv("MESSAGE_BUFFER_CONCURRENCY", "4"))  # Recipients refilled at once
+MESSAGE_BUFFER_REGENERATE_ROUNDS = 3  # Times near-duplicates are regenerated per refill
+
+
+class MessageBuffer:
+    """
+    Bounded per-recipient queues of ready messages, filled by a background thread.
+
+    Args:
+        generator: Function called as generator(count, **params) returning a list of messages
+        capacity: Maximum number of messages kept per recipient
+        low_water: Refill a recipient's queue once it has this many messages or fewer
+        max_age: Seconds a message stays fresh before it is discarded
+        check_interval: Seconds between producer passes when nothing wakes it up
+        concurrency: Number of recipients refilled at the same time
+        history: Sent-message history; near-duplicates of sent or queued messages are regenerated
+        outbox: Journal that accepted messages are recorded in, so they survive a crash
+    """
+
+    def __init__(
+        self,
+        generator: Callable[..., List[str]] = generate_messages,
+        capacity: int = MESSAGE_BUFFER_SIZE,
+        low_water: int = MESSAGE_BUFFER_LOW_WATER,
+        max_age: float = MESSAGE_BUFFER_MAX_AGE,
+        check_interval: float = MESSAGE_BUFFER_CHECK_INTERVAL,
+        concurrency: int = MESSAGE_BUFFER_CONCURRENCY,
+        history: Optional[MessageHistory] = None,
+        outbox: Optional[Outbox] = None
+    ):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.generator = generator
+        self.capacity = capacity
+        self.low_water = min(low_water, capacity - 1)
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.concurrency = max(1, concurrency)
+        self.history = history
+        self.outbox = outbox
+        self._params: Dict[Hashable, dict] = {}
+        self._queues: Dict[Hashable, Deque[Tuple[str, float]]] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, key: Hashable, **params) -> None:
+        """
+        Start keeping messages ready for a recipient.
+
+        Args:
+            key: Identifier used to pop messages later (e.g. the phone number)
+            **params: Keyword arguments passed to the generator for this recipient
+        """
+        with self._lock:
+            self._params[key] = params
+            self._queues.setdefault(key, deque())
+        self._wake.set()
+
+    def unregister(self, key: Hashable) -> None:
+        """Stop buffering for a recipient and drop its queued messages."""
+        with self._lock:
+            self._params.pop(key, None)
+            queue = self._queues.pop(key, None)
+        if queue:
+            self._journal_dropped(key, [message for message, _ in queue], "unregistered")
+
+    def pop(self, key: Hashable) -> Optional[str]:
+        """
+        Take the oldest fresh message for a recipient.
+
+        Returns:
+            A ready message, or None if the buffer is empty
+        """
+        with self._lock:
+            queue = self._queues.get(key)
+            message = None
+            stale: List[str] = []
+            if queue:
+                stale = self._drop_stale(queue, time.monotonic())
+                if queue:
+                    message = queue.popleft()[0]
+        self._journal_dropped(key, stale, "stale")
+        self._wake.set()  # Let the producer top the queue back up
+        return message
+
+    def put(self, key: Hashable, messages: List[str], created: Optional[List[float]] = None) -> int:
+        """
+        Add ready messages for a registered recipient (e.g. from a concurrent prefill).
+        Near-duplicates of sent or already queued messages are dropped.
+
+        Args:
+            key: Recipient the messages are for
+            messages: Ready messages
+            created: Unix times the messages were generated, for messages recovered from the
+                outbox: they keep their age across restarts and aren't journaled again
+
+        Returns:
+            Number of messages accepted
+        """
+        now = time.monotonic()
+        if created is None:
+            stamps = [now] * len(messages)
+        else:
+            # The buffer ages messages on the monotonic clock; carry the journaled age over
+            wall = time.time()
+            stamps = [now - max(0.0, wall - generated) for generated in created]
+        items = list(zip(messages, stamps))
+        with stage("duplicate_check"):
+            fresh = self._drop_duplicates(key, items)
+        if len(fresh) < len(messages):
+            log.info("♻️  Dropped near-duplicate messages", extra={"recipient": key, "count": len(messages) - len(fresh)})
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                accepted = []
+            else:
+                accepted = [item for item in fresh if now - item[1] <= self.max_age][:self.capacity - len(queue)]
+                queue.extend(accepted)
+                if created is not None:
+                    # Replayed messages are older than what may already be queued; keep the oldest first
+                    ordered = sorted(queue, key=lambda item: item[1])
+                    queue.clear()
+                    queue.extend(ordered)
+        if created is None:
+            if self.outbox is not None and accepted:
+                self.outbox.record_generated(str(key), [message for message, _ in accepted])
+        elif len(accepted) < len(items):
+            # Replayed messages are already journaled: the ones not taken back (near-duplicate,
+            # stale or over capacity) are marked dropped so the next restart doesn't replay them
+            kept = {message for message, _ in accepted}
+            self._journal_dropped(key, [message for message, _ in items if message not in kept], "not buffered on replay")
+        return len(accepted)
+
+    def size(self, key: Hashable) -> int:
+        """Number of messages currently buffered for a recipient."""
+        with self._lock:
+            queue = self._queues.get(key)
+            return len(queue) if queue else 0
+
+    def start(self) -> None:
+        """Start the background producer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="message-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the producer thread (a generation in progress is allowed to finish)."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def fill(self) -> None:
+        """Run one producer pass, topping up every queue that is at or below the low-water mark."""
+        pending = self._pending_keys()
+        if len(pending) <= 1 or self.concurrency == 1:
+            for key in pending:
+                self._refill(key)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as pool:
+            list(pool.map(self._refill, pending))
+
+    @stage("buffer_refill")
+    def _refill(self, key: Hashable) -> None:
+        if self._stop.is_set():
+            return
+        with self._lock:
+            params = self._params.get(key)
+            queue = self._queues.get(key)
+            if params is None or queue is None:
+                return
+            missing = self.capacity - len(queue)
+        # One batched request tops up the whole queue; near-duplicates are asked for again
+        for _ in range(MESSAGE_BUFFER_REGENERATE_ROUNDS):
+            if missing <= 0 or self._stop.is_set():
+                return
+            try:
+                messages = self.generator(missing, **params)
+            except Exception as e:
+                log.warning("⚠️  Buffer could not generate messages", extra={"recipient": key, "error": str(e)})
+                return
+            accepted = self.put(key, messages)
+            missing -= accepted
+            if accepted == len(messages):
+                return
+
+    def _drop_duplicates(self, key: Hashable, items: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
+        if self.history is None:
+            return items
+        with self._lock:
+            queue = self._queues.get(key)
+            seen = [shingles(message) for message, _ in queue] if queue else []
+        fresh = []
+        for message, stamp in items:
+            message_shingles = shingles(message)
+            if self.history.is_duplicate(message, str(key)):
+                continue
+            if any(jaccard(message_shingles, other) >= self.history.threshold for other in seen):
+                continue
+            seen.append(message_shingles)
+            fresh.append((message, stamp))
+        return fresh
+
+    def _pending_keys(self):
+        now = time.monotonic()
+        stale: Dict[Hashable, List[str]] = {}
+        with self._lock:
+            pending = []
+            for key, queue in self._queues.items():
+                stale[key] = self._drop_stale(queue, now)
+                if len(queue) <= self.low_water:
+                    pending.append(key)
+        for key, messages in stale.items():
+            self._journal_dropped(key, messages, "stale")
+        return pending
+
+    def _drop_stale(self, queue: Deque[Tuple[str, float]], now: float) -> List[str]:
+        dropped = []
+        while queue and now - queue[0][1] > self.max_age:
+            dropped.append(queue.popleft()[0])
+        return dropped
+
+    def _journal_dropped(self, key: Hashable, messages: List[str], reason: str) -> None:
+        """Mark messages the buffer threw away as dropped, so the outbox doesn't replay them."""
+        if self.outbox is not None and messages:
+            self.outbox.mark_dropped(str(key), messages, reason)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            self.fill()
+            self._wake.wait(self.check_interval)
@@ -2,16 +2,49 @@
 LLM Message Generator for WhatsApp Bot
 Supports LM Studio (local), OpenAI, and template-based generation
 """
+import json
+import logging
 import os
-from typing import Optional
+from types import SimpleNamespace
+from typing import List, Optional
 
-# Try to import OpenAI, but make it optional
-try:
-    import openai  # type: ignore
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
-    openai = None  # type: ignore
+from circuit_breaker import OPEN, CircuitBreaker, CircuitOpenError, HealthProbe, guarded_by
+from hedging import HedgeStats, LatencyTracker, hedged_race, timed
+from metrics import FALLBACKS, record_usage, stage
+from prompt_builder import build_messages, count_message_tokens, count_tokens
+from recipient_memory import recall, time_of_day
+from rate_limiter import (
+    LM_STUDIO_MAX_CONCURRENCY,
+    LM_STUDIO_RPM,
+    LM_STUDIO_TPM,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_RPM,
+    OPENAI_TPM,
+    BackendLimiter,
+    limited_by,
+)
+from template_engine import get_template_engine
+from stream_guard import (
+    LLM_STREAMING,
+    RECENT_OPENERS,
+    STREAM_MAX_ATTEMPTS,
+    ContentViolation,
+    StreamGuard,
+    consume_stream,
+    consume_stream_async,
+)
+from llm_clients import (
+    OPENAI_AVAILABLE,  # openai itself is imported lazily, with the first client
+    get_async_client,
+    get_client,
+    get_model,
+    get_model_async,
+    invalidate_model,
+    is_model_not_found,
+    run,
+)
+
+log = logging.getLogger(__name__)
 
 # Configuration
 # LM Studio Configuration (local LLM)
@@ -24,14 +57,277 @@ USE_LM_STUDIO = os.getenv("USE_LM_STUDIO", "true").lower() == "true"  # Default
 
 # OpenAI Configuration (cloud)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # Leave unset for api.openai.com
 DEFAULT_MODEL = "gpt-3.5-turbo"  # or "gpt-4" for better quality
 
 
+# Circuit breakers - a failing backend is skipped instantly until it recovers
+LM_STUDIO_BREAKER = CircuitBreaker("LM Studio")
+OPENAI_BREAKER = CircuitBreaker("OpenAI")
+
+# Rate and concurrency limits - requests over them wait for a slot instead of failing
+LM_STUDIO_LIMITER = BackendLimiter("lm_studio", LM_STUDIO_RPM, LM_STUDIO_TPM, LM_STUDIO_MAX_CONCURRENCY)
+OPENAI_LIMITER = BackendLimiter("openai", OPENAI_RPM, OPENAI_TPM, OPENAI_MAX_CONCURRENCY)
+
+# Recent single-message latencies per backend, used to decide when a hedged request fires the next backend
+LM_STUDIO_LATENCY = LatencyTracker()
+OPENAI_LATENCY = LatencyTracker()
+
+
+def _single_message(messages: list, max_tokens: int = 200, temperature: float = 0.9, max_length: Optional[int] = None) -> bool:
+    """Whether a completion call asks for one message. Batches don't pass max_length and take far longer."""
+    return max_length is not None
+HEDGE_STATS = HedgeStats()
+
+# Batch generation: how many times missing or invalid messages are re-requested
+BATCH_MAX_ROUNDS = int(os.getenv("BATCH_MAX_ROUNDS", "3"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "10"))  # Messages asked for in a single request
+
+
+def _clean_message(content: str) -> str:
+    """Strip whitespace and any quotes the model wrapped the message in."""
+    message = content.strip()
+    # Remove quotes if the model wrapped it in quotes
+    if message.startswith('"') and message.endswith('"'):
+        message = message[1:-1]
+    if message.startswith("'") and message.endswith("'"):
+        message = message[1:-1]
+    return message
+
+
+def _prompt(
+    recipient_id: Optional[str],
+    recipient_name: str,
+    relationship: str,
+    style: str,
+    max_length: int,
+    count: Optional[int] = None
+) -> List[dict]:
+    """
+    Chat messages for a request, with the facts and earlier messages remembered for the
+    recipient that best match the time of day and the style (see recipient_memory.py).
+    """
+    facts, earlier = recall(recipient_id, f"{time_of_day()} {style}")
+    return build_messages(recipient_name, relationship, style, max_length, count=count, facts=facts, earlier=earlier)
+
+
+def _stream_usage(guard: StreamGuard, messages: list):
+    """
+    Token usage of a streamed request: what the server reported, or an estimate when the stream
+    was closed early (cut or aborted) and the usage chunk never came. The server may have
+    generated a little past the cut, so the estimate can be slightly low.
+    """
+    if guard.usage is not None:
+        return guard.usage
+    return SimpleNamespace(prompt_tokens=count_message_tokens(messages), completion_tokens=count_tokens(guard.text))
+
+
+def _chat(
+    backend: str,
+    client,
+    model: str,
+    messages: list,
+    max_tokens: int,
+    temperature: float,
+    max_length: Optional[int]
+) -> Optional[str]:
+    """
+    Run one chat completion and return its content, counting the tokens it used under backend.
+    With streaming enabled and a max_length, the message is checked as it arrives:
+    it is cut at a sentence boundary once long enough, and retried if it breaks a rule.
+    """
+    if max_length is None or not LLM_STREAMING:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        record_usage(backend, getattr(response, "usage", None))
+        return response.choices[0].message.content
+    
+    for attempt in range(1, STREAM_MAX_ATTEMPTS + 1):
+        guard = StreamGuard(max_length)
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}  # Usage comes in a last chunk, after the text
+        )
+        message = consume_stream(stream, guard)
+        record_usage(backend, _stream_usage(guard, messages))
+        if message:
+            RECENT_OPENERS.add(message)
+            return message
+        log.info(
+            "✂️  Stream aborted, retrying",
+            extra={"backend": backend, "reason": guard.violation or "empty message", "attempt": attempt}
+        )
+    raise ContentViolation(f"Model broke the message rules {STREAM_MAX_ATTEMPTS} times in a row")
+
+
+async def _chat_async(
+    backend: str,
+    client,
+    model: str,
+    messages: list,
+    max_tokens: int,
+    temperature: float,
+    max_length: Optional[int]
+) -> Optional[str]:
+    """Async version of _chat."""
+    if max_length is None or not LLM_STREAMING:
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        record_usage(backend, getattr(response, "usage", None))
+        return response.choices[0].message.content
+    
+    for attempt in range(1, STREAM_MAX_ATTEMPTS + 1):
+        guard = StreamGuard(max_length)
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}  # Usage comes in a last chunk, after the text
+        )
+        message = await consume_stream_async(stream, guard)
+        record_usage(backend, _stream_usage(guard, messages))
+        if message:
+            RECENT_OPENERS.add(message)
+            return message
+        log.info(
+            "✂️  Stream aborted, retrying",
+            extra={"backend": backend, "reason": guard.violation or "empty message", "attempt": attempt}
+        )
+    raise ContentViolation(f"Model broke the message rules {STREAM_MAX_ATTEMPTS} times in a row")
+
+
+# The limiter wraps the breaker: queueing for a slot says nothing about the backend's health
+@limited_by(LM_STUDIO_LIMITER)
+@guarded_by(LM_STUDIO_BREAKER)
+@stage("llm_request", backend="lm_studio")
+@timed(LM_STUDIO_LATENCY, when=_single_message)
+def _lm_studio_completion(
+    messages: list,
+    max_tokens: int = 200,
+    temperature: float = 0.9,
+    max_length: Optional[int] = None
+) -> str:
+    """
+    Run a chat completion against LM Studio and return the raw content.
+    Uses the pooled client and the cached model, re-detecting it once if it was unloaded.
+    Pass max_length to stream and check a single message as it is generated (see LLM_STREAMING).
+    """
+    # LM Studio uses OpenAI-compatible API, but no API key needed
+    # Use a dummy key since LM Studio doesn't require authentication
+    # The client is pooled, so the connection is reused across messages
+    client = get_client(LM_STUDIO_BASE_URL, "lm-studio")
+    
+    # Get the model name - use the specified one, or the cached auto-detected one
+    model = LM_STUDIO_MODEL
+    if not model:
+        model = get_model(client, LM_STUDIO_BASE_URL)
+    
+    try:
+        content = _chat("lm_studio", client, model, messages, max_tokens, temperature, max_length)
+    except Exception as e:
+        # The loaded model changed since it was cached - detect it again and retry once
+        if LM_STUDIO_MODEL or not is_model_not_found(e):
+            raise
+        log.warning("⚠️  Model is no longer loaded, re-detecting", extra={"model": model})
+        invalidate_model(LM_STUDIO_BASE_URL)
+        model = get_model(client, LM_STUDIO_BASE_URL)
+        content = _chat("lm_studio", client, model, messages, max_tokens, temperature, max_length)
+    
+    if content is None:
+        raise Exception("LM Studio returned None content. The model may not have generated a response.")
+    return content
+
+
+@limited_by(OPENAI_LIMITER)
+@guarded_by(OPENAI_BREAKER)
+@stage("llm_request", backend="openai")
+@timed(OPENAI_LATENCY, when=_single_message)
+def _openai_completion(
+    messages: list,
+    max_tokens: int = 200,
+    temperature: float = 0.9,
+    max_length: Optional[int] = None
+) -> str:
+    """Run a chat completion against OpenAI and return the raw content."""
+    client = get_client(OPENAI_BASE_URL, OPENAI_API_KEY)
+    content = _chat("openai", client, DEFAULT_MODEL, messages, max_tokens, temperature, max_length)
+    
+    if content is None:
+        raise Exception("OpenAI returned None content. The model may not have generated a response.")
+    return content
+
+
+@limited_by(LM_STUDIO_LIMITER)
+@guarded_by(LM_STUDIO_BREAKER)
+@stage("llm_request", backend="lm_studio")
+@timed(LM_STUDIO_LATENCY, when=_single_message)
+async def _lm_studio_completion_async(
+    messages: list,
+    max_tokens: int = 200,
+    temperature: float = 0.9,
+    max_length: Optional[int] = None
+) -> str:
+    """Async version of _lm_studio_completion using the pooled AsyncOpenAI client."""
+    client = get_async_client(LM_STUDIO_BASE_URL, "lm-studio")
+    
+    model = LM_STUDIO_MODEL
+    if not model:
+        model = await get_model_async(client, LM_STUDIO_BASE_URL)
+    
+    try:
+        content = await _chat_async("lm_studio", client, model, messages, max_tokens, temperature, max_length)
+    except Exception as e:
+        if LM_STUDIO_MODEL or not is_model_not_found(e):
+            raise
+        log.warning("⚠️  Model is no longer loaded, re-detecting", extra={"model": model})
+        invalidate_model(LM_STUDIO_BASE_URL)
+        model = await get_model_async(client, LM_STUDIO_BASE_URL)
+        content = await _chat_async("lm_studio", client, model, messages, max_tokens, temperature, max_length)
+    
+    if content is None:
+        raise Exception("LM Studio returned None content. The model may not have generated a response.")
+    return content
+
+
+@limited_by(OPENAI_LIMITER)
+@guarded_by(OPENAI_BREAKER)
+@stage("llm_request", backend="openai")
+@timed(OPENAI_LATENCY, when=_single_message)
+async def _openai_completion_async(
+    messages: list,
+    max_tokens: int = 200,
+    temperature: float = 0.9,
+    max_length: Optional[int] = None
+) -> str:
+    """Async version of _openai_completion using the pooled AsyncOpenAI client."""
+    client = get_async_client(OPENAI_BASE_URL, OPENAI_API_KEY)
+    content = await _chat_async("openai", client, DEFAULT_MODEL, messages, max_tokens, temperature, max_length)
+    
+    if content is None:
+        raise Exception("OpenAI returned None content. The model may not have generated a response.")
+    return content
+
+
 def generate_message_lm_studio(
     recipient_name: str = "darling",
     relationship: str = "romantic partner",
     style: str = "sweet and loving",
-    max_length: int = 100
+    max_length: int = 100,
+    recipient_id: Optional[str] = None
 ) -> str:
     """
     Generate a message using LM Studio local API.
@@ -41,85 +337,32 @@ def generate_message_lm_studio(
         relationship: Relationship with recipient
         style: Style of the message
         max_length: Maximum length of the message
+        recipient_id: Phone number of the recipient, to add what is remembered about them
     
     Returns:
         Generated message string
     """
-    if not OPENAI_AVAILABLE or openai is None:
+    if not OPENAI_AVAILABLE:
         raise ImportError("OpenAI library not installed. Run: pip install openai")
     
-    print(f"   📡 Connecting to LM Studio at {LM_STUDIO_BASE_URL}...")
+    log.debug("📡 Connecting to LM Studio", extra={"url": LM_STUDIO_BASE_URL})
     
-    # LM Studio uses OpenAI-compatible API, but no API key needed
-    # Use a dummy key since LM Studio doesn't require authentication
-    client = openai.OpenAI(  # type: ignore
-        base_url=LM_STUDIO_BASE_URL,
-        api_key="lm-studio"  # LM Studio doesn't require a real API key
-    )
-    
-    prompt = f"""Generate a romantic, funny, loving, and cute WhatsApp message for my {relationship} named {recipient_name}.
-
-The message should be:
-- Romantic and heartfelt, expressing deep love and affection
-- Funny and playful, with cute humor that makes them smile
-- Loving and warm, showing how much they mean to you
-- Cute and endearing, with sweet details or inside jokes if possible
-- Multiple sentences (2-4 sentences), not just one generic line
-- Personal and specific, not generic or cliché, do not use the same message twice
-- Do not form any stories or use any quotes or idioms
-- Do not use any emojis or special characters
-- Natural and conversational, like you're really talking to them
-- Include 2-4 emojis that match the tone
-- Keep it under {max_length} characters total
-
-Make it feel genuine, like you're really thinking about them right now. Mix romance with humor and cuteness.
-
-Generate only the message text, nothing else:"""
-
     try:
-        # Get the model name - try to fetch from LM Studio, or use specified/default
-        model = LM_STUDIO_MODEL
-        if not model:
-            # Try to get the first available model from LM Studio
-            try:
-                print("   🔍 Detecting available model from LM Studio...")
-                models_response = client.models.list()
-                if models_response.data and len(models_response.data) > 0:
-                    model = models_response.data[0].id
-                    print(f"   ✓ Found model: {model}")
-                else:
-                    model = "local-model"  # Fallback
-                    print("   ⚠️  No models found, using default")
-            except Exception as e:
-                model = "local-model"  # Fallback if we can't list models
-                print(f"   ⚠️  Could not list models: {e}, using default")
-        else:
-            print(f"   ✓ Using specified model: {model}")
+        if LM_STUDIO_MODEL:
+            log.debug("✓ Using specified model", extra={"model": LM_STUDIO_MODEL})
         
-        print("   🎨 Generating message with LM Studio...")
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a creative and romantic message writer who creates heartfelt, funny, and cute WhatsApp messages. You excel at mixing romance with humor and creating messages that feel genuine and personal."},
-                {"role": "user", "content": prompt}
-            ],
+        content = _lm_studio_completion(
+            _prompt(recipient_id, recipient_name, relationship, style, max_length),
             max_tokens=200,  # Increased for longer messages
-            temperature=0.9  # Higher temperature for more creativity and variety
+            temperature=0.9,  # Higher temperature for more creativity and variety
+            max_length=max_length  # Checked while streaming when LLM_STREAMING is on
         )
+        message = _clean_message(content)
         
-        content = response.choices[0].message.content
-        if content is None:
-            raise Exception("LM Studio returned None content. The model may not have generated a response.")
-        
-        message = content.strip()
-        # Remove quotes if the model wrapped it in quotes
-        if message.startswith('"') and message.endswith('"'):
-            message = message[1:-1]
-        if message.startswith("'") and message.endswith("'"):
-            message = message[1:-1]
-        
-        print(f"   ✓ Generated {len(message)} characters")
+        log.debug("✓ Generated message", extra={"backend": "lm_studio", "chars": len(message)})
         return message
+    except CircuitOpenError:
+        raise
     except Exception as e:
         raise Exception(f"Failed to generate message with LM Studio: {e}. Make sure LM Studio is running and the server is active.")
 
@@ -128,7 +371,8 @@ def generate_message_openai(
     recipient_name: str = "darling",
     relationship: str = "romantic partner",
     style: str = "sweet and loving",
-    max_length: int = 100
+    max_length: int = 100,
+    recipient_id: Optional[str] = None
 ) -> str:
     """
     Generate a message using OpenAI API.
@@ -138,11 +382,12 @@ def generate_message_openai(
         relationship: Relationship with recipient
         style: Style of the message
         max_length: Maximum length of the message
+        recipient_id: Phone number of the recipient, to add what is remembered about them
     
     Returns:
         Generated message string
     """
-    if not OPENAI_AVAILABLE or openai is None:
+    if not OPENAI_AVAILABLE:
         raise ImportError("OpenAI library not installed. Run: pip install openai")
     
     if not OPENAI_API_KEY:
@@ -150,48 +395,18 @@ def generate_message_openai(
             "OPENAI_API_KEY not set. Set it as an environment variable or in the script."
         )
     
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)  # type: ignore
-    
-    prompt = f"""Generate a romantic, funny, loving, and cute WhatsApp message for my {relationship} named {recipient_name}.
-
-The message should be:
-- Romantic and heartfelt, expressing deep love and affection
-- Funny and playful, with cute humor that makes them smile
-- Loving and warm, showing how much they mean to you
-- Cute and endearing, with sweet details or inside jokes if possible
-- Multiple sentences (2-4 sentences), not just one generic line
-- Personal and specific, not generic or cliché
-- Natural and conversational, like you're really talking to them
-- Include 2-4 emojis that match the tone
-- Keep it under {max_length} characters total
-
-Make it feel genuine, like you're really thinking about them right now. Mix romance with humor and cuteness.
-
-Generate only the message text, nothing else:"""
-
     try:
-        response = client.chat.completions.create(
-            model=DEFAULT_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a creative and romantic message writer who creates heartfelt, funny, and cute WhatsApp messages. You excel at mixing romance with humor and creating messages that feel genuine and personal."},
-                {"role": "user", "content": prompt}
-            ],
+        content = _openai_completion(
+            _prompt(recipient_id, recipient_name, relationship, style, max_length),
             max_tokens=200,  # Increased for longer messages
-            temperature=0.9  # Higher temperature for more creativity and variety
+            temperature=0.9,  # Higher temperature for more creativity and variety
+            max_length=max_length  # Checked while streaming when LLM_STREAMING is on
         )
-        
-        content = response.choices[0].message.content
-        if content is None:
-            raise Exception("OpenAI returned None content. The model may not have generated a response.")
-        
-        message = content.strip()
-        # Remove quotes if the model wrapped it in quotes
-        if message.startswith('"') and message.endswith('"'):
-            message = message[1:-1]
-        if message.startswith("'") and message.endswith("'"):
-            message = message[1:-1]
+        message = _clean_message(content)
         
         return message
+    except CircuitOpenError:
+        raise
     except Exception as e:
         raise Exception(f"Failed to generate message with OpenAI: {e}")
 
@@ -203,34 +418,11 @@ def generate_message_simple(
 ) -> str:
     """
     Generate a simple message without LLM (fallback option).
-    Uses template-based generation.
+    Uses template-based generation from the template corpus (see template_engine.py),
+    avoiding templates recently used for the same recipient.
     """
-    import random
-    from datetime import datetime
-    
-    hour = datetime.now().hour
-    
-    # Time-based greetings
-    if hour < 12:
-        greeting = "Good morning"
-    elif hour < 17:
-        greeting = "Good afternoon"
-    else:
-        greeting = "Good evening"
-    
-    # Message templates - More romantic, funny, and cute
-    templates = [
-        f"{greeting} {recipient_name}! 💕 I was just thinking about you and couldn't help but smile. You have this amazing way of making everything better, even when you're not here. Sending you all my love and a million hugs! 🤗❤️",
-        f"Hey {recipient_name}! 😊 I know this is random, but I was just sitting here and realized how incredibly lucky I am to have you. You're not just my {relationship}, you're my favorite person, my best friend, and honestly, the cutest human on the planet! 💖✨",
-        f"Hi beautiful! 🌟 Just wanted to tell you that I love you more than words can say. You make my heart do this little happy dance every time I think of you (which is basically all the time 😅). Can't wait to see you! 💕",
-        f"{greeting} {recipient_name}! 💭 You know what's funny? I was trying to focus on something, but my brain kept going 'but what about {recipient_name}?' 😂 I guess my heart just really misses you right now. Sending you all the love! ❤️🤗",
-        f"Hey {recipient_name}! ☀️ I hope you're having the most amazing day because you absolutely deserve it! You're the kind of person who makes everything brighter just by existing. Also, you're super cute and I love you! 💖😊",
-        f"Hi {recipient_name}! 💕 Random thought: I was just thinking about how you laugh at my terrible jokes and how you make even the most ordinary moments feel special. You're honestly the best thing that's ever happened to me. Love you so much! ❤️✨",
-        f"{greeting} my love! 🤗 I know I tell you this a lot, but you're genuinely the most amazing person I know. You're beautiful, funny, kind, and you put up with me - which honestly deserves an award! 😂💖",
-        f"Hey {recipient_name}! 🌟 Just a quick message to say you're on my mind (as always) and I'm sending you all the good vibes, hugs, and love! You make everything better just by being you. Can't wait to talk to you! 💕😊",
-    ]
-    
-    return random.choice(templates)
+    with stage("template_render"):
+        return get_template_engine().render(recipient_name, relationship, style)
 
 
 def generate_message(
@@ -238,7 +430,8 @@ def generate_message(
     recipient_name: str = "darling",
     relationship: str = "romantic partner",
     style: str = "sweet and loving",
-    max_length: int = 200
+    max_length: int = 200,
+    recipient_id: Optional[str] = None
 ) -> str:
     """
     Main function to generate a message.
@@ -250,10 +443,23 @@ def generate_message(
         relationship: Relationship with recipient
         style: Style of the message
         max_length: Maximum length of the message
+        recipient_id: Phone number of the recipient, to add what is remembered about them
     
     Returns:
         Generated message string
     """
+    with stage("generate"):
+        return _generate_message(use_llm, recipient_name, relationship, style, max_length, recipient_id)
+
+
+def _generate_message(
+    use_llm: bool,
+    recipient_name: str,
+    relationship: str,
+    style: str,
+    max_length: int,
+    recipient_id: Optional[str] = None
+) -> str:
     if not use_llm:
         return generate_message_simple(
             recipient_name=recipient_name,
@@ -262,7 +468,7 @@ def generate_message(
         )
     
     if not OPENAI_AVAILABLE:
-        print("⚠️  OpenAI library not installed. Using simple message generation...")
+        log.warning("⚠️  OpenAI library not installed. Using simple message generation...")
         return generate_message_simple(
             recipient_name=recipient_name,
             relationship=relationship,
@@ -272,43 +478,47 @@ def generate_message(
     # Try LM Studio first (if enabled), then OpenAI, then fallback
     if USE_LM_STUDIO:
         try:
-            print("🤖 Using LM Studio to generate message...")
+            log.info("🤖 Using LM Studio to generate message...")
             message = generate_message_lm_studio(
                 recipient_name=recipient_name,
                 relationship=relationship,
                 style=style,
-                max_length=max_length
+                max_length=max_length,
+                recipient_id=recipient_id
             )
-            print("✅ Message successfully generated by LM Studio!")
+            log.info("✅ Message successfully generated by LM Studio!")
             return message
+        except CircuitOpenError as e:
+            log.info(f"⏭️  {e}, trying OpenAI...")
+            FALLBACKS.inc(source="lm_studio", reason="circuit_open")
         except Exception as e:
-            print(f"⚠️  LM Studio generation failed: {e}")
-            print("   Trying OpenAI...")
+            log.warning("⚠️  LM Studio generation failed, trying OpenAI...", extra={"error": str(e)})
+            FALLBACKS.inc(source="lm_studio", reason="error")
             # Fall through to try OpenAI if LM Studio fails
     
     # Try OpenAI if LM Studio is disabled or failed
     if OPENAI_API_KEY:
         try:
-            print("🌐 Using OpenAI to generate message...")
+            log.info("🌐 Using OpenAI to generate message...")
             message = generate_message_openai(
                 recipient_name=recipient_name,
                 relationship=relationship,
                 style=style,
-                max_length=max_length
+                max_length=max_length,
+                recipient_id=recipient_id
             )
-            print("✅ Message successfully generated by OpenAI!")
+            log.info("✅ Message successfully generated by OpenAI!")
             return message
         except Exception as e:
-            print(f"⚠️  OpenAI generation failed: {e}")
-            print("   Falling back to simple message generation...")
+            log.warning("⚠️  OpenAI generation failed, falling back to simple message generation...", extra={"error": str(e)})
+            FALLBACKS.inc(source="openai", reason="circuit_open" if isinstance(e, CircuitOpenError) else "error")
             return generate_message_simple(
                 recipient_name=recipient_name,
                 relationship=relationship,
                 style=style
             )
     else:
-        print("⚠️  No LLM configured (LM Studio not running or OpenAI API key not set).")
-        print("   Using simple template-based message generation...")
+        log.warning("⚠️  No LLM configured (LM Studio not running or OpenAI API key not set). Using simple template-based message generation...")
         return generate_message_simple(
             recipient_name=recipient_name,
             relationship=relationship,
@@ -316,43 +526,334 @@ def generate_message(
         )
 
 
-def test_lm_studio_connection() -> bool:
+async def generate_message_async(
+    use_llm: bool = True,
+    recipient_name: str = "darling",
+    relationship: str = "romantic partner",
+    style: str = "sweet and loving",
+    max_length: int = 200,
+    recipient_id: Optional[str] = None
+) -> str:
+    """
+    Async version of generate_message with the same arguments and fallback order.
+    Lets many messages be generated concurrently on one event loop.
+    
+    Returns:
+        Generated message string
+    """
+    if not use_llm or not OPENAI_AVAILABLE:
+        return generate_message_simple(
+            recipient_name=recipient_name,
+            relationship=relationship,
+            style=style
+        )
+    
+    backends = []
+    if USE_LM_STUDIO:
+        backends.append(("lm_studio", _lm_studio_completion_async))
+    if OPENAI_API_KEY:
+        backends.append(("openai", _openai_completion_async))
+    
+    messages = _prompt(recipient_id, recipient_name, relationship, style, max_length) if backends else []
+    for backend, complete in backends:
+        try:
+            content = await complete(
+                messages,
+                max_tokens=200,
+                temperature=0.9,
+                max_length=max_length
+            )
+            return _clean_message(content)
+        except Exception as e:
+            log.warning("⚠️  Generation failed", extra={"backend": backend, "recipient": recipient_name, "error": str(e)})
+            FALLBACKS.inc(source=backend, reason="circuit_open" if isinstance(e, CircuitOpenError) else "error")
+    
+    return generate_message_simple(
+        recipient_name=recipient_name,
+        relationship=relationship,
+        style=style
+    )
+
+
+async def generate_message_hedged_async(
+    recipient_name: str = "darling",
+    relationship: str = "romantic partner",
+    style: str = "sweet and loving",
+    max_length: int = 200,
+    deadline: Optional[float] = None,
+    recipient_id: Optional[str] = None
+) -> str:
+    """
+    Generate a message by racing the LLM backends under a latency budget.
+    The preferred backend starts first; if it hasn't answered within its p95 latency,
+    the next one is started too and whichever answers first wins (the other is cancelled).
+    
+    Args:
+        recipient_name: Name of the recipient
+        relationship: Relationship with recipient
+        style: Style of the message
+        max_length: Maximum length of the message
+        deadline: Seconds to wait for an LLM before using a template message
+        recipient_id: Phone number of the recipient, to add what is remembered about them
+    
+    Returns:
+        Generated message string
+    """
+    candidates = []
+    if OPENAI_AVAILABLE:
+        messages = _prompt(recipient_id, recipient_name, relationship, style, max_length)
+        # Backends with an open circuit are left out instead of being raced
+        if USE_LM_STUDIO and LM_STUDIO_BREAKER.state != OPEN:
+            candidates.append((
+                "LM Studio",
+                lambda: _lm_studio_completion_async(messages, max_length=max_length),
+                LM_STUDIO_LATENCY.hedge_delay()
+            ))
+        if OPENAI_API_KEY and OPENAI_BREAKER.state != OPEN:
+            candidates.append((
+                "OpenAI",
+                lambda: _openai_completion_async(messages, max_length=max_length),
+                OPENAI_LATENCY.hedge_delay()
+            ))
+    
+    with stage("generate_hedged"):
+        content, winner = await hedged_race(candidates, HEDGE_STATS, deadline=deadline)
+    if content is None:
+        log.warning("⚠️  No LLM answered in time, using simple message generation...")
+        FALLBACKS.inc(source="hedged", reason="deadline")
+        return generate_message_simple(
+            recipient_name=recipient_name,
+            relationship=relationship,
+            style=style
+        )
+    log.info("✅ Message generated (hedged request)", extra={"backend": winner})
+    return _clean_message(content)
+
+
+def generate_message_hedged(
+    recipient_name: str = "darling",
+    relationship: str = "romantic partner",
+    style: str = "sweet and loving",
+    max_length: int = 200,
+    deadline: Optional[float] = None,
+    recipient_id: Optional[str] = None
+) -> str:
+    """Blocking wrapper around generate_message_hedged_async."""
+    return run(generate_message_hedged_async(
+        recipient_name=recipient_name,
+        relationship=relationship,
+        style=style,
+        max_length=max_length,
+        deadline=deadline,
+        recipient_id=recipient_id
+    ))
+
+
+def _parse_message_list(content: str) -> List[str]:
+    """
+    Pull the list of messages out of a batch response.
+    Tolerates code fences or chatter around the JSON array.
+    """
+    start = content.find("[")
+    end = content.rfind("]")
+    if start == -1 or end <= start:
+        return []
+    try:
+        data = json.loads(content[start:end + 1])
+    except ValueError:
+        return []
+    if not isinstance(data, list):
+        return []
+    
+    messages = []
+    for item in data:
+        if isinstance(item, dict):
+            item = item.get("message") or item.get("text")
+        if isinstance(item, str):
+            messages.append(item)
+    return messages
+
+
+def generate_messages(
+    n: int,
+    use_llm: bool = True,
+    recipient_name: str = "darling",
+    relationship: str = "romantic partner",
+    style: str = "sweet and loving",
+    max_length: int = 200,
+    recipient_id: Optional[str] = None
+) -> List[str]:
+    """
+    Generate several distinct messages, asking the LLM for many in one request.
+    Invalid or duplicate messages are dropped and only the missing ones are re-requested.
+    Anything the LLMs can't provide is filled with template messages.
+    
+    Args:
+        n: Number of messages to generate
+        use_llm: Whether to use LLM or simple template-based generation
+        recipient_name: Name of the recipient
+        relationship: Relationship with recipient
+        style: Style of the message
+        max_length: Maximum length of each message
+        recipient_id: Phone number of the recipient, to add what is remembered about them
+    
+    Returns:
+        List of n generated message strings
+    """
+    with stage("generate_batch"):
+        return _generate_messages(n, use_llm, recipient_name, relationship, style, max_length, recipient_id)
+
+
+def _generate_messages(
+    n: int,
+    use_llm: bool,
+    recipient_name: str,
+    relationship: str,
+    style: str,
+    max_length: int,
+    recipient_id: Optional[str] = None
+) -> List[str]:
+    results: List[str] = []
+    seen = set()
+    
+    backends = []
+    if use_llm and OPENAI_AVAILABLE:
+        if USE_LM_STUDIO:
+            backends.append(("lm_studio", _lm_studio_completion))
+        if OPENAI_API_KEY:
+            backends.append(("openai", _openai_completion))
+    
+    for backend, complete in backends:
+        short_rounds = 0
+        while len(results) < n and short_rounds < BATCH_MAX_ROUNDS:
+            count = min(n - len(results), BATCH_MAX_SIZE)
+            log.info("🤖 Asking for messages in one request", extra={"backend": backend, "count": count})
+            try:
+                content = complete(
+                    _prompt(recipient_id, recipient_name, relationship, style, max_length, count=count),
+                    max_tokens=min(200 * count, 4000),
+                    temperature=0.9
+                )
+            except Exception as e:
+                log.warning("⚠️  Batch generation failed", extra={"backend": backend, "error": str(e)})
+                FALLBACKS.inc(source=backend, reason="circuit_open" if isinstance(e, CircuitOpenError) else "error")
+                break
+            
+            accepted = 0
+            for candidate in _parse_message_list(content)[:count]:
+                message = _clean_message(candidate)
+                key = message.lower()
+                if not message or len(message) > max_length or key in seen:
+                    continue
+                seen.add(key)
+                results.append(message)
+                accepted += 1
+            
+            if accepted < count:
+                short_rounds += 1
+                log.info("⚠️  Too few valid messages, re-requesting the rest...", extra={"valid": accepted, "count": count})
+        
+        if len(results) >= n:
+            break
+    
+    if len(results) < n and use_llm:
+        log.warning("⚠️  Filling messages with simple message generation...", extra={"count": n - len(results)})
+        FALLBACKS.inc(source="batch", reason="short")
+    while len(results) < n:
+        results.append(generate_message_simple(
+            recipient_name=recipient_name,
+            relationship=relationship,
+            style=style
+        ))
+    return results
+
+
+def test_lm_studio_connection(verbose: bool = True) -> bool:
     """
     Test if LM Studio is accessible and working.
     
+    Args:
+        verbose: Print the result and troubleshooting tips (off for background health probes)
+    
     Returns:
         True if LM Studio is accessible, False otherwise
     """
-    if not OPENAI_AVAILABLE or openai is None:
-        print("❌ OpenAI library not installed")
+    if not OPENAI_AVAILABLE:
+        if verbose:
+            log.error("❌ OpenAI library not installed")
         return False
     
     try:
-        print(f"🔍 Testing LM Studio connection at {LM_STUDIO_BASE_URL}...")
-        client = openai.OpenAI(  # type: ignore
-            base_url=LM_STUDIO_BASE_URL,
-            api_key="lm-studio"
-        )
+        if verbose:
+            log.info("🔍 Testing LM Studio connection...", extra={"url": LM_STUDIO_BASE_URL})
+        client = get_client(LM_STUDIO_BASE_URL, "lm-studio")
         
         # Try to list models
         models_response = client.models.list()
         if models_response.data and len(models_response.data) > 0:
-            print(f"✅ LM Studio is connected! Available model: {models_response.data[0].id}")
+            if verbose:
+                log.info("✅ LM Studio is connected!", extra={"model": models_response.data[0].id})
             return True
         else:
-            print("⚠️  LM Studio is reachable but no models are loaded")
+            if verbose:
+                log.warning("⚠️  LM Studio is reachable but no models are loaded")
             return False
     except Exception as e:
-        print(f"❌ LM Studio connection failed: {e}")
-        print("   Make sure:")
-        print("   1. LM Studio is running")
-        print("   2. A model is loaded in LM Studio")
-        print("   3. The local server is started in LM Studio")
-        print(f"   4. The server URL is correct: {LM_STUDIO_BASE_URL}")
+        if verbose:
+            log.error(
+                "❌ LM Studio connection failed. Make sure LM Studio is running, a model is loaded, "
+                "the local server is started and the server URL is correct",
+                extra={"url": LM_STUDIO_BASE_URL, "error": str(e)}
+            )
         return False
 
 
+def get_hedge_stats() -> dict:
+    """How often hedged requests fired a backup backend, and how often it won."""
+    return HEDGE_STATS.as_dict()
+
+
+def get_breaker_stats() -> dict:
+    """State and trip counts of each backend's circuit breaker."""
+    return {
+        "lm_studio": LM_STUDIO_BREAKER.stats(),
+        "openai": OPENAI_BREAKER.stats(),
+    }
+
+
+def get_limiter_stats() -> dict:
+    """Concurrency limit, requests in flight and queued callers of each backend."""
+    return {
+        "lm_studio": LM_STUDIO_LIMITER.stats(),
+        "openai": OPENAI_LIMITER.stats(),
+    }
+
+
+_health_probe: Optional[HealthProbe] = None
+
+
+def start_health_probe() -> Optional[HealthProbe]:
+    """
+    Start probing LM Studio in the background so a dead server is skipped
+    before any message waits on it, and re-admitted as soon as it is back.
+    
+    Returns:
+        The running probe, or None if LM Studio is disabled
+    """
+    global _health_probe
+    if not USE_LM_STUDIO or not OPENAI_AVAILABLE:
+        return None
+    if _health_probe is None:
+        _health_probe = HealthProbe()
+        _health_probe.add(LM_STUDIO_BREAKER, lambda: test_lm_studio_connection(verbose=False))
+    _health_probe.start()
+    return _health_probe
+
+
 if __name__ == "__main__":
+    from log_setup import configure_logging
+
+    configure_logging()
     # Test the message generator
     print("=" * 60)
     print("Testing message generator...")
@@ -381,6 +882,8 @@ if __name__ == "__main__":
             print(f"\n📝 Generated message:\n{result}")
         except Exception as e:
             print(f"❌ Error: {e}")
+        
+        print(f"\n   Circuit breakers: {get_breaker_stats()}")
     else:
         print("\n2. LLM generation skipped (OpenAI library not installed)")
         print("   Install with: pip install openai")
@@ -0,0 +1,167 @@
+"""
+Sent-message history for the WhatsApp Bot
+Remembers every message sent and finds near-duplicates with a MinHash/LSH index,
+so a candidate is checked against years of history without scanning all of it
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+
+# Configuration
+MESSAGE_HISTORY_FILE = os.getenv("MESSAGE_HISTORY_FILE", "sent_messages.jsonl")
+# Candidates at least this similar (Jaccard over word shingles) to a sent message are rejected
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.5"))
+
+SHINGLE_SIZE = 3  # Words per shingle
+NUM_PERMUTATIONS = 64
+LSH_RECALL = 0.99  # Chance a pair exactly at the threshold lands in a shared bucket (sets the bands, see lsh_rows)
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Fixed seed so signatures stored on disk stay valid across runs
+_rng = random.Random(20240601)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+
+def shingles(text: str) -> Set[int]:
+    """Hashed word shingles of a message, ignoring case, punctuation and emojis."""
+    words = re.findall(r"[\w']+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))} if words else set()
+    return {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_SIZE]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def minhash(shingle_set: Set[int]) -> List[int]:
+    """MinHash signature of a shingle set."""
+    if not shingle_set:
+        return [_MAX_HASH] * NUM_PERMUTATIONS
+    return [
+        min(((a * s + b) % _PRIME) & _MAX_HASH for s in shingle_set)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def jaccard(a: Set[int], b: Set[int]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_rows(threshold: float, recall: float = LSH_RECALL) -> int:
+    """
+    Rows per LSH band for a similarity threshold: the most rows (fewest false candidates)
+    whose bands still bucket a pair of that similarity together with probability `recall`.
+    With NUM_PERMUTATIONS // rows bands, that probability is 1 - (1 - threshold ** rows) ** bands.
+    """
+    best = 1
+    for rows in range(1, NUM_PERMUTATIONS + 1):
+        if NUM_PERMUTATIONS % rows:
+            continue
+        bands = NUM_PERMUTATIONS // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            best = rows
+    return best
+
+
+def _band_keys(signature: List[int], rows: int) -> List[Tuple[int, int]]:
+    return [
+        (band, hash(tuple(signature[band * rows:(band + 1) * rows])))
+        for band in range(NUM_PERMUTATIONS // rows)
+    ]
+
+
+class MessageHistory:
+    """
+    Append-only log of sent messages with a near-duplicate index.
+
+    Each record stores its MinHash signature, so loading years of history only
+    rebuilds the LSH buckets instead of re-hashing every message.
+
+    Args:
+        path: JSON Lines file the history is kept in (None keeps it in memory only)
+        threshold: Similarity at or above which a message counts as a near-duplicate
+    """
+
+    def __init__(self, path: Optional[str] = MESSAGE_HISTORY_FILE, threshold: float = DUPLICATE_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._rows = lsh_rows(threshold)
+        self._lock = threading.Lock()
+        self._texts: List[str] = []
+        self._recipients: List[str] = []
+        self._buckets: Dict[Tuple[int, int], List[int]] = {}
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def find_similar(self, text: str, recipient: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """
+        Look for a sent message that is a near-duplicate of text.
+
+        Args:
+            text: Candidate message
+            recipient: Only compare with messages sent to this recipient (None compares with everyone)
+
+        Returns:
+            (most similar sent message, similarity) if one is at or above the threshold, else None
+        """
+        candidate_shingles = shingles(text)
+        signature = minhash(candidate_shingles)
+        with self._lock:
+            ids = set()
+            for key in _band_keys(signature, self._rows):
+                ids.update(self._buckets.get(key, ()))
+            best = None
+            for message_id in ids:
+                if recipient is not None and self._recipients[message_id] != recipient:
+                    continue
+                similarity = jaccard(candidate_shingles, shingles(self._texts[message_id]))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (self._texts[message_id], similarity)
+        return best
+
+    def is_duplicate(self, text: str, recipient: Optional[str] = None) -> bool:
+        """Whether text is a near-duplicate of a message already sent (to recipient, if given)."""
+        return self.find_similar(text, recipient) is not None
+
+    def record(self, text: str, recipient: str) -> None:
+        """Remember a sent message and append it to the history file."""
+        signature = minhash(shingles(text))
+        with self._lock:
+            self._add(text, recipient, signature)
+            if self.path:
+                entry = {"time": time.time(), "recipient": recipient, "text": text, "minhash": signature}
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _add(self, text: str, recipient: str, signature: List[int]) -> None:
+        message_id = len(self._texts)
+        self._texts.append(text)
+        self._recipients.append(recipient)
+        for key in _band_keys(signature, self._rows):
+            self._buckets.setdefault(key, []).append(message_id)
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as f:  # type: ignore
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A half-written last line from a crash
+                signature = entry.get("minhash")
+                if not isinstance(signature, list) or len(signature) != NUM_PERMUTATIONS:
+                    signature = minhash(shingles(entry["text"]))
+                self._add(entry["text"], entry.get("recipient", ""), signature)
@@ -0,0 +1,337 @@
+"""
+Metrics for the WhatsApp Bot
+Low-overhead counters and latency histograms for every stage of generating and
+sending a message, exported to a Prometheus textfile or as JSON lines
+"""
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+# Configuration
+METRICS_FILE = os.getenv("METRICS_FILE", "")  # Where metrics are exported (empty disables the exporter)
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "prometheus")  # prometheus (textfile) or jsonl
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "15"))  # Seconds between exports
+
+# Upper bounds (seconds) of the latency histogram buckets - from a template render to a GUI send
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """A monotonically increasing count per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def prometheus_lines(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(labels)} {value:g}"
+
+    def snapshot(self):
+        with self._lock:
+            return [{"labels": dict(labels), "value": value} for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """A value per label set that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """Observations counted into fixed buckets per label set, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (last one is +Inf), sum]
+        self._values: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(_labels(labels))
+            return sum(entry[0]) if entry else 0
+
+    def percentile(self, percent: float, **labels) -> Optional[float]:
+        """Upper bound of the bucket holding the given percentile, or None without observations."""
+        with self._lock:
+            entry = self._values.get(_labels(labels))
+            counts = list(entry[0]) if entry else []
+        total = sum(counts)
+        if not total:
+            return None
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            if running >= percent / 100 * total:
+                return bound
+        return float("inf")
+
+    def prometheus_lines(self):
+        with self._lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+        for labels, (counts, total) in sorted(values.items()):
+            running = 0
+            for bound, count in zip(self.buckets, counts):
+                running += count
+                yield f"{self.name}_bucket{_format_labels(labels, ('le', f'{bound:g}'))} {running}"
+            running += counts[-1]
+            yield f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {running}"
+            yield f"{self.name}_sum{_format_labels(labels)} {total:.6f}"
+            yield f"{self.name}_count{_format_labels(labels)} {running}"
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    "labels": dict(labels),
+                    "count": sum(counts),
+                    "sum": round(total, 6),
+                    "buckets": dict(zip([f"{b:g}" for b in self.buckets] + ["+Inf"], counts)),
+                }
+                for labels, (counts, total) in sorted(self._values.items())
+            ]
+
+
+class Registry:
+    """All metrics of the process, rendered together for export."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(name, lambda: Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(name, lambda: Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, help_text, buckets))
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._sorted():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.prometheus_lines())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Metrics as plain data, for JSON export."""
+        return {metric.name: metric.snapshot() for metric in self._sorted()}
+
+    def write(self, path: str, fmt: str = METRICS_FORMAT) -> None:
+        """
+        Export the metrics once.
+
+        Args:
+            path: Output file
+            fmt: "prometheus" replaces the file atomically (for node_exporter's textfile collector),
+                 "jsonl" appends one snapshot line per call
+        """
+        if fmt == "jsonl":
+            line = json.dumps({"time": time.time(), "metrics": self.snapshot()})
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            return
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(temporary, path)  # Readers never see a half-written file
+
+    def _register(self, name, create):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = create()
+            return metric
+
+    def _sorted(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "whatsapp_bot_stage_seconds", "Time spent in each stage of generating and sending a message"
+)
+STAGE_ERRORS = REGISTRY.counter("whatsapp_bot_stage_errors_total", "Stage runs that raised an error")
+LLM_TOKENS = REGISTRY.counter("whatsapp_bot_llm_tokens_total", "Tokens reported by the LLM backends")
+FALLBACKS = REGISTRY.counter("whatsapp_bot_fallbacks_total", "Times generation fell back to the next backend")
+MESSAGES_SENT = REGISTRY.counter("whatsapp_bot_messages_sent_total", "Messages handed to a transport")
+
+
+class stage:
+    """
+    Time a stage, as a context manager or as a decorator (sync or async).
+    Records the duration in STAGE_SECONDS and counts raised errors in STAGE_ERRORS.
+
+        with stage("send", transport="mock"):
+            ...
+
+        @stage("generate", backend="lm_studio")
+        def ...
+    """
+
+    __slots__ = ("name", "extra_labels", "labels", "_start")
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.extra_labels = labels
+        self.labels = dict(labels, stage=name)
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self._start, **self.labels)
+        if exc_type is not None and not issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            STAGE_ERRORS.inc(error=exc_type.__name__, **self.labels)
+        return False
+
+    def __call__(self, func):
+        name, labels = self.name, self.extra_labels
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def record_usage(backend: str, usage) -> None:
+    """Count the prompt and completion tokens from a response's `usage`, if the backend sent it."""
+    if usage is None:
+        return
+    for kind in ("prompt", "completion"):
+        tokens = getattr(usage, f"{kind}_tokens", None)
+        if tokens:
+            LLM_TOKENS.inc(tokens, backend=backend, kind=kind)
+
+
+class MetricsExporter:
+    """
+    Background thread exporting the registry every `interval` seconds.
+
+    Args:
+        path: Output file
+        fmt: "prometheus" or "jsonl" (see Registry.write)
+        interval: Seconds between exports
+        registry: Metrics to export
+    """
+
+    def __init__(
+        self,
+        path: str = METRICS_FILE,
+        fmt: str = METRICS_FORMAT,
+        interval: float = METRICS_EXPORT_INTERVAL,
+        registry: Registry = REGISTRY
+    ):
+        if fmt not in ("prometheus", "jsonl"):
+            raise ValueError(f"Unknown metrics format {fmt!r}. Use prometheus or jsonl.")
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self) -> None:
+        try:
+            self.registry.write(self.path, self.fmt)
+        except OSError as e:
+            log.warning("could not export metrics", extra={"path": self.path, "error": str(e)})
+
+    def start(self) -> "MetricsExporter":
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop exporting, writing the final values once more."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.export()
+
+
+def start_metrics_exporter() -> Optional[MetricsExporter]:
+    """Start exporting to METRICS_FILE, or return None if it isn't set."""
+    if not METRICS_FILE:
+        return None
+    log.info("exporting metrics", extra={"path": METRICS_FILE, "format": METRICS_FORMAT})
+    return MetricsExporter().start()
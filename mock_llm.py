@@ -0,0 +1,245 @@
+"""
+Mock OpenAI-compatible LLM server for the WhatsApp Bot
+Serves /v1/models and /v1/chat/completions (plain and streamed) in-process, with
+configurable latency and errors, so generation can be benchmarked and run offline
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Tuple
+
+MOCK_MODEL = "mock-model"
+
+_GREETINGS = ["Hey", "Hi", "Hello", "Morning", "Psst", "Oh", "Yo", "Aww", "Howdy", "Ahoy"]
+_ADJECTIVES = ["sweet", "lovely", "silly", "gorgeous", "sleepy", "brilliant", "tiny", "cozy", "sunny", "wonderful"]
+_PET_NAMES = ["sunshine", "cupcake", "honeybee", "darling", "pumpkin", "starlight", "sweetpea", "angel", "muffin", "treasure"]
+_MIDDLES = ["you make every day brighter", "I can't stop smiling thinking about you",
+            "my heart does a little dance when you text", "you are my favorite notification",
+            "I would share my last slice of pizza with you", "you are cuter than a basket of puppies",
+            "every silly song reminds me of you", "my coffee tastes better when I think of you",
+            "I saved you the best seat on the couch", "you are the plot twist I always wanted"]
+_CLOSERS = ["Miss you already!", "Can't wait to see you!", "Sending hugs!", "Talk soon!",
+            "You're the best!", "Love you lots!", "Stay awesome!", "Smile today!",
+            "Think of me!", "Hugs and kisses!"]
+_EMOJIS = ["💕", "😊", "🥰", "✨", "😘", "💖", "🌟", "🤗", "😂", "❤️"]
+
+_BATCH_REQUEST = re.compile(r"JSON array of (\d+)")
+_PROMPT_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def mock_message(rng: random.Random) -> str:
+    """A plausible, randomly assembled message."""
+    # 1000 different openings, so the streaming repeated-opener check rarely fires
+    return (f"{rng.choice(_GREETINGS)} {rng.choice(_ADJECTIVES)} {rng.choice(_PET_NAMES)}! "
+            f"{rng.choice(_MIDDLES).capitalize()}. {rng.choice(_CLOSERS)} {rng.choice(_EMOJIS)}{rng.choice(_EMOJIS)}")
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)  # Rough, like most English text
+
+
+class MockLLMServer:
+    """
+    In-process OpenAI-compatible server.
+
+    Args:
+        latency: Seconds before every response starts
+        jitter: Up to this many extra seconds are added at random
+        error_rate: Share of chat requests answered with a 500 error
+        token_delay: Seconds between streamed chunks
+        prefill_delay: Seconds per prompt token that isn't in the prompt cache
+        cache_slots: Recent prompts kept in the prompt cache; like llama.cpp (LM Studio), a new
+            prompt only skips the tokens it shares as a prefix with one of them
+        seed: Random seed, for repeatable runs
+        port: Port to listen on (0 picks a free one)
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        token_delay: float = 0.0,
+        prefill_delay: float = 0.0,
+        cache_slots: int = 1,
+        seed: Optional[int] = None,
+        port: int = 0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+        self._cache: Deque[List[str]] = deque(maxlen=max(1, cache_slots))
+        self.requests: Dict[str, int] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """Base URL to use as LM_STUDIO_BASE_URL or OPENAI_BASE_URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def _prefill(self, messages: List[dict]) -> Tuple[int, int]:
+        """Look the prompt up in the prompt cache and store it. Returns (prompt tokens, cached tokens)."""
+        tokens = []
+        for message in messages:
+            tokens.append(f"<{message.get('role', '')}>")
+            tokens.extend(_PROMPT_TOKEN.findall(message.get("content") or ""))
+        with self._lock:
+            cached = 0
+            for previous in self._cache:
+                shared = 0
+                for a, b in zip(previous, tokens):
+                    if a != b:
+                        break
+                    shared += 1
+                cached = max(cached, shared)
+            self._cache.append(tokens)
+        return len(tokens), cached
+
+    def _delay(self, uncached_tokens: int = 0) -> None:
+        with self._lock:
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        delay += uncached_tokens * self.prefill_delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def _content(self, messages: List[dict]) -> str:
+        prompt = messages[-1].get("content", "") if messages else ""
+        batch = _BATCH_REQUEST.search(prompt)
+        with self._lock:
+            if batch:
+                return json.dumps([mock_message(self._rng) for _ in range(int(batch.group(1)))], ensure_ascii=False)
+            return mock_message(self._rng)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like a real server
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._count(self.path)
+                if self.path.rstrip("/").endswith("/models"):
+                    self._reply(200, {"object": "list", "data": [{"id": MOCK_MODEL, "object": "model", "owned_by": "mock"}]})
+                else:
+                    self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                server._count(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                messages = request.get("messages", [])
+                prompt_tokens, cached_tokens = server._prefill(messages)
+                server._delay(prompt_tokens - cached_tokens)
+                if server._fails():
+                    self._reply(500, {"error": {"message": "mock failure", "type": "server_error"}})
+                    return
+
+                model = request.get("model") or MOCK_MODEL
+                content = server._content(messages)
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": _tokens(content),
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                }
+                usage["total_tokens"] = prompt_tokens + usage["completion_tokens"]
+                if request.get("stream"):
+                    include_usage = (request.get("stream_options") or {}).get("include_usage", False)
+                    self._stream(model, content, usage if include_usage else None)
+                    return
+                self._reply(200, {
+                    "id": f"chatcmpl-mock{time.monotonic_ns()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+
+            def _stream(self, model: str, content: str, usage: Optional[dict]):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                base = {"id": f"chatcmpl-mock{time.monotonic_ns()}", "object": "chat.completion.chunk",
+                        "created": int(time.time()), "model": model}
+                try:
+                    # Roughly one token (word) per chunk
+                    for piece in re.findall(r"\S+\s*", content):
+                        self._event(dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+                        if server.token_delay:
+                            time.sleep(server.token_delay)
+                    self._event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+                    if usage is not None:
+                        self._event(dict(base, choices=[], usage=usage))
+                    self._chunk(b"data: [DONE]\n\n")
+                    self._chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True  # The client stopped reading early
+
+            def _event(self, payload: dict):
+                self._chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+            def _chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _reply(self, status: int, payload: dict):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep benchmark output quiet
+
+        return Handler
+
+
+if __name__ == "__main__":
+    # Run the mock on a fixed port, e.g. to point a real bot at it:
+    # LM_STUDIO_BASE_URL=http://127.0.0.1:1234/v1 python whatsapp_bot.py
+    mock = MockLLMServer(latency=0.2, jitter=0.3, token_delay=0.02, prefill_delay=0.002, port=1234).start()
+    print(f"Mock LLM server listening at {mock.url} - Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
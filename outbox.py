@@ -0,0 +1,287 @@
+"""
+Durable outbox for the WhatsApp Bot
+Journals every message in SQLite as it moves from generated to sent, so a crash
+loses no generated messages and never causes a message to be sent twice
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from metrics import stage
+
+log = logging.getLogger(__name__)
+
+# Configuration
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "outbox.db")
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.5"))  # Seconds journal writes may wait to be batched
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))  # Queued writes that trigger an immediate flush
+
+# Message states, in the order a message moves through them
+GENERATED = "generated"  # Ready in the buffer
+SCHEDULED = "scheduled"  # Picked for a send that is due
+SENDING = "sending"  # Handed to the transport - never sent again automatically
+SENT = "sent"
+FAILED = "failed"  # The transport raised - it may have gone out anyway, so it is never sent again
+DROPPED = "dropped"  # Thrown away unsent (stale, over capacity or a near-duplicate)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    message TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    transport_id TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_recipient_state ON outbox (recipient, state);
+"""
+
+
+@dataclass
+class OutboxEntry:
+    """
+    One journaled message.
+
+    Args:
+        key: Idempotency key; a key is handed to the transport at most once
+        recipient: Phone number the message is for
+        message: Message text
+        state: Current state (generated, scheduled, sending, sent, failed or dropped)
+        created: Unix time the message was journaled
+    """
+    key: str
+    recipient: str
+    message: str
+    state: str
+    created: float
+
+
+class Outbox:
+    """
+    SQLite journal of outgoing messages.
+
+    Bookkeeping writes (generated, scheduled, sent, failed) are queued and committed
+    together every OUTBOX_FLUSH_INTERVAL seconds or OUTBOX_BATCH_SIZE writes. Only the
+    move to "sending" is committed right away, since it is what prevents double sends.
+
+    Args:
+        path: SQLite database file (":memory:" for a throwaway outbox)
+        flush_interval: Seconds queued writes may wait before being committed
+        batch_size: Queued writes that trigger an immediate commit
+    """
+
+    def __init__(
+        self,
+        path: str = OUTBOX_FILE,
+        flush_interval: float = OUTBOX_FLUSH_INTERVAL,
+        batch_size: int = OUTBOX_BATCH_SIZE
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")  # Committed means on disk
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, tuple]] = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="outbox-writer", daemon=True)
+        self._thread.start()
+
+    def record_generated(self, recipient: str, messages: List[str]) -> List[str]:
+        """
+        Journal freshly generated messages.
+
+        Returns:
+            The idempotency keys assigned to the messages
+        """
+        now = time.time()
+        keys = [uuid.uuid4().hex for _ in messages]
+        self._queue([
+            (
+                "INSERT INTO outbox (key, recipient, message, state, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, recipient, message, GENERATED, now, now)
+            )
+            for key, message in zip(keys, messages)
+        ])
+        return keys
+
+    def schedule(self, recipient: str, message: str) -> OutboxEntry:
+        """
+        Pick a message for a due send. Reuses its journal entry if it was generated
+        into the buffer, otherwise journals it now (e.g. a template fallback).
+        """
+        now = time.time()
+        with self._lock:
+            self._flush_locked()
+            row = self._db.execute(
+                "SELECT key, created FROM outbox WHERE recipient = ? AND message = ? AND state = ? "
+                "ORDER BY created LIMIT 1",
+                (recipient, message, GENERATED)
+            ).fetchone()
+            if row is None:
+                key, created = uuid.uuid4().hex, now
+                self._pending.append((
+                    "INSERT INTO outbox (key, recipient, message, state, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, recipient, message, SCHEDULED, now, now)
+                ))
+            else:
+                key, created = row
+                self._pending.append((
+                    "UPDATE outbox SET state = ?, updated = ? WHERE key = ?", (SCHEDULED, now, key)
+                ))
+        return OutboxEntry(key, recipient, message, SCHEDULED, created)
+
+    def begin_send(self, key: str) -> bool:
+        """
+        Claim a message for sending. Committed immediately, before the transport is called.
+        Only messages that never reached the transport can be claimed: a failed send may have
+        been delivered before the error (e.g. a timeout after the request went out).
+
+        Returns:
+            True if the caller should send it, False if it was already handed to the transport
+        """
+        with self._lock:
+            self._flush_locked()
+            cursor = self._db.execute(
+                "UPDATE outbox SET state = ?, updated = ?, attempts = attempts + 1 "
+                "WHERE key = ? AND state IN (?, ?)",
+                (SENDING, time.time(), key, GENERATED, SCHEDULED)
+            )
+            return cursor.rowcount == 1
+
+    def mark_sent(self, key: str, transport_id: Optional[str] = None) -> None:
+        self._queue([(
+            "UPDATE outbox SET state = ?, updated = ?, transport_id = ?, error = NULL WHERE key = ?",
+            (SENT, time.time(), transport_id, key)
+        )])
+
+    def mark_failed(self, key: str, error: str) -> None:
+        self._queue([(
+            "UPDATE outbox SET state = ?, updated = ?, error = ? WHERE key = ?",
+            (FAILED, time.time(), error, key)
+        )])
+
+    def mark_dropped(self, recipient: str, messages: List[str], reason: str) -> None:
+        """Record that generated messages were thrown away unsent, so a restart doesn't replay them."""
+        now = time.time()
+        self._queue([
+            (
+                "UPDATE outbox SET state = ?, updated = ?, error = ? WHERE key = ("
+                "SELECT key FROM outbox WHERE recipient = ? AND message = ? AND state = ? ORDER BY created LIMIT 1)",
+                (DROPPED, now, reason, recipient, message, GENERATED)
+            )
+            for message in messages
+        ])
+
+    def last_sent(self, recipient: str) -> Optional[float]:
+        """Unix time of the last message sent (or handed to the transport) for a recipient."""
+        with self._lock:
+            self._flush_locked()
+            row = self._db.execute(
+                "SELECT MAX(updated) FROM outbox WHERE recipient = ? AND state IN (?, ?)",
+                (recipient, SENDING, SENT)
+            ).fetchone()
+        return row[0] if row else None
+
+    def recover(self, max_age: float) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        Replay unfinished work after a restart.
+
+        Messages that were generated or scheduled but never sent are returned so they can
+        go back into the buffer; ones older than max_age are marked dropped instead.
+        Messages left in "sending" may or may not have been delivered, so they are reported
+        and left alone rather than sent again.
+
+        Returns:
+            Recipient -> (message, Unix time it was generated) to buffer again, oldest first
+        """
+        now = time.time()
+        with self._lock:
+            self._flush_locked()
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "UPDATE outbox SET state = ?, updated = ?, error = 'expired before sending' "
+                "WHERE state IN (?, ?) AND created < ?",
+                (DROPPED, now, GENERATED, SCHEDULED, now - max_age)
+            )
+            self._db.execute(
+                "UPDATE outbox SET state = ?, updated = ? WHERE state = ?", (GENERATED, now, SCHEDULED)
+            )
+            rows = self._db.execute(
+                "SELECT recipient, message, created FROM outbox WHERE state = ? ORDER BY created", (GENERATED,)
+            ).fetchall()
+            interrupted = self._db.execute("SELECT COUNT(*) FROM outbox WHERE state = ?", (SENDING,)).fetchone()[0]
+            self._db.execute("COMMIT")
+
+        if interrupted:
+            log.warning(
+                "⚠️  Messages were interrupted while sending and may not have arrived - not resending",
+                extra={"count": interrupted}
+            )
+        recovered: Dict[str, List[Tuple[str, float]]] = {}
+        for recipient, message, created in rows:
+            recovered.setdefault(recipient, []).append((message, created))
+        if rows:
+            log.info("📒 Recovered unsent messages from the outbox", extra={"count": len(rows)})
+        return recovered
+
+    def counts(self) -> Dict[str, int]:
+        """Number of journaled messages in each state."""
+        with self._lock:
+            self._flush_locked()
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+
+    def flush(self) -> None:
+        """Commit every queued write now."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        """Flush queued writes and close the database."""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        with self._lock:
+            self._flush_locked()
+            self._db.close()
+
+    def _queue(self, writes: List[Tuple[str, tuple]]) -> None:
+        with self._lock:
+            self._pending.extend(writes)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _flush_locked(self) -> None:
+        if not self._pending:
+            return
+        writes, self._pending = self._pending, []
+        # One transaction (and one fsync) for the whole batch
+        with stage("outbox_flush"):
+            self._db.execute("BEGIN")
+            try:
+                for sql, params in writes:
+                    self._db.execute(sql, params)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log.error("⚠️  Could not write the outbox journal", extra={"error": str(e)})
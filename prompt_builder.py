@@ -0,0 +1,141 @@
+"""
+Prompt builder for the WhatsApp Bot
+Every LLM request starts with the same static system prompt and ends with the parts
+that change (recipient, style, length, count, remembered details), so LM Studio can reuse its prompt
+cache for the shared prefix instead of re-reading the whole prompt every time
+"""
+import os
+import re
+from typing import Dict, List, Optional, Sequence
+
+# Configuration
+PROMPT_COMPACT = os.getenv("PROMPT_COMPACT", "false").lower() == "true"  # Shorter instructions, for small or CPU-only models
+
+# Static instructions - never put per-request values in here, or the shared prefix ends at them
+SYSTEM_PROMPT = """You are a creative and romantic message writer who creates heartfelt, funny, and cute WhatsApp messages. You excel at mixing romance with humor and creating messages that feel genuine and personal.
+
+Every message you write should be:
+- Romantic and heartfelt, expressing deep love and affection
+- Funny and playful, with cute humor that makes them smile
+- Loving and warm, showing how much they mean to you
+- Cute and endearing, with sweet details or inside jokes if possible
+- Multiple sentences (2-4 sentences), not just one generic line
+- Personal and specific, not generic or cliché, never the same message twice
+- Free of stories, quotes and idioms
+- Natural and conversational, like you're really talking to them
+- Written in the style you are given
+- Decorated with 2-4 emojis that match the tone
+- Shorter than the character limit you are given
+
+Make it feel genuine, like you're really thinking about them right now. Mix romance with humor and cuteness.
+When you are told things about them, work in one that fits naturally, never all of them. Never reuse the wording of an earlier message.
+
+When asked for one message, reply with only the message text, nothing else.
+When asked for several, make each clearly different from the others, with a different opening, and reply with only a JSON array of strings, nothing else."""
+
+COMPACT_SYSTEM_PROMPT = """You write short WhatsApp messages to a loved one: romantic, funny and cute, 2-4 sentences, personal, in the given style, with 2-4 emojis, under the given character limit. No stories, quotes or idioms, and never repeat a message.
+Work in at most one of the things you are told about them, and never reuse the wording of an earlier message.
+For one message reply with only its text. For several, make each open differently and reply with only a JSON array of strings."""
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate how many tokens a text is, without a tokenizer.
+    Words and punctuation marks count one each, long words a little more, and
+    non-ASCII characters such as emojis usually take several tokens.
+    """
+    tokens = 0
+    for piece in _TOKEN.findall(text):
+        if piece.isascii():
+            tokens += 1 + len(piece) // 8
+        else:
+            tokens += 2 * len(piece)
+    return tokens
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """Estimated prompt tokens of a chat request, including a few per message for the chat format."""
+    return sum(count_tokens(message.get("content") or "") + 4 for message in messages)
+
+
+def system_prompt(compact: bool = PROMPT_COMPACT) -> str:
+    return COMPACT_SYSTEM_PROMPT if compact else SYSTEM_PROMPT
+
+
+def request_text(
+    recipient_name: str,
+    relationship: str,
+    style: str,
+    max_length: int,
+    count: Optional[int] = None,
+    facts: Sequence[str] = (),
+    earlier: Sequence[str] = ()
+) -> str:
+    """
+    The per-request part of the prompt, sent after the static system prompt.
+
+    Args:
+        count: Number of messages to ask for as a JSON array, or None for a single message
+        facts: Things to know about the recipient
+        earlier: Similar messages sent to them before
+    """
+    lines = [
+        f"Recipient: my {relationship} named {recipient_name}",
+        f"Style: {style}",
+        f"Character limit: {max_length} per message",
+    ]
+    if facts:
+        lines.append("Things you know about them:")
+        lines.extend(f"- {fact}" for fact in facts)
+    if earlier:
+        lines.append("Earlier messages to them:")
+        lines.extend(f"- {message}" for message in earlier)
+    if count is None:
+        lines.append("Write one message now:")
+    else:
+        lines.append(f"Write {count} different messages now, as a JSON array of {count} strings:")
+    return "\n".join(lines)
+
+
+def build_messages(
+    recipient_name: str = "darling",
+    relationship: str = "romantic partner",
+    style: str = "sweet and loving",
+    max_length: int = 200,
+    count: Optional[int] = None,
+    compact: bool = PROMPT_COMPACT,
+    facts: Sequence[str] = (),
+    earlier: Sequence[str] = ()
+) -> List[Dict[str, str]]:
+    """
+    Chat messages for a generation request: the static system prompt, then the variable parts.
+
+    Args:
+        recipient_name: Name of the recipient
+        relationship: Relationship with recipient
+        style: Style of the message
+        max_length: Maximum length of each message
+        count: Number of messages to ask for as a JSON array, or None for a single message
+        compact: Use the shorter system prompt
+        facts: Things to know about the recipient (see recipient_memory.py)
+        earlier: Similar messages sent to them before, so their wording isn't reused
+
+    Returns:
+        Messages for a chat completion request
+    """
+    return [
+        {"role": "system", "content": system_prompt(compact)},
+        {"role": "user", "content": request_text(recipient_name, relationship, style, max_length, count, facts, earlier)},
+    ]
+
+
+if __name__ == "__main__":
+    for compact in (False, True):
+        messages = build_messages(compact=compact)
+        shared = count_tokens(messages[0]["content"])
+        total = count_message_tokens(messages)
+        print(f"{'Compact' if compact else 'Full'} prompt: ~{total} tokens, ~{shared} of them in the shared prefix")
+    print()
+    print(build_messages(count=5)[1]["content"])
@@ -0,0 +1,394 @@
+"""
+Rate limiting and adaptive concurrency for the LLM backends
+Token buckets keep each backend under its requests- and tokens-per-minute limits, and an
+AIMD concurrency limit finds how many requests it serves at once before latency climbs.
+Callers over the limits wait their turn instead of failing
+"""
+import asyncio
+import collections
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Deque, Optional
+
+from circuit_breaker import CircuitOpenError
+from metrics import REGISTRY, STAGE_SECONDS
+from prompt_builder import count_message_tokens, count_tokens
+from stream_guard import ContentViolation
+
+log = logging.getLogger(__name__)
+
+# Configuration
+# Requests and tokens per minute (0 = unlimited). LM Studio has no quota, OpenAI's depends on your tier
+LM_STUDIO_RPM = float(os.getenv("LM_STUDIO_RPM", "0"))
+LM_STUDIO_TPM = float(os.getenv("LM_STUDIO_TPM", "0"))
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "60000"))
+# Concurrent requests: a local server slows down for everyone once it starts queueing internally
+LM_STUDIO_MAX_CONCURRENCY = int(os.getenv("LM_STUDIO_MAX_CONCURRENCY", "4"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+# Recent seconds per generated token over this many times the usual (baseline) value counts as overload
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", "2.0"))
+ADAPTIVE_BACKOFF = 0.5  # Concurrency limit is multiplied by this on overload
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "120"))  # Longest wait for a slot before giving up
+BASELINE_WINDOW = 100  # Completed requests the baseline (10th percentile) time per token is taken from
+RECENT_WINDOW = 5  # Latest requests whose median time per token is compared with the baseline
+
+CONCURRENCY_LIMIT = REGISTRY.gauge("whatsapp_bot_llm_concurrency_limit", "Current adaptive concurrency limit per backend")
+THROTTLES = REGISTRY.counter("whatsapp_bot_llm_throttles_total", "Times a backend signalled overload, by reason")
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited LLM_QUEUE_TIMEOUT seconds without getting a slot."""
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """Rough token count of a chat request: its messages plus the completion it may produce."""
+    return count_message_tokens(messages) + max_tokens
+
+
+def overload_reason(error: BaseException) -> Optional[str]:
+    """
+    Why an error means the backend is overloaded ("rate_limited", "server_error" or "timeout"),
+    or None for errors that say nothing about load (bad request, model not loaded, ...).
+    """
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if isinstance(status, int) and status >= 500:
+        return "server_error"
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or "timeout" in type(error).__name__.lower():
+        return "timeout"
+    return None
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the backend asked us to wait (Retry-After header), if it said."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Allows `per_minute` units per minute, with bursts of up to a minute's worth.
+    Callers take what they need up front and wait off any shortfall, so the bucket
+    may go negative - later callers then wait longer, in arrival order.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.rate > 0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= amount
+                wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def refund(self, amount: float) -> None:
+        """Give back what was reserved but not used (e.g. a shorter completion than max_tokens)."""
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def pause(self, seconds: float) -> None:
+        """Hand out nothing for `seconds` (the backend told us to back off)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class _Waiter:
+    """A queued caller: a thread waiting on an event, or a task waiting on a future."""
+
+    __slots__ = ("event", "loop", "future")
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+
+class BackendLimiter:
+    """
+    Request and token buckets plus an AIMD concurrency limit for one backend.
+
+    Each finished request adjusts the limit: a fast success adds about one slot per
+    `limit` requests (additive increase), while a 429, 5xx, timeout or slow replies halve it
+    (multiplicative decrease, at most once per typical latency so one slow burst counts once).
+    Replies are slow when the median time per generated token of the last RECENT_WINDOW requests
+    is over ADAPTIVE_LATENCY_TOLERANCE x the 10th percentile of the last BASELINE_WINDOW, so a
+    long completion on its own doesn't look like overload.
+
+    Args:
+        name: Backend label for logs and metrics
+        requests_per_minute: Request budget (0 = unlimited)
+        tokens_per_minute: Token budget (0 = unlimited)
+        max_concurrency: Upper bound of the concurrency limit
+        initial_concurrency: Limit to start from (defaults to half the maximum)
+        latency_tolerance: Time per token over the baseline, as a factor, that counts as overload
+        queue_timeout: Seconds a caller may wait for a slot before QueueTimeout is raised
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_concurrency: int = 8,
+        initial_concurrency: Optional[int] = None,
+        latency_tolerance: float = ADAPTIVE_LATENCY_TOLERANCE,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT
+    ):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(initial_concurrency or max(1, self.max_concurrency // 2))
+        self.latency_tolerance = latency_tolerance
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._latencies: Deque[float] = collections.deque(maxlen=BASELINE_WINDOW)  # Whole requests, seconds
+        self._per_token: Deque[float] = collections.deque(maxlen=BASELINE_WINDOW)  # Seconds per generated token
+        self._last_decrease = 0.0
+        self._waiters: Deque[_Waiter] = collections.deque()
+        self._lock = threading.Lock()
+        CONCURRENCY_LIMIT.set(self.limit, backend=name)
+
+    # Admission
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Wait for budget and a concurrency slot (blocking). Pair with release()."""
+        start = time.perf_counter()
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+        with self._lock:
+            if self._admit_locked():
+                return self._waited(start)
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        if not waiter.event.wait(self.queue_timeout):
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise QueueTimeout(f"No {self.name} slot after {self.queue_timeout:g}s")
+        self._waited(start)  # Granted (possibly just as the wait timed out)
+
+    async def acquire_async(self, tokens: int = 0) -> None:
+        """Async version of acquire()."""
+        start = time.perf_counter()
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        with self._lock:
+            if self._admit_locked():
+                return self._waited(start)
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except BaseException as e:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.future.done() and not waiter.future.cancelled():
+                    self._release_slot_locked()  # Granted, but the caller is gone
+                else:
+                    waiter.future.cancel()  # A grant is on its way - it hands the slot back
+            if isinstance(e, asyncio.TimeoutError):
+                raise QueueTimeout(f"No {self.name} slot after {self.queue_timeout:g}s") from None
+            raise
+        self._waited(start)
+
+    def release(
+        self,
+        latency: Optional[float] = None,
+        error: Optional[BaseException] = None,
+        tokens: int = 0
+    ) -> None:
+        """
+        Give back a slot and adapt the limit to how the request went.
+
+        Args:
+            latency: Seconds the request took, if it completed
+            error: What the request raised, if it failed
+            tokens: Completion tokens the request produced; latency is judged per token
+        """
+        reason = overload_reason(error) if error is not None else None
+        with self._lock:
+            if reason is None and latency is not None and error is None:
+                self._latencies.append(latency)
+                self._per_token.append(latency / max(1, tokens))
+                if self._slow_locked():
+                    reason = "latency"
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            if reason is not None:
+                self._decrease_locked(reason)
+            CONCURRENCY_LIMIT.set(round(self.limit, 2), backend=self.name)
+            self._release_slot_locked()
+        if reason is not None:
+            THROTTLES.inc(backend=self.name, reason=reason)
+            pause = retry_after(error) if error is not None else None
+            if reason == "rate_limited":
+                self.requests.pause(pause or 1.0)
+                self.tokens.pause(pause or 1.0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": len(self._waiters),
+                "baseline_latency": self._baseline_locked() or None,
+            }
+
+    # Internals (called with self._lock held)
+
+    def _admit_locked(self) -> bool:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return True
+        return False
+
+    def _decrease_locked(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self._baseline_locked():
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(1.0, self.limit * ADAPTIVE_BACKOFF)
+        if int(previous) != int(self.limit):
+            log.info(
+                "🐢 Backend overloaded, lowering concurrency",
+                extra={"backend": self.name, "reason": reason, "limit": int(self.limit)}
+            )
+
+    def _slow_locked(self) -> bool:
+        # A baseline needs a few more requests than the recent window
+        if len(self._per_token) < 2 * RECENT_WINDOW:
+            return False
+        recent = sorted(itertools.islice(reversed(self._per_token), RECENT_WINDOW))
+        baseline = sorted(self._per_token)[len(self._per_token) // 10]
+        return recent[RECENT_WINDOW // 2] > baseline * self.latency_tolerance
+
+    def _baseline_locked(self) -> float:
+        """Median latency of the recent requests (0 before the first one)."""
+        if not self._latencies:
+            return 0.0
+        return sorted(self._latencies)[len(self._latencies) // 2]
+
+    def _release_slot_locked(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            self.in_flight += 1
+            if waiter.loop is None:
+                waiter.event.set()
+            else:
+                waiter.loop.call_soon_threadsafe(self._grant, waiter)
+
+    def _grant(self, waiter: _Waiter) -> None:
+        # Runs on the waiter's event loop
+        if waiter.future.cancelled():
+            with self._lock:
+                self._release_slot_locked()
+        else:
+            waiter.future.set_result(None)
+
+    def _waited(self, start: float) -> None:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="llm_queue", backend=self.name)
+
+
+def limited_by(limiter: BackendLimiter):
+    """
+    Decorator admitting every call of an LLM completion function (sync or async) through a limiter.
+    The function must take the chat messages first and may take max_tokens; unused tokens are
+    refunded from the estimate once the completion's length is known. A ContentViolation
+    says nothing about load, so it leaves the concurrency limit as it was.
+
+    Apply it outside guarded_by, so waiting for a slot (or a QueueTimeout) never counts against
+    the backend's circuit and the half-open trial call isn't held up in the queue. A call the
+    breaker refuses gets its whole reservation back.
+    """
+    def request(args, kwargs):
+        messages = kwargs.get("messages", args[0] if args else [])
+        max_tokens = kwargs.get("max_tokens", args[1] if len(args) > 1 else 200)
+        return messages, max_tokens
+
+    def refund(estimate: int) -> None:
+        limiter.release()
+        limiter.requests.refund(1)
+        limiter.tokens.refund(estimate)
+
+    def settle(max_tokens: int, content) -> int:
+        used = count_tokens(content or "")
+        limiter.tokens.refund(max_tokens - used)
+        return used
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                messages, max_tokens = request(args, kwargs)
+                estimate = estimate_tokens(messages, max_tokens)
+                await limiter.acquire_async(estimate)
+                start = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except CircuitOpenError:
+                    refund(estimate)  # Never reached the backend
+                    raise
+                except (asyncio.CancelledError, ContentViolation):
+                    limiter.release()  # Lost a hedged race, or the model broke the rules - says nothing about load
+                    raise
+                except Exception as e:
+                    limiter.release(error=e)
+                    raise
+                latency = time.perf_counter() - start
+                limiter.release(latency, tokens=settle(max_tokens, result))
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            messages, max_tokens = request(args, kwargs)
+            estimate = estimate_tokens(messages, max_tokens)
+            limiter.acquire(estimate)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except CircuitOpenError:
+                refund(estimate)
+                raise
+            except ContentViolation:
+                limiter.release()
+                raise
+            except Exception as e:
+                limiter.release(error=e)
+                raise
+            except BaseException:
+                limiter.release()
+                raise
+            latency = time.perf_counter() - start
+            limiter.release(latency, tokens=settle(max_tokens, result))
+            return result
+        return wrapper
+    return decorator
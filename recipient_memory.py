@@ -0,0 +1,396 @@
+"""
+Personal memory for the WhatsApp Bot
+Keeps facts about each recipient and the messages sent to them as embeddings in one
+contiguous, memory-mapped array per recipient, and finds the ones relevant to a new
+message with a single vectorized similarity pass, so prompts can mention real details
+"""
+import importlib.util
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# numpy is optional (memory is off without it) and only imported once a memory is opened,
+# so it doesn't slow down startup (see _import_numpy)
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+np = None
+
+from metrics import stage
+
+log = logging.getLogger(__name__)
+
+# Configuration
+MEMORY_DIR = os.getenv("MEMORY_DIR", "memory")  # One sub-directory per recipient
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "true").lower() == "true"  # Needs numpy
+MEMORY_DIM = int(os.getenv("MEMORY_DIM", "256"))  # Embedding size; changing it needs a fresh MEMORY_DIR
+MEMORY_FACTS = int(os.getenv("MEMORY_FACTS", "3"))  # Facts added to each prompt
+MEMORY_MESSAGES = int(os.getenv("MEMORY_MESSAGES", "2"))  # Earlier messages added to each prompt
+# Snippets with a lower cosine similarity to the request are left out. At -1 the best ones are
+# always used, which suits a handful of hand-written facts; raise it for large, noisy memories
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "-1"))
+
+FACT = "fact"
+MESSAGE = "message"
+KINDS = (FACT, MESSAGE)
+
+_GROW_ROWS = 1024  # The vector file grows by at least this many rows (or doubles) at a time
+_WORD = re.compile(r"[\w']+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i i'm in is it it's me my of on or our so "
+    "that the their them they this to was we were with you you're your".split()
+)
+
+
+def _import_numpy() -> None:
+    global np
+    if np is None:
+        if not NUMPY_AVAILABLE:
+            raise ImportError("numpy is not installed. Run: pip install numpy")
+        with stage("import_numpy"):
+            import numpy as _np  # type: ignore
+        np = _np
+
+
+class Snippet(NamedTuple):
+    text: str
+    kind: str
+    score: float
+
+
+class HashingEmbedder:
+    """
+    Local embedding stand-in: hashes words, word pairs and word trigrams (characters)
+    into a fixed-size, L2-normalized vector, so similar wording gives similar vectors.
+    No model or network needed; any object with `dim` and `embed(texts)` can replace it.
+
+    Args:
+        dim: Vector size
+    """
+
+    def __init__(self, dim: int = MEMORY_DIM):
+        _import_numpy()
+        self.dim = dim
+
+    def _features(self, text: str) -> Iterable[Tuple[str, float]]:
+        words = [w for w in _WORD.findall(text.lower()) if w not in _STOPWORDS]
+        for word in words:
+            yield word, 1.0
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.25  # Catches plurals and other endings
+        for first, second in zip(words, words[1:]):
+            yield f"{first} {second}", 0.5
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        """Float32 matrix with one unit-length row per text (all zeros for texts without words)."""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))  # Stable across runs, unlike hash()
+                vectors[row, h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class RecipientMemory:
+    """
+    Memory of one recipient: entries.jsonl holds the snippets in order, and row i of
+    vectors.f32 (a raw float32 matrix, memory-mapped) holds the embedding of entry i.
+    Appends write into spare rows of the mapping; the file only grows now and then.
+
+    Args:
+        directory: Where the two files live (None keeps everything in memory only)
+        embedder: Turns texts into unit-length vectors
+    """
+
+    def __init__(self, directory: Optional[str], embedder):
+        _import_numpy()
+        self.directory = directory
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        self._texts: List[str] = []
+        self._known = set()
+        self._count = 0
+        self._vectors = np.zeros((0, embedder.dim), dtype=np.float32)
+        self._kind_codes = np.zeros(0, dtype=np.uint8)
+        if directory is not None and os.path.exists(self._entries_path):
+            self._load()  # Otherwise the files are only created by the first add
+
+    @property
+    def _entries_path(self) -> str:
+        return os.path.join(self.directory, "entries.jsonl")
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.f32")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _load(self) -> None:
+        with open(self._entries_path, "rb+") as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                # A line cut short by a crash; drop it, or the next entry would be glued onto it
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+        # Line i must belong to row i, so unlike a torn last line a broken entry is an error
+        entries = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+        texts = [entry["text"] for entry in entries]
+        kinds = [KINDS.index(entry.get("kind", FACT)) for entry in entries]
+
+        row_bytes = self.embedder.dim * 4
+        rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        self._map(max(rows, len(texts)))
+        self._texts = texts
+        self._known = {(kind, text) for kind, text in zip(kinds, texts)}
+        self._count = len(texts)
+        self._kind_codes = self._grown(self._kind_codes, len(self._vectors))
+        self._kind_codes[:self._count] = kinds
+
+        # Entries whose vector never reached the disk (a crash between the two writes) are re-embedded
+        missing = np.flatnonzero(~self._vectors[:self._count].any(axis=1))
+        if len(missing):
+            vectors = self.embedder.embed([texts[i] for i in missing])
+            self._vectors[missing] = vectors
+            repaired = int(vectors.any(axis=1).sum())  # Texts without words embed to zeros anyway
+            if repaired:
+                log.info("🧠 Re-embedded memory entries", extra={"path": self.directory, "count": repaired})
+
+    def _map(self, rows: int) -> None:
+        """(Re)map the vector file with room for `rows` rows, growing the file if needed."""
+        rows = max(rows, _GROW_ROWS)
+        with open(self._vectors_path, "ab") as f:
+            if f.tell() < rows * self.embedder.dim * 4:
+                f.truncate(rows * self.embedder.dim * 4)  # Sparse zeros, so unused rows cost no disk
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(rows, self.embedder.dim))
+
+    @staticmethod
+    def _grown(array: "np.ndarray", rows: int) -> "np.ndarray":
+        bigger = np.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+        bigger[:len(array)] = array
+        return bigger
+
+    def add(self, texts: Sequence[str], kind: str = FACT) -> int:
+        """
+        Append snippets; ones already stored with the same kind are skipped.
+
+        Returns:
+            Number of snippets added
+        """
+        code = KINDS.index(kind)
+        with self._lock:
+            new = []
+            for text in texts:
+                text = text.strip()
+                if text and (code, text) not in self._known:
+                    self._known.add((code, text))
+                    new.append(text)
+            if not new:
+                return 0
+
+            vectors = self.embedder.embed(new)
+            end = self._count + len(new)
+            if end > len(self._vectors):
+                capacity = max(end, 2 * len(self._vectors), _GROW_ROWS)
+                if self.directory is None:
+                    self._vectors = self._grown(self._vectors, capacity)
+                else:
+                    if isinstance(self._vectors, np.memmap):
+                        self._vectors.flush()
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._map(capacity)
+                self._kind_codes = self._grown(self._kind_codes, capacity)
+            # Vectors first: if a crash lands in between, the entries were never recorded at all
+            self._vectors[self._count:end] = vectors
+            self._kind_codes[self._count:end] = code
+            if self.directory is not None:
+                now = round(time.time(), 3)
+                with open(self._entries_path, "a", encoding="utf-8") as f:
+                    for text in new:
+                        f.write(json.dumps({"kind": kind, "text": text, "time": now}, ensure_ascii=False) + "\n")
+            self._texts.extend(new)
+            self._count = end
+            return len(new)
+
+    def search(self, query: str, limits: Dict[str, int], min_score: float = MEMORY_MIN_SCORE) -> List[Snippet]:
+        """
+        The snippets most similar to the query, best first.
+
+        Args:
+            query: Text to compare against
+            limits: How many snippets of each kind to return, e.g. {"fact": 3, "message": 2}
+            min_score: Minimum cosine similarity
+
+        Returns:
+            Up to sum(limits.values()) snippets
+        """
+        with self._lock:
+            # Rows below the count never change, so the search runs on a snapshot without the lock
+            count, vectors, kind_codes, texts = self._count, self._vectors, self._kind_codes, self._texts
+        if not count:
+            return []
+
+        query_vector = self.embedder.embed([query])[0]
+        scores = vectors[:count] @ query_vector  # One pass over every stored vector
+        found = []
+        for kind, limit in limits.items():
+            if limit <= 0:
+                continue
+            kind_scores = np.where(kind_codes[:count] == KINDS.index(kind), scores, -np.inf)  # Other kinds never win
+            k = min(limit, count)
+            top = np.argpartition(-kind_scores, k - 1)[:k]
+            found.extend(
+                Snippet(texts[i], kind, float(kind_scores[i]))
+                for i in top if kind_scores[i] >= min_score
+            )
+        found.sort(key=lambda snippet: snippet.score, reverse=True)
+        return found
+
+    def flush(self) -> None:
+        with self._lock:
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+
+
+class MemoryStore:
+    """
+    Memories of all recipients, opened on first use.
+
+    Args:
+        directory: Directory holding one memory per recipient (None keeps them in memory only)
+        embedder: Embedding model; defaults to the local HashingEmbedder
+    """
+
+    def __init__(self, directory: Optional[str] = MEMORY_DIR, embedder=None):
+        self.directory = directory
+        self.embedder = embedder or HashingEmbedder()
+        self._lock = threading.Lock()
+        self._memories: Dict[str, RecipientMemory] = {}
+
+    def memory(self, recipient: str) -> RecipientMemory:
+        with self._lock:
+            memory = self._memories.get(recipient)
+            if memory is None:
+                path = None
+                if self.directory is not None:
+                    # Phone numbers become directory names: "+1 234-567" -> "1234567"
+                    path = os.path.join(self.directory, re.sub(r"[^\w]", "", recipient) or "_")
+                memory = self._memories[recipient] = RecipientMemory(path, self.embedder)
+            return memory
+
+    def add(self, recipient: str, texts: Sequence[str], kind: str = FACT) -> int:
+        """Remember facts about a recipient, or messages sent to them. Returns how many were new."""
+        return self.memory(recipient).add(texts, kind)
+
+    def search(
+        self,
+        recipient: str,
+        query: str,
+        facts: int = MEMORY_FACTS,
+        messages: int = MEMORY_MESSAGES
+    ) -> List[Snippet]:
+        """The facts and earlier messages for a recipient most similar to the query."""
+        return self.memory(recipient).search(query, {FACT: facts, MESSAGE: messages})
+
+    def flush(self) -> None:
+        with self._lock:
+            memories = list(self._memories.values())
+        for memory in memories:
+            memory.flush()
+
+
+_store: Optional[MemoryStore] = None
+_store_lock = threading.Lock()
+
+
+def memory_available() -> bool:
+    """Whether memory is turned on and numpy is installed."""
+    return MEMORY_ENABLED and NUMPY_AVAILABLE
+
+
+def get_memory() -> Optional[MemoryStore]:
+    """The shared memory store, or None when memory is unavailable."""
+    global _store
+    if not memory_available():
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = MemoryStore()
+        return _store
+
+
+def set_memory(store: Optional[MemoryStore]) -> Optional[MemoryStore]:
+    """Replace the shared memory store (e.g. with an in-memory one for dry runs)."""
+    global _store
+    with _store_lock:
+        _store = store
+    return store
+
+
+def recall(recipient: Optional[str], query: str) -> Tuple[List[str], List[str]]:
+    """
+    Facts and earlier messages to put in a prompt for this recipient.
+
+    Args:
+        recipient: Phone number, or None when the recipient isn't known
+        query: What the message is going to be about
+
+    Returns:
+        (facts, earlier messages), both possibly empty
+    """
+    store = get_memory() if recipient else None
+    if store is None:
+        return [], []
+    try:
+        with stage("memory_recall"):
+            snippets = store.search(recipient, query)
+    except Exception as e:
+        log.warning("⚠️  Could not recall the recipient's memory", extra={"recipient": recipient, "error": str(e)})
+        return [], []
+    return ([s.text for s in snippets if s.kind == FACT],
+            [s.text for s in snippets if s.kind == MESSAGE])
+
+
+def time_of_day(hour: Optional[int] = None) -> str:
+    """
+    Words for the current part of the day, to recall what fits it: facts about breakfast
+    in the morning, about sleep at night. The recipient's name and relationship are the
+    same in every query, so only the time of day and the style steer what is recalled.
+    """
+    hour = time.localtime().tm_hour if hour is None else hour
+    if 5 <= hour < 12:
+        return "morning breakfast coffee wake up early start of the day"
+    if 12 <= hour < 17:
+        return "afternoon lunch work break busy day"
+    if 17 <= hour < 22:
+        return "evening dinner tonight relax after work"
+    return "night sleep bed dreams late tonight"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Add to or search a recipient's memory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Remember a fact about a recipient")
+    add.add_argument("number")
+    add.add_argument("fact")
+    search = commands.add_parser("search", help="Show what would be recalled for a query")
+    search.add_argument("number")
+    search.add_argument("query")
+    args = parser.parse_args()
+
+    store = MemoryStore()
+    if args.command == "add":
+        added = store.add(args.number, [args.fact])
+        print("🧠 Remembered" if added else "🧠 Already known")
+    else:
+        for snippet in store.search(args.number, args.query):
+            print(f"{snippet.score:.3f}  {snippet.kind:<8} {snippet.text}")
+    store.flush()
@@ -0,0 +1,158 @@
+"""
+Recipient table for the WhatsApp Bot
+Loads the contacts to message from a JSON or CSV file and generates
+messages for many of them concurrently
+"""
+import asyncio
+import csv
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from llm_clients import run
+from message_generator import generate_message_async
+
+# Configuration
+RECIPIENTS_FILE = os.getenv("RECIPIENTS_FILE", "recipients.json")
+# Maximum number of LLM generations running at the same time
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+
+
+@dataclass(frozen=True)
+class Recipient:
+    """
+    One contact the bot sends messages to.
+
+    Args:
+        number: Phone number including country code
+        name: Name used in the messages
+        relationship: Your relationship with them
+        style: Style of the messages
+        cadence_minutes: Minutes between messages
+        max_length: Maximum characters per message
+        jitter_minutes: Up to this many minutes are randomly added to each send time
+        quiet_hours: (start_hour, end_hour) in local time during which nothing is sent
+        facts: Things about them the messages can mention (kept in recipient_memory.py)
+    """
+    number: str
+    name: str = "darling"
+    relationship: str = "romantic partner"
+    style: str = "sweet and loving"
+    cadence_minutes: int = 30
+    max_length: int = 200
+    jitter_minutes: float = 0.0
+    quiet_hours: Optional[Tuple[int, int]] = None
+    facts: Tuple[str, ...] = ()
+
+    def generation_params(self, use_llm: bool = True) -> dict:
+        """Keyword arguments for generate_message and friends."""
+        return {
+            "use_llm": use_llm,
+            "recipient_name": self.name,
+            "relationship": self.relationship,
+            "style": self.style,
+            "max_length": self.max_length,
+            "recipient_id": self.number,
+        }
+
+
+def _parse_quiet_hours(value) -> Optional[Tuple[int, int]]:
+    """Accept quiet hours as "22-7" or [22, 7]."""
+    if value in (None, ""):
+        return None
+    parts = value.split("-") if isinstance(value, str) else value
+    if len(parts) != 2:
+        raise ValueError(f"quiet_hours must look like \"22-7\", got {value!r}")
+    start, end = int(parts[0]), int(parts[1])
+    if not (0 <= start < 24 and 0 <= end < 24):
+        raise ValueError(f"quiet_hours must be hours between 0 and 23, got {value!r}")
+    return start, end
+
+
+def _parse_facts(value) -> Tuple[str, ...]:
+    """Accept facts as a list, or as one string separated by ";" (for CSV files)."""
+    if value in (None, ""):
+        return ()
+    parts = value.split(";") if isinstance(value, str) else value
+    return tuple(str(part).strip() for part in parts if str(part).strip())
+
+
+def _recipient_from_row(row: dict) -> Recipient:
+    number = str(row.get("number") or "").strip()
+    if not number:
+        raise ValueError(f"Recipient entry is missing a number: {row}")
+
+    values = {"number": number}
+    for field in ("name", "relationship", "style"):
+        if row.get(field):
+            values[field] = str(row[field]).strip()
+    for field in ("cadence_minutes", "max_length"):
+        if row.get(field) not in (None, ""):
+            values[field] = int(row[field])
+    if row.get("jitter_minutes") not in (None, ""):
+        values["jitter_minutes"] = float(row["jitter_minutes"])
+    values["quiet_hours"] = _parse_quiet_hours(row.get("quiet_hours"))
+    values["facts"] = _parse_facts(row.get("facts"))
+    return Recipient(**values)
+
+
+def load_recipients(path: str = RECIPIENTS_FILE) -> List[Recipient]:
+    """
+    Load recipients from a JSON list of objects or a CSV file with a header row.
+    Columns: number, name, relationship, style, cadence_minutes, max_length,
+    jitter_minutes, quiet_hours, facts (only number is required).
+
+    Args:
+        path: File to load
+
+    Returns:
+        List of recipients, in file order
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+    if not isinstance(rows, list):
+        raise ValueError(f"{path} must contain a list of recipients")
+
+    recipients = [_recipient_from_row(row) for row in rows]
+    numbers = [r.number for r in recipients]
+    if len(set(numbers)) != len(numbers):
+        raise ValueError(f"{path} lists the same number more than once")
+    return recipients
+
+
+async def generate_for_recipients_async(
+    recipients: List[Recipient],
+    use_llm: bool = True,
+    concurrency: int = GENERATION_CONCURRENCY
+) -> Dict[str, str]:
+    """
+    Generate one message per recipient, running up to `concurrency` generations at once.
+
+    Returns:
+        Mapping of phone number to generated message
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def generate_one(recipient: Recipient) -> str:
+        async with semaphore:
+            return await generate_message_async(**recipient.generation_params(use_llm))
+
+    messages = await asyncio.gather(*(generate_one(r) for r in recipients))
+    return {r.number: message for r, message in zip(recipients, messages)}
+
+
+def generate_for_recipients(
+    recipients: List[Recipient],
+    use_llm: bool = True,
+    concurrency: Optional[int] = None
+) -> Dict[str, str]:
+    """Blocking wrapper around generate_for_recipients_async."""
+    return run(generate_for_recipients_async(
+        recipients,
+        use_llm=use_llm,
+        concurrency=GENERATION_CONCURRENCY if concurrency is None else concurrency
+    ))
@@ -0,0 +1,239 @@
+"""
+Event-driven scheduler for the WhatsApp Bot
+Keeps jobs in a heap ordered by due time and sleeps exactly until the next
+one is due, so thousands of jobs can be scheduled without polling
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Callable, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+JOB_LATENESS = REGISTRY.histogram("whatsapp_bot_job_lateness_seconds", "How late scheduled jobs fired")
+
+
+@dataclass(eq=False)
+class Job:
+    """
+    A scheduled call and its timing statistics.
+
+    Args:
+        func: Function or coroutine function to call
+        args: Positional arguments for func
+        interval: Seconds between runs, or None to run once
+        jitter: Up to this many seconds are randomly added to every run
+        quiet_hours: (start_hour, end_hour) in local time during which the job never fires
+        name: Label used in log output
+    """
+    func: Callable[..., Any]
+    args: Tuple[Any, ...] = ()
+    interval: Optional[float] = None
+    jitter: float = 0.0
+    quiet_hours: Optional[Tuple[int, int]] = None
+    name: str = ""
+    runs: int = 0
+    last_lateness: float = 0.0
+    max_lateness: float = 0.0
+    total_lateness: float = 0.0
+    cancelled: bool = False
+    next_run: float = field(default=0.0, repr=False)  # time.monotonic() when the job is due
+    planned: float = field(default=0.0, repr=False)  # next_run before jitter, used to avoid drift
+
+    @property
+    def average_lateness(self) -> float:
+        return self.total_lateness / self.runs if self.runs else 0.0
+
+
+def in_quiet_hours(moment: datetime, quiet_hours: Optional[Tuple[int, int]]) -> bool:
+    """Check whether a local time falls in a (start_hour, end_hour) window, which may wrap midnight."""
+    if quiet_hours is None:
+        return False
+    start, end = quiet_hours
+    if start == end:
+        return False
+    if start < end:
+        return start <= moment.hour < end
+    return moment.hour >= start or moment.hour < end
+
+
+def _quiet_hours_delay(delay: float, quiet_hours: Optional[Tuple[int, int]]) -> float:
+    """Push a delay (seconds from now) past the end of the quiet window if it lands inside it."""
+    moment = datetime.now() + timedelta(seconds=delay)
+    if not in_quiet_hours(moment, quiet_hours):
+        return delay
+    end = moment.replace(hour=quiet_hours[1], minute=0, second=0, microsecond=0)  # type: ignore
+    if end <= moment:
+        end += timedelta(days=1)
+    return delay + (end - moment).total_seconds()
+
+
+class Scheduler:
+    """
+    Heap-based asyncio scheduler.
+
+    Jobs run as their own tasks, so a slow job never delays the others.
+    Plain functions are run in the default thread pool; coroutine functions run on the loop.
+    Each run records how late it fired compared to its due time.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Job]] = []
+        self._counter = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._tasks: set = set()
+        self._running = False
+
+    def add_job(
+        self,
+        func: Callable[..., Any],
+        interval: Optional[float],
+        *args: Any,
+        start_in: Optional[float] = None,
+        jitter: float = 0.0,
+        quiet_hours: Optional[Tuple[int, int]] = None,
+        name: Optional[str] = None
+    ) -> Job:
+        """
+        Schedule a job.
+
+        Args:
+            func: Function or coroutine function to call
+            interval: Seconds between runs, or None to run once
+            *args: Positional arguments for func
+            start_in: Seconds until the first run (defaults to one interval)
+            jitter: Up to this many seconds are randomly added to every run
+            quiet_hours: (start_hour, end_hour) in local time during which the job never fires
+            name: Label used in log output
+
+        Returns:
+            The scheduled job
+        """
+        if interval is None and start_in is None:
+            raise ValueError("A one-off job needs start_in")
+        if interval is not None and interval <= 0:
+            raise ValueError("interval must be positive")
+
+        job = Job(
+            func=func,
+            args=args,
+            interval=interval,
+            jitter=jitter,
+            quiet_hours=quiet_hours,
+            name=name or getattr(func, "__name__", "job")
+        )
+        delay = interval if start_in is None else start_in
+        self._schedule(job, time.monotonic(), delay)  # type: ignore
+        return job
+
+    def cancel(self, job: Job) -> None:
+        """Stop a job from running again (it is dropped lazily from the heap)."""
+        job.cancelled = True
+
+    @property
+    def jobs(self) -> List[Job]:
+        """Scheduled jobs, soonest first."""
+        return [job for _, _, job in sorted(self._heap) if not job.cancelled]
+
+    def next_run_in(self) -> Optional[float]:
+        """Seconds until the next job is due, or None if nothing is scheduled."""
+        self._drop_cancelled()
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    async def run(self) -> None:
+        """Run jobs until stop() is called."""
+        self._wake = asyncio.Event()
+        self._running = True
+        try:
+            while self._running:
+                self._drop_cancelled()
+                if not self._heap:
+                    await self._sleep(None)
+                    continue
+
+                due, _, job = self._heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await self._sleep(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                self._fire(job, due)
+        finally:
+            self._running = False
+
+    def stop(self) -> None:
+        """Ask run() to return after the current iteration."""
+        self._running = False
+        if self._wake is not None:
+            self._wake.set()
+
+    async def wait_for_running_jobs(self) -> None:
+        """Wait until every job task that has already started finishes."""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def _push(self, job: Job, due: float) -> None:
+        job.next_run = due
+        heapq.heappush(self._heap, (due, next(self._counter), job))
+        if self._wake is not None:
+            self._wake.set()  # A new job may be due sooner than the one we're sleeping for
+
+    def _drop_cancelled(self) -> None:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+    def _schedule(self, job: Job, now: float, delay: float) -> None:
+        job.planned = now + _quiet_hours_delay(delay, job.quiet_hours)
+        due = job.planned
+        if job.jitter:
+            due = now + _quiet_hours_delay(due - now + random.uniform(0, job.jitter), job.quiet_hours)
+        self._push(job, due)
+
+    async def _sleep(self, delay: Optional[float]) -> None:
+        self._wake.clear()  # type: ignore
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)  # type: ignore
+        except asyncio.TimeoutError:
+            pass
+
+    def _fire(self, job: Job, due: float) -> None:
+        now = time.monotonic()
+        lateness = now - due
+        job.runs += 1
+        job.last_lateness = lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        job.total_lateness += lateness
+        log.info("⏰ Running job", extra={"job": job.name, "late_ms": round(lateness * 1000, 1)})
+        JOB_LATENESS.observe(lateness)
+
+        task = asyncio.ensure_future(self._call(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        if job.interval is not None:
+            # Schedule from the planned time rather than the actual one, so runs don't drift
+            next_planned = job.planned + job.interval
+            if next_planned <= now:
+                missed = int((now - next_planned) // job.interval) + 1
+                next_planned += missed * job.interval
+                log.warning("⚠️  Job skipped missed runs", extra={"job": job.name, "missed": missed})
+            self._schedule(job, now, next_planned - now)
+
+    async def _call(self, job: Job) -> None:
+        try:
+            if asyncio.iscoroutinefunction(job.func):
+                await job.func(*job.args)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, job.func, *job.args)
+        except Exception:
+            log.exception("❌ Job failed", extra={"job": job.name})
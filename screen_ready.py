@@ -0,0 +1,143 @@
+"""
+Screen readiness detection for the WhatsApp Web transport
+Polls screenshots of the chat window and acts as soon as the UI is ready,
+instead of sleeping for fixed times and clicking guessed coordinates
+"""
+import os
+import time
+from typing import Callable, Optional, Tuple, TypeVar
+
+# Configuration
+UI_READY_TIMEOUT = float(os.getenv("UI_READY_TIMEOUT", "60"))  # Seconds to wait for the chat to load
+UI_CONFIRM_TIMEOUT = float(os.getenv("UI_CONFIRM_TIMEOUT", "10"))  # Seconds to wait for the message to leave the input box
+UI_POLL_INTERVAL = float(os.getenv("UI_POLL_INTERVAL", "0.2"))  # Seconds between screenshots
+UI_STABLE_FOR = float(os.getenv("UI_STABLE_FOR", "1.0"))  # The chat counts as loaded once it stops changing this long
+UI_INPUT_HEIGHT = int(os.getenv("UI_INPUT_HEIGHT", "200"))  # Pixels at the bottom of the screen holding the input box
+# Optional screenshots of the input box and of the sent tick, matched on screen for exact detection
+UI_INPUT_TEMPLATE = os.getenv("UI_INPUT_TEMPLATE", "")
+UI_SENT_TEMPLATE = os.getenv("UI_SENT_TEMPLATE", "")
+
+CHANGED_PIXEL_LEVEL = 30  # Grey-level difference at which a pixel counts as changed
+CHANGED_FRACTION = 0.005  # Share of changed pixels that counts as a change (ignores the blinking caret)
+SENT_TICK_STRIP = 120  # Pixels above the input box where the newest message's tick appears
+
+Region = Tuple[int, int, int, int]  # left, top, width, height
+T = TypeVar("T")
+
+
+def wait_until(
+    check: Callable[[], Optional[T]],
+    timeout: float,
+    interval: float = UI_POLL_INTERVAL
+) -> Optional[T]:
+    """
+    Call check until it returns something truthy or the timeout passes.
+
+    Returns:
+        The first truthy result, or None on timeout
+    """
+    give_up_at = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() >= give_up_at:
+            return None
+        time.sleep(interval)
+
+
+def changed_fraction(before, after) -> float:
+    """Share of pixels that differ noticeably between two screenshots of the same region."""
+    from PIL import ImageChops
+
+    diff = ImageChops.difference(before.convert("L"), after.convert("L"))
+    changed = diff.point(lambda level: 255 if level > CHANGED_PIXEL_LEVEL else 0).histogram()[255]
+    return changed / (diff.width * diff.height)
+
+
+class ScreenWatcher:
+    """
+    Watches the bottom of the screen, where WhatsApp Web shows the message input box.
+
+    Args:
+        pyautogui: The pyautogui module (passed in so it is only imported by GUI transports)
+        input_template: Screenshot of the empty input box to locate on screen, if available
+        sent_template: Screenshot of the sent tick to locate on screen, if available
+    """
+
+    def __init__(self, pyautogui, input_template: str = UI_INPUT_TEMPLATE, sent_template: str = UI_SENT_TEMPLATE):
+        self._pyautogui = pyautogui
+        width, height = pyautogui.size()
+        self.region: Region = (0, max(0, height - UI_INPUT_HEIGHT), width, min(height, UI_INPUT_HEIGHT))
+        self.input_template = input_template if input_template and os.path.exists(input_template) else None
+        self.sent_template = sent_template if sent_template and os.path.exists(sent_template) else None
+        try:
+            import cv2  # type: ignore # noqa: F401
+            self._match_options = {"confidence": 0.8}  # Tolerant matching needs OpenCV
+        except ImportError:
+            self._match_options = {}
+
+    def grab(self):
+        """Screenshot of the watched region."""
+        return self._pyautogui.screenshot(region=self.region)
+
+    def input_center(self) -> Tuple[int, int]:
+        """Where to click to focus the input box: the located template, or the middle of the region."""
+        box = self.locate(self.input_template) if self.input_template else None
+        if box is not None:
+            return self._pyautogui.center(box)
+        left, top, width, height = self.region
+        return left + width // 2, top + height // 2
+
+    def locate(self, template: str, region: Optional[Region] = None):
+        """Box of template on screen (within region), or None if it isn't showing."""
+        try:
+            return self._pyautogui.locateOnScreen(template, region=region, **self._match_options)
+        except Exception:
+            return None  # Newer pyscreeze raises instead of returning None when nothing matches
+
+    def wait_for_change(self, reference, timeout: float):
+        """Wait until the region differs from reference; returns the new screenshot or None on timeout."""
+        def changed():
+            current = self.grab()
+            return current if changed_fraction(reference, current) >= CHANGED_FRACTION else None
+        return wait_until(changed, timeout)
+
+    def wait_for_ready(self, reference, timeout: float = UI_READY_TIMEOUT) -> bool:
+        """
+        Wait until the chat has loaded: the region has changed from reference (the new tab
+        opened) and then the input box template shows or, without a template, the region
+        stays still for UI_STABLE_FOR.
+        """
+        give_up_at = time.monotonic() + timeout
+        current = self.wait_for_change(reference, timeout)
+        if current is None:
+            return False
+        if self.input_template:
+            remaining = max(0.0, give_up_at - time.monotonic())
+            return wait_until(lambda: self.locate(self.input_template), remaining) is not None
+
+        stable_since = time.monotonic()
+        while time.monotonic() < give_up_at:
+            time.sleep(UI_POLL_INTERVAL)
+            latest = self.grab()
+            if changed_fraction(current, latest) >= CHANGED_FRACTION:
+                current, stable_since = latest, time.monotonic()
+            elif time.monotonic() - stable_since >= UI_STABLE_FOR:
+                return True
+        return False
+
+    def wait_for_sent(self, reference, timeout: float = UI_CONFIRM_TIMEOUT) -> bool:
+        """
+        Wait until the message has left the input box (the region changed) and, with a
+        sent-tick template, until the tick shows on the newest message just above it.
+        """
+        give_up_at = time.monotonic() + timeout
+        if self.wait_for_change(reference, timeout) is None:
+            return False
+        if not self.sent_template:
+            return True
+        left, top, width, _ = self.region
+        newest_message = (left, max(0, top - SENT_TICK_STRIP), width, min(top, SENT_TICK_STRIP))
+        remaining = max(0.0, give_up_at - time.monotonic())
+        return wait_until(lambda: self.locate(self.sent_template, newest_message), remaining) is not None
@@ -0,0 +1,510 @@
+"""
+Sender pool for the WhatsApp Bot
+Sends through several isolated sessions at once, each in its own worker process with its
+own transport, display and browser profile. Recipients are consistently hashed to a
+session, and messages spill over to the next session on the ring when theirs is backed up
+"""
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from metrics import REGISTRY
+from transports import SEND_TRANSPORT, WHATSAPP_PHONE_NUMBER_ID, SendResult, Transport
+
+log = logging.getLogger(__name__)
+
+# Configuration
+SENDER_SESSIONS_FILE = os.getenv("SENDER_SESSIONS_FILE", "sessions.json")  # One entry per isolated session
+# Without a sessions file: run this many copies of SEND_TRANSPORT (mock or cloud_api) side by side
+SENDER_WORKERS = int(os.getenv("SENDER_WORKERS", "1"))
+# A recipient's message goes to the next session of the same account on the ring while their own
+# one has more than this many times the account's average number of queued sends (0 always uses their own)
+SENDER_LOAD_FACTOR = float(os.getenv("SENDER_LOAD_FACTOR", "1.25"))
+SENDER_BROWSER = os.getenv("SENDER_BROWSER", "chromium")  # Browser started for sessions with a profile
+XVFB_SCREEN = os.getenv("XVFB_SCREEN", "1280x800x24")  # Size and depth of the virtual displays
+
+RING_POINTS = 64  # Points per session on the hash ring, so recipients are shared out evenly
+XVFB_START_TIMEOUT = 10  # Seconds for Xvfb to open its display
+
+QUEUE_DEPTH = REGISTRY.gauge("whatsapp_bot_sender_queue_depth", "Sends queued or running per session")
+SPILLS = REGISTRY.counter("whatsapp_bot_sender_spills_total", "Sends moved off a recipient's own session because it was busy")
+
+
+@dataclass(frozen=True)
+class Session:
+    """
+    One isolated place to send from, run by its own worker process.
+
+    Args:
+        name: Unique name; recipients are hashed to names, so keep them stable
+        transport: whatsapp_web, cloud_api or mock
+        display: X display for WhatsApp Web, e.g. ":101"
+        xvfb: Start a virtual framebuffer (Xvfb) on the display
+        profile: Browser profile directory with its own WhatsApp Web login
+        browser: Browser command used with the profile
+        account: WhatsApp account the session sends as. Sends only move between sessions of
+            the same account; defaults to the phone_number_id for cloud_api, one shared
+            account for mock, and a separate account per session for WhatsApp Web
+        settings: Transport options: base_url, phone_number_id and access_token for
+            cloud_api, latency and failure_rate for mock
+    """
+    name: str
+    transport: str = SEND_TRANSPORT
+    display: Optional[str] = None
+    xvfb: bool = False
+    profile: Optional[str] = None
+    browser: str = SENDER_BROWSER
+    account: Optional[str] = None
+    settings: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def sender(self) -> str:
+        """The account this session sends as (see `account`)."""
+        if self.account:
+            return self.account
+        if self.transport == "cloud_api":
+            return f"cloud_api:{self.settings.get('phone_number_id') or WHATSAPP_PHONE_NUMBER_ID}"
+        if self.transport == "mock":
+            return "mock"
+        return f"session:{self.name}"  # Each WhatsApp Web profile is linked on its own
+
+    def browser_command(self) -> Optional[List[str]]:
+        if not self.profile:
+            return None
+        return shlex.split(self.browser) + [f"--user-data-dir={os.path.abspath(self.profile)}"]
+
+    def create_transport(self) -> Transport:
+        """Build the session's transport (called in the worker process)."""
+        from transports import CloudApiTransport, MockTransport, MockWhatsAppServer, WhatsAppWebTransport
+
+        if self.transport == "mock":
+            server = MockWhatsAppServer(
+                latency=float(self.settings.get("latency", 0.0)),
+                failure_rate=float(self.settings.get("failure_rate", 0.0))
+            )
+            return MockTransport(server.start())
+        if self.transport == "cloud_api":
+            return CloudApiTransport(**{
+                key: value for key, value in self.settings.items()
+                if key in ("base_url", "phone_number_id", "access_token", "timeout")
+            })
+        if self.transport in ("whatsapp_web", "pywhatkit"):
+            return WhatsAppWebTransport(browser=self.browser_command())
+        raise ValueError(f"Unknown transport {self.transport!r} for session {self.name}")
+
+
+def _session_from_row(row: dict, index: int) -> Session:
+    known = {"name", "transport", "display", "xvfb", "profile", "browser", "account"}
+    values = {key: row[key] for key in known if row.get(key) not in (None, "")}
+    values.setdefault("name", f"session-{index + 1}")
+    values["xvfb"] = bool(values.get("xvfb", False))
+    values["settings"] = {key: value for key, value in row.items() if key not in known}
+    return Session(**values)
+
+
+def load_sessions(
+    path: Optional[str] = SENDER_SESSIONS_FILE,
+    workers: int = SENDER_WORKERS,
+    transport: str = SEND_TRANSPORT
+) -> List[Session]:
+    """
+    The sessions to send from: those in the sessions file, or `workers` copies of the
+    transport when there is no file. An empty list means a single, plain transport.
+
+    Args:
+        path: JSON list of sessions (see sessions.example.json), or None to not look for one
+        workers: Copies of the transport to run without a sessions file
+        transport: Transport of those copies
+    """
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+        if not isinstance(rows, list) or not rows:
+            raise ValueError(f"{path} must contain a list of sessions")
+        sessions = [_session_from_row(row, i) for i, row in enumerate(rows)]
+        names = [s.name for s in sessions]
+        if len(set(names)) != len(names):
+            raise ValueError(f"{path} uses the same session name more than once")
+        return sessions
+    if workers <= 1:
+        return []
+    if transport in ("whatsapp_web", "pywhatkit"):
+        # Copies would share one screen and browser; each needs its own display and login
+        raise ValueError(f"Several WhatsApp Web sessions need a {path} file (see sessions.example.json)")
+    return [Session(name=f"{transport}-{i + 1}", transport=transport) for i in range(workers)]
+
+
+def _ring_hash(key: str) -> int:
+    # Not hash(): it differs between processes and runs, and recipients must keep their session
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring: each key belongs to the first session clockwise of its hash, so
+    adding or removing a session only moves that session's share of the recipients.
+
+    Args:
+        names: Session names
+        points: Points per session on the ring
+    """
+
+    def __init__(self, names: List[str], points: int = RING_POINTS):
+        ring = sorted((_ring_hash(f"{name}#{i}"), name) for name in names for i in range(points))
+        self._hashes = [h for h, _ in ring]
+        self._names = [name for _, name in ring]
+        self._count = len(set(names))
+
+    def walk(self, key: str) -> Iterator[str]:
+        """Every session once, starting with the key's own and going clockwise."""
+        start = bisect.bisect(self._hashes, _ring_hash(key))
+        seen = set()
+        for i in range(len(self._names)):
+            name = self._names[(start + i) % len(self._names)]
+            if name not in seen:
+                seen.add(name)
+                yield name
+                if len(seen) == self._count:
+                    return
+
+
+def _start_xvfb(display: str) -> subprocess.Popen:
+    """Start a virtual framebuffer on the display and wait until it accepts connections."""
+    process = subprocess.Popen(
+        ["Xvfb", display, "-screen", "0", XVFB_SCREEN, "-nolisten", "tcp"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    socket_path = f"/tmp/.X11-unix/X{display.lstrip(':').split('.')[0]}"
+    give_up_at = time.monotonic() + XVFB_START_TIMEOUT
+    while not os.path.exists(socket_path):
+        if process.poll() is not None:
+            raise RuntimeError(f"Xvfb exited with code {process.returncode} (is display {display} already in use?)")
+        if time.monotonic() >= give_up_at:
+            process.terminate()
+            raise RuntimeError(f"Xvfb did not open display {display} within {XVFB_START_TIMEOUT}s")
+        time.sleep(0.05)
+    return process
+
+
+def _worker_main(session: Session, requests, results) -> None:
+    """
+    Worker process: owns one session's display, browser profile and transport, and sends
+    the messages it is handed one at a time, reporting each outcome to the coordinator.
+    """
+    from log_setup import configure_logging
+
+    configure_logging()
+    xvfb = None
+    transport = None
+    try:
+        # Set up before the transport is built: pyautogui connects to $DISPLAY when imported
+        if session.xvfb:
+            xvfb = _start_xvfb(session.display or ":99")
+        if session.display or session.xvfb:
+            os.environ["DISPLAY"] = session.display or ":99"
+        transport = session.create_transport()
+    except Exception as e:
+        results.put(("failed", session.name, None, None, f"{type(e).__name__}: {e}"))
+        if xvfb is not None:
+            xvfb.terminate()
+        return
+
+    results.put(("ready", session.name, None, None, None))
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            request_id, phone_number, message = request
+            try:
+                results.put(("done", session.name, request_id, transport.send(phone_number, message), None))
+            except Exception as e:
+                results.put(("done", session.name, request_id, None, f"{type(e).__name__}: {e}"))
+    except KeyboardInterrupt:
+        pass  # Ctrl+C reaches the whole process group; the coordinator shuts the pool down
+    finally:
+        transport.close()
+        server = getattr(transport, "server", None)
+        if server is not None:
+            server.stop()
+        if xvfb is not None:
+            xvfb.terminate()
+
+
+class _Worker:
+    def __init__(self, session: Session, context, results):
+        self.session = session
+        self.requests = context.Queue()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(session, self.requests, results),
+            name=f"sender-{session.name}",
+            daemon=True
+        )
+        self.ready = False
+        self.failed = False
+        self.depth = 0  # Sends handed to it and not answered yet
+        self.sent = 0
+        self.errors = 0
+        self.process.start()
+
+
+class SenderPool(Transport):
+    """
+    Transport that sends through several sessions in parallel, one worker process each.
+    send() can be called from many threads at once; each call blocks until its worker
+    has sent the message. A worker that dies is restarted, and the sends it had fail, since
+    they may or may not have gone out.
+
+    Args:
+        sessions: Sessions to start a worker for
+        load_factor: How far above the average queue depth a session may get before its
+            recipients spill over to the next session on the ring (0 never spills)
+    """
+
+    name = "pool"
+    exclusive = False  # Sessions are isolated from each other, so sends may overlap
+
+    def __init__(self, sessions: List[Session], load_factor: float = SENDER_LOAD_FACTOR):
+        if not sessions:
+            raise ValueError("A sender pool needs at least one session")
+        self.load_factor = load_factor
+        # Spawned, not forked: each worker starts clean, without the coordinator's threads,
+        # sockets or display connection
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending: Dict[int, Tuple[str, Future]] = {}
+        self._closed = False
+        self._ring = HashRing([s.name for s in sessions])
+        self._workers: Dict[str, _Worker] = {}
+        for session in sessions:
+            self._workers[session.name] = _Worker(session, self._context, self._results)
+            QUEUE_DEPTH.set(0, session=session.name)
+        self._reader = threading.Thread(target=self._read_results, name="sender-pool", daemon=True)
+        self._reader.start()
+        log.info("📮 Sender pool started", extra={"sessions": len(sessions), "load_factor": load_factor})
+
+    def send(self, phone_number: str, message: str) -> SendResult:
+        return self.submit(phone_number, message).result()
+
+    def submit(self, phone_number: str, message: str) -> "Future[SendResult]":
+        """Queue a send on the recipient's session (or a less busy one) without waiting for it."""
+        future: "Future[SendResult]" = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The sender pool is closed")
+            worker = self._route_locked(phone_number)
+            request_id = next(self._ids)
+            self._pending[request_id] = (worker.session.name, future)
+            worker.depth += 1
+            QUEUE_DEPTH.set(worker.depth, session=worker.session.name)
+        worker.requests.put((request_id, phone_number, message))
+        return future
+
+    def _route_locked(self, phone_number: str) -> _Worker:
+        """
+        Bounded-load consistent hashing: the first session on the ring that isn't backed up,
+        among the sessions of the recipient's own session's account, so the sender never changes.
+        """
+        walk = [self._workers[name] for name in self._ring.walk(phone_number)]
+        sender = walk[0].session.sender
+        candidates = [w for w in walk if w.session.sender == sender and not w.failed]
+        if not candidates:
+            raise RuntimeError(f"No sender session for {sender} is running")
+        if self.load_factor <= 0:
+            return candidates[0]
+        # Below the bound there is always a session, since not all can be above the average
+        bound = max(1, math.ceil(self.load_factor * (sum(w.depth for w in candidates) + 1) / len(candidates)))
+        for worker in candidates:
+            if worker.depth < bound:
+                if worker is not candidates[0]:
+                    SPILLS.inc(session=candidates[0].session.name)
+                return worker
+        return candidates[0]
+
+    def _read_results(self) -> None:
+        while True:
+            try:
+                kind, name, request_id, result, error = self._results.get(timeout=1.0)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if kind == "stop":
+                return
+            with self._lock:
+                worker = self._workers[name]
+                if kind == "ready":
+                    worker.ready = True
+                    log.info("✅ Sender session ready", extra={"session": name, "transport": worker.session.transport})
+                    continue
+                if kind == "failed":
+                    worker.failed = True
+                    log.error("❌ Sender session could not start", extra={"session": name, "error": error})
+                    self._fail_pending_locked(name, f"Session {name} could not start: {error}")
+                    continue
+                _, future = self._pending.pop(request_id)
+                worker.depth -= 1
+                QUEUE_DEPTH.set(worker.depth, session=name)
+                if error is None:
+                    worker.sent += 1
+                else:
+                    worker.errors += 1
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(Exception(f"Session {name}: {error}"))
+
+    def _check_workers(self) -> None:
+        """Restart workers that died after starting; their unanswered sends fail."""
+        with self._lock:
+            if self._closed:
+                return
+            for name, worker in list(self._workers.items()):
+                if worker.failed or worker.process.is_alive():
+                    continue
+                reason = f"Session {name} exited with code {worker.process.exitcode}"
+                self._fail_pending_locked(name, reason)
+                if not worker.ready:
+                    # It never got going, so starting it again would most likely fail the same way
+                    worker.failed = True
+                    log.error("❌ Sender session could not start", extra={"session": name, "error": reason})
+                    continue
+                log.error("❌ Sender session died, restarting it", extra={"session": name, "exit_code": worker.process.exitcode})
+                restarted = self._workers[name] = _Worker(worker.session, self._context, self._results)
+                restarted.sent, restarted.errors = worker.sent, worker.errors
+
+    def _fail_pending_locked(self, name: str, reason: str) -> None:
+        for request_id, (owner, future) in list(self._pending.items()):
+            if owner == name:
+                del self._pending[request_id]
+                future.set_exception(Exception(reason))
+        self._workers[name].depth = 0
+        QUEUE_DEPTH.set(0, session=name)
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Wait until every session has started or failed. Returns whether all of them started."""
+        give_up_at = time.monotonic() + timeout
+        while time.monotonic() < give_up_at:
+            with self._lock:
+                if all(w.ready or w.failed for w in self._workers.values()):
+                    return not any(w.failed for w in self._workers.values())
+            time.sleep(0.05)
+        return False
+
+    def stats(self) -> Dict[str, dict]:
+        """Queue depth, sends and errors per session."""
+        with self._lock:
+            return {
+                name: {
+                    "state": "failed" if w.failed else "ready" if w.ready else "starting",
+                    "queued": w.depth,
+                    "sent": w.sent,
+                    "errors": w.errors,
+                }
+                for name, w in self._workers.items()
+            }
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Let the workers finish what they were handed, then stop them."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers.values())
+        for worker in workers:
+            worker.requests.put(None)
+        give_up_at = time.monotonic() + timeout
+        for worker in workers:
+            worker.process.join(max(0.0, give_up_at - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+        # Every answer the workers sent is in the queue ahead of this
+        self._results.put(("stop", None, None, None, None))
+        self._reader.join(timeout)
+        with self._lock:
+            for name in self._workers:
+                self._fail_pending_locked(name, "The sender pool was closed")
+
+
+def _throughput(sessions: List[Session], messages: int, recipients: int) -> float:
+    """Messages per second sending `messages` messages to `recipients` recipients from many threads."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = SenderPool(sessions)
+    try:
+        pool.wait_ready(30)  # Don't time the worker start
+        numbers = [f"+1555{i % recipients:07d}" for i in range(messages)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(sessions) * 4) as executor:
+            list(executor.map(lambda number: pool.send(number, "Test message"), numbers))
+        elapsed = time.perf_counter() - start
+        print(f"   {len(sessions)} session(s): {messages / elapsed:.1f} messages/sec, sent per session "
+              f"{[s['sent'] for s in pool.stats().values()]}")
+        return messages / elapsed
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sender pool tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench", help="Compare one session with several, using mock sessions")
+    bench.add_argument("--workers", type=int, default=4)
+    bench.add_argument("--latency", type=float, default=0.2, help="Seconds each mock send takes")
+    bench.add_argument("--messages", type=int, default=40)
+    bench.add_argument("--recipients", type=int, default=10)
+    login = commands.add_parser("login", help="Open WhatsApp Web in a session so you can link it")
+    login.add_argument("name", help="Session name from the sessions file")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        def mock_sessions(count: int) -> List[Session]:
+            return [Session(name=f"mock-{i + 1}", transport="mock", settings={"latency": args.latency}) for i in range(count)]
+
+        print(f"📮 Sending {args.messages} messages ({args.latency}s each) to {args.recipients} recipients...")
+        single = _throughput(mock_sessions(1), args.messages, args.recipients)
+        several = _throughput(mock_sessions(args.workers), args.messages, args.recipients)
+        print(f"✅ {several / single:.1f}x faster with {args.workers} sessions")
+    else:
+        # Virtual displays can't be looked at, so the QR code is saved as a screenshot to scan
+        session = next((s for s in load_sessions() if s.name == args.name), None)
+        if session is None:
+            raise SystemExit(f"No session named {args.name!r} in {SENDER_SESSIONS_FILE}")
+        xvfb = _start_xvfb(session.display or ":99") if session.xvfb else None
+        if session.display or session.xvfb:
+            os.environ["DISPLAY"] = session.display or ":99"
+        try:
+            import pyautogui  # type: ignore
+
+            command = session.browser_command() or shlex.split(session.browser)
+            subprocess.Popen(command + ["https://web.whatsapp.com"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            screenshot = f"login-{session.name}.png"
+            print(f"📱 Scan the QR code in {screenshot} (refreshed every 5 seconds) with WhatsApp > Linked devices.")
+            print("   Press Ctrl+C once the chats show up.")
+            try:
+                while True:
+                    time.sleep(5)
+                    pyautogui.screenshot(screenshot)
+            except KeyboardInterrupt:
+                print(f"✅ The login is kept in {session.profile or 'the browser profile'}")
+        finally:
+            if xvfb is not None:
+                xvfb.terminate()
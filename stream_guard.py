@@ -0,0 +1,191 @@
+"""
+Streaming checks for LLM output
+Watches a streamed message as tokens arrive, cuts it at a sentence boundary once
+it reaches the length limit, and aborts as soon as it breaks a hard rule
+"""
+import os
+import re
+import threading
+from collections import deque
+from typing import Deque, Optional
+
+# Configuration
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() == "true"  # Stream and check messages as they arrive
+STREAM_MAX_ATTEMPTS = int(os.getenv("STREAM_MAX_ATTEMPTS", "3"))  # Tries before giving up on a rule-breaking model
+RECENT_OPENERS_SIZE = 50  # Openings of recent messages that may not be reused
+OPENER_WORDS = 3  # Words that make up a message's opening
+
+QUOTE_CHARS = "\"“”„«»"
+SENTENCE_END = re.compile(r"[.!?…](?=\s|$)")
+STORY_PATTERNS = re.compile(
+    r"\b(once upon a time|long ago|there once was|there was once|let me tell you a story|"
+    r"as the saying goes|as they say)\b",
+    re.IGNORECASE,
+)
+
+
+class ContentViolation(Exception):
+    """
+    Raised when a model kept breaking the message rules. The backend answered, so circuit
+    breakers and concurrency limits treat it as neither a success nor a failure.
+    """
+
+
+class _RecentOpeners:
+    """Openings of recently accepted messages, shared by every stream."""
+
+    def __init__(self, size: int = RECENT_OPENERS_SIZE):
+        self._openers: Deque[str] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, text: str) -> None:
+        opener = opener_of(text)
+        if opener:
+            with self._lock:
+                self._openers.append(opener)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._openers.clear()
+
+    def __contains__(self, opener: str) -> bool:
+        with self._lock:
+            return opener in self._openers
+
+
+RECENT_OPENERS = _RecentOpeners()
+
+
+def opener_of(text: str) -> Optional[str]:
+    """Normalized first few words of a message, or None if it is still too short to tell."""
+    words = re.findall(r"[\w']+", text.lower())
+    if len(words) < OPENER_WORDS:
+        return None
+    if len(words) == OPENER_WORDS and re.search(r"[\w']$", text):
+        return None  # The last word may still be streaming in
+    return " ".join(words[:OPENER_WORDS])
+
+
+class StreamGuard:
+    """
+    Incremental checker for one streamed message.
+
+    Feed it each text delta; it returns False once the stream should be closed, either
+    because the message is long enough (result() then returns the trimmed text) or
+    because it broke a rule (result() returns None and `violation` says why).
+
+    Args:
+        max_length: Maximum characters in the final message
+    """
+
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.text = ""
+        self.violation: Optional[str] = None
+        self.truncated = False
+        self.usage = None  # Token usage, if the server sent it before the stream was closed
+        self._checked_opener = False
+        self._closing_quote_at: Optional[int] = None
+
+    def feed(self, delta: str) -> bool:
+        """Add streamed text; returns True to keep reading, False to stop."""
+        start = len(self.text)
+        self.text += delta
+
+        self._check_quotes(start)
+        if self.violation is None and STORY_PATTERNS.search(self.text[max(0, start - 40):]):
+            self.violation = "story or idiom"
+        if self.violation is None and not self._checked_opener:
+            self._check_opener()
+        if self.violation is not None:
+            return False
+
+        if len(self.text.strip().strip(QUOTE_CHARS)) > self.max_length:
+            self.truncated = True
+            return False
+        return True
+
+    def result(self) -> Optional[str]:
+        """The finished message, trimmed to max_length, or None if the stream was aborted."""
+        if self.violation is not None:
+            return None
+        text = self.text.strip()
+        if self._closing_quote_at is not None:
+            text = text[:self._closing_quote_at].strip()
+        text = text.strip(QUOTE_CHARS).strip()
+        if len(text) > self.max_length:
+            text = cut_at_boundary(text, self.max_length)
+        return text
+
+    def _check_quotes(self, start: int) -> None:
+        stripped_offset = len(self.text) - len(self.text.lstrip())
+        wrapped = self.text.lstrip()[:1] in QUOTE_CHARS and self.text.lstrip() != ""
+        for index in range(max(start, stripped_offset), len(self.text)):
+            char = self.text[index]
+            if self._closing_quote_at is not None and not char.isspace():
+                # Text after the wrapper's closing quote means the model quoted something
+                self.violation = "quotation"
+                return
+            if char in QUOTE_CHARS:
+                if index == stripped_offset:
+                    continue  # Opening quote around the whole message - stripped later
+                if wrapped:
+                    self._closing_quote_at = index
+                else:
+                    self.violation = "quotation"
+                    return
+
+    def _check_opener(self) -> None:
+        opener = opener_of(self.text)
+        if opener is None:
+            return
+        self._checked_opener = True
+        if opener in RECENT_OPENERS:
+            self.violation = f"repeated opening \"{opener}\""
+
+
+def cut_at_boundary(text: str, max_length: int) -> str:
+    """Cut text to max_length at the last sentence end, or the last word if there is none."""
+    head = text[:max_length + 1]
+    ends = [match.end() for match in SENTENCE_END.finditer(head) if match.end() <= max_length]
+    if ends:
+        cut = ends[-1]
+        # Keep emojis that directly follow the final punctuation
+        trailing = re.match(r"\s*[^\w\s]+", text[cut:max_length])
+        if trailing:
+            cut += trailing.end()
+        return text[:cut].strip()
+    space = head.rfind(" ", 0, max_length)
+    return text[:space if space > 0 else max_length].strip()
+
+
+def consume_stream(stream, guard: StreamGuard) -> Optional[str]:
+    """Read a streamed chat completion through a guard, closing it as soon as the guard says stop."""
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                guard.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta and not guard.feed(delta):
+                break
+    finally:
+        stream.close()  # Stops generation on the server instead of paying for the rest
+    return guard.result()
+
+
+async def consume_stream_async(stream, guard: StreamGuard) -> Optional[str]:
+    """Async version of consume_stream."""
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                guard.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta and not guard.feed(delta):
+                break
+    finally:
+        await stream.close()
+    return guard.result()
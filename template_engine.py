@@ -0,0 +1,212 @@
+"""
+Template engine for the no-LLM message path
+Loads a template corpus once, compiles each template into a fast formatter and
+indexes it by time of day, relationship and style, so picking a message stays
+cheap with tens of thousands of templates
+"""
+import json
+import math
+import os
+import random
+import threading
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime
+from itertools import accumulate
+from string import Formatter
+from typing import Deque, Dict, FrozenSet, List, Optional, Set, Tuple
+
+# Configuration
+TEMPLATES_FILE = os.getenv(
+    "TEMPLATES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates.json")
+)
+RECENT_TEMPLATE_WINDOW = int(os.getenv("RECENT_TEMPLATE_WINDOW", "20"))  # Templates not reused per recipient
+
+GREETINGS = {"morning": "Good morning", "afternoon": "Good afternoon", "evening": "Good evening"}
+FIELDS = {"greeting", "name", "relationship", "style"}
+ANY = "*"
+MAX_REDRAWS = 8  # Draws tried before a recently used template is accepted anyway
+
+
+def time_bucket(hour: int) -> str:
+    """Time-of-day bucket for an hour, matching the greeting that is used."""
+    if hour < 12:
+        return "morning"
+    if hour < 17:
+        return "afternoon"
+    return "evening"
+
+
+def _words(text: str) -> Set[str]:
+    return {word.strip(",.;!") for word in text.lower().split()} - {"", "and", "or"}
+
+
+class CompiledTemplate:
+    """A template split once into literal text and fields, so rendering is a single join."""
+
+    __slots__ = ("text", "weight", "_parts")
+
+    def __init__(self, text: str, weight: float = 1.0):
+        if not (math.isfinite(weight) and weight > 0):
+            raise ValueError(f"Template weight must be a positive number, got {weight!r}: {text!r}")
+        self.text = text
+        self.weight = weight
+        parts = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if field is not None and (field not in FIELDS or spec or conversion):
+                raise ValueError(f"Unsupported field {{{field}}} in template: {text!r}")
+            parts.append((literal, field))
+        self._parts = tuple(parts)
+
+    def render(self, values: Dict[str, str]) -> str:
+        return "".join(literal + (values[field] if field else "") for literal, field in self._parts)
+
+
+class _Pool:
+    """Templates matching one lookup key, with cumulative weights for weighted picks."""
+
+    __slots__ = ("ids", "cumulative", "total")
+
+    def __init__(self, ids: List[int], weights: List[float]):
+        self.ids = ids
+        self.cumulative = list(accumulate(weights))
+        self.total = self.cumulative[-1] if self.cumulative else 0.0
+
+    def draw(self) -> int:
+        return self.ids[bisect_right(self.cumulative, random.random() * self.total)]
+
+
+class TemplateEngine:
+    """
+    Indexed, weighted template selection.
+
+    Corpus format (JSON): {"templates": [{"text": ..., "weight": 1, "times": [...],
+    "relationships": [...], "styles": [...]}]}. Only "text" is required; a missing list
+    means the template fits any time, relationship or style. Fields available in text:
+    {greeting}, {name}, {relationship}, {style}.
+
+    Args:
+        templates: Parsed template entries
+        recent_window: Templates per recipient that are avoided because they were just used
+    """
+
+    def __init__(self, templates: List[dict], recent_window: int = RECENT_TEMPLATE_WINDOW):
+        if not templates:
+            raise ValueError("Template corpus is empty")
+        self.recent_window = recent_window
+        self._templates: List[CompiledTemplate] = []
+        self._by_time: Dict[str, Set[int]] = {}
+        self._by_relationship: Dict[str, Set[int]] = {}
+        self._by_style: Dict[str, Set[int]] = {}
+        self._pools: Dict[Tuple[str, str, FrozenSet[str]], _Pool] = {}
+        self._recent: Dict[str, Deque[int]] = {}
+        self._lock = threading.Lock()
+        for entry in templates:
+            self._add(entry)
+
+    @classmethod
+    def from_file(cls, path: str = TEMPLATES_FILE, **kwargs) -> "TemplateEngine":
+        """Load and compile a corpus file."""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        templates = data.get("templates") if isinstance(data, dict) else data
+        return cls(templates, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self._templates)
+
+    def render(
+        self,
+        recipient_name: str,
+        relationship: str,
+        style: str,
+        now: Optional[datetime] = None
+    ) -> str:
+        """
+        Pick a template for the recipient and time of day and fill it in.
+
+        Args:
+            recipient_name: Name of the recipient
+            relationship: Relationship with recipient
+            style: Style of the message
+            now: Time used for the greeting (defaults to the current time)
+
+        Returns:
+            The rendered message
+        """
+        bucket = time_bucket((now or datetime.now()).hour)
+        pool = self._pool(bucket, relationship.lower().strip(), frozenset(_words(style)))
+        template_id = self._pick(pool, recipient_name)
+        return self._templates[template_id].render({
+            "greeting": GREETINGS[bucket],
+            "name": recipient_name,
+            "relationship": relationship,
+            "style": style,
+        })
+
+    def _add(self, entry: dict) -> None:
+        template_id = len(self._templates)
+        self._templates.append(CompiledTemplate(entry["text"], float(entry.get("weight", 1.0))))
+        for index, key, normalize in (
+            (self._by_time, "times", str.lower),
+            (self._by_relationship, "relationships", lambda value: value.lower().strip()),
+            (self._by_style, "styles", str.lower),
+        ):
+            values = entry.get(key) or [ANY]
+            for value in values:
+                index.setdefault(normalize(value), set()).add(template_id)
+
+    def _matching(self, index: Dict[str, Set[int]], keys) -> Set[int]:
+        matched = set(index.get(ANY, ()))
+        for key in keys:
+            matched |= index.get(key, set())
+        return matched
+
+    def _pool(self, bucket: str, relationship: str, styles: FrozenSet[str]) -> _Pool:
+        key = (bucket, relationship, styles)
+        pool = self._pools.get(key)
+        if pool is not None:
+            return pool
+
+        times = self._matching(self._by_time, [bucket])
+        relationships = self._matching(self._by_relationship, [relationship])
+        style_ids = self._matching(self._by_style, styles)
+        # Widen the search one constraint at a time if nothing fits exactly
+        ids = times & relationships & style_ids or times & relationships or times or set(range(len(self._templates)))
+        ordered = sorted(ids)
+        pool = _Pool(ordered, [self._templates[i].weight for i in ordered])
+        with self._lock:
+            self._pools[key] = pool
+        return pool
+
+    def _pick(self, pool: _Pool, recipient: str) -> int:
+        with self._lock:
+            recent = self._recent.setdefault(recipient, deque(maxlen=max(1, self.recent_window)))
+            avoid = min(len(recent), len(pool.ids) - 1)
+            recent_ids = set(list(recent)[-avoid:]) if avoid > 0 else set()
+            template_id = pool.draw()
+            for _ in range(MAX_REDRAWS):
+                if template_id not in recent_ids:
+                    break
+                template_id = pool.draw()
+            else:
+                # Mostly recent templates in a small pool - take any that wasn't used recently
+                unused = [i for i in pool.ids if i not in recent_ids]
+                if unused:
+                    template_id = random.choice(unused)
+            recent.append(template_id)
+        return template_id
+
+
+_engine: Optional[TemplateEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_template_engine() -> TemplateEngine:
+    """The shared engine, loaded from TEMPLATES_FILE on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = TemplateEngine.from_file(TEMPLATES_FILE)
+    return _engine
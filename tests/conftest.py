@@ -0,0 +1,7 @@
+"""
+Shared pytest setup: the bot's modules live in the repository root, so it goes on sys.path
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
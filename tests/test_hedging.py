@@ -0,0 +1,18 @@
+"""
+Tests for latency tracking behind hedged requests
+"""
+import message_generator
+from hedging import LatencyTracker, timed
+
+
+def test_timed_skips_calls_the_predicate_rejects():
+    tracker = LatencyTracker()
+
+    @timed(tracker, when=message_generator._single_message)
+    def complete(messages, max_tokens=200, temperature=0.9, max_length=None):
+        return "ok"
+
+    complete([], max_tokens=2000)  # A batch
+    complete([], max_length=120)
+    complete([], 200, 0.9, 120)
+    assert len(tracker._samples) == 2
@@ -0,0 +1,73 @@
+"""
+Tests for near-duplicate detection against the sent-message history
+"""
+import pytest
+
+import whatsapp_bot
+from message_history import MessageHistory, jaccard, lsh_rows, shingles
+from outbox import Outbox
+from recipients import Recipient
+from transports import MockTransport
+
+SENT = "Good morning sunshine! I hope your coffee is strong and your day is full of little wins today."
+
+
+def test_near_duplicate_is_found():
+    history = MessageHistory(path=None)
+    history.record(SENT, "+1")
+    reworded = SENT.replace("little wins", "small wins")
+    assert jaccard(shingles(SENT), shingles(reworded)) >= history.threshold
+    assert history.is_duplicate(reworded, "+1")
+
+
+def test_unrelated_message_and_other_recipients_are_not_duplicates():
+    history = MessageHistory(path=None)
+    history.record(SENT, "+1")
+    assert not history.is_duplicate("Thinking of you tonight, sleep well and dream big!", "+1")
+    assert not history.is_duplicate(SENT, "+2")
+    assert history.is_duplicate(SENT)  # Compared with everyone
+
+
+def test_history_survives_a_restart(tmp_path):
+    path = str(tmp_path / "sent.jsonl")
+    MessageHistory(path=path).record(SENT, "+1")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"time": 1, "recipient": "+1", "te')  # Torn last line from a crash
+    history = MessageHistory(path=path)
+    assert len(history) == 1
+    assert history.is_duplicate(SENT, "+1")
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.7, 0.9])
+def test_lsh_bands_catch_pairs_at_the_threshold(threshold):
+    rows = lsh_rows(threshold)
+    bands = 64 // rows
+    assert 1 - (1 - threshold ** rows) ** bands >= 0.99
+
+
+@pytest.fixture
+def bot():
+    recipient = Recipient(number="+15550000000", name="Sam", relationship="friend", style="fun")
+    transport = MockTransport()
+    outbox = Outbox(":memory:")
+    bot = whatsapp_bot.WhatsAppBot([recipient], transport, outbox, MessageHistory(path=None), use_llm=False)
+    yield bot, recipient, transport.server
+    transport.close()
+    transport.server.stop()
+    outbox.close()
+
+
+def test_send_replaces_a_repeated_message(bot):
+    bot, recipient, server = bot
+    bot.history.record(SENT, recipient.number)
+    bot.send_message(recipient, SENT)
+    assert len(server.received) == 1
+    assert not jaccard(shingles(server.received[0]["text"]["body"]), shingles(SENT)) >= bot.history.threshold
+
+
+def test_send_is_skipped_when_every_draw_repeats(bot, monkeypatch):
+    bot, recipient, server = bot
+    bot.history.record(SENT, recipient.number)
+    monkeypatch.setattr(whatsapp_bot, "generate_message_simple", lambda **params: SENT)
+    bot.send_message(recipient)
+    assert server.received == []
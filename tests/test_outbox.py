@@ -0,0 +1,142 @@
+"""
+Tests for the outbox journal and its recovery after a restart
+"""
+import sqlite3
+import time
+
+from message_buffer import MessageBuffer
+from message_history import MessageHistory
+from outbox import DROPPED, GENERATED, SENDING, SENT, Outbox
+
+
+def _backdate(path: str, seconds: float) -> None:
+    """Make every journaled message look `seconds` older, as if the bot had been down that long."""
+    db = sqlite3.connect(path)
+    db.execute("UPDATE outbox SET created = created - ?", (seconds,))
+    db.commit()
+    db.close()
+
+
+def test_recover_replays_unsent_messages_only(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.record_generated("+1", ["buffered", "scheduled", "sending", "sent"])
+    outbox.schedule("+1", "scheduled")
+    keys = {message: outbox.schedule("+1", message).key for message in ("sending", "sent")}
+    assert outbox.begin_send(keys["sending"]) and outbox.begin_send(keys["sent"])
+    outbox.mark_sent(keys["sent"], "wamid.1")
+    outbox.close()
+
+    outbox = Outbox(path)
+    recovered = outbox.recover(max_age=60)
+    assert [message for message, _ in recovered["+1"]] == ["buffered", "scheduled"]
+    assert outbox.counts()[SENDING] == 1  # Left alone: it may have gone out
+    assert outbox.counts()[SENT] == 1
+    outbox.close()
+
+
+def test_a_key_is_handed_to_the_transport_at_most_once():
+    outbox = Outbox(":memory:")
+    sent, failed = (outbox.schedule("+1", message).key for message in ("sent", "failed"))
+    assert outbox.begin_send(sent) and outbox.begin_send(failed)
+    assert not outbox.begin_send(sent)  # Still sending
+    outbox.mark_sent(sent)
+    outbox.mark_failed(failed, "timed out after the request went out")
+    assert not outbox.begin_send(sent)
+    assert not outbox.begin_send(failed)  # May have arrived, so never resent
+    outbox.close()
+
+
+def test_recovered_messages_keep_their_age(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.record_generated("+1", ["from before the restart"])
+    outbox.close()
+    _backdate(path, 40)
+
+    outbox = Outbox(path)
+    buffer = MessageBuffer(generator=lambda count, **params: [], max_age=60, outbox=outbox)
+    buffer.register("+1")
+    ((message, created),) = outbox.recover(buffer.max_age)["+1"]
+    assert time.time() - created >= 40
+    assert buffer.put("+1", [message], created=[created]) == 1
+    buffer.max_age = 30  # Already 40 seconds old, so it is stale now
+    assert buffer.pop("+1") is None
+    outbox.close()
+
+
+def test_replayed_messages_are_not_journaled_again():
+    outbox = Outbox(":memory:")
+    buffer = MessageBuffer(generator=lambda count, **params: [], outbox=outbox)
+    buffer.register("+1")
+    buffer.put("+1", ["fresh"])
+    buffer.put("+1", ["replayed"], created=[time.time() - 5])
+    assert outbox.counts() == {GENERATED: 1}
+    assert buffer.pop("+1") == "replayed"  # Older, so first out
+    outbox.close()
+
+
+def _restart(path: str, max_age: float = 60, capacity: int = 3, history=None):
+    outbox = Outbox(path)
+    buffer = MessageBuffer(
+        generator=lambda count, **params: [], capacity=capacity, max_age=max_age, history=history, outbox=outbox
+    )
+    buffer.register("+1")
+    for recipient, entries in outbox.recover(max_age).items():
+        messages, created = zip(*entries)
+        buffer.put(recipient, list(messages), created=list(created))
+    return outbox, buffer
+
+
+def test_stale_messages_are_not_replayed_again(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox, buffer = _restart(path)
+    buffer.put("+1", ["going stale"])
+    buffer.max_age = 0
+    assert buffer.pop("+1") is None
+    outbox.close()
+
+    outbox, buffer = _restart(path)
+    assert buffer.size("+1") == 0
+    assert outbox.counts() == {DROPPED: 1}
+    outbox.close()
+
+
+def test_replayed_messages_over_capacity_are_not_replayed_again(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.record_generated("+1", ["one", "two", "three"])
+    outbox.close()
+
+    outbox, buffer = _restart(path, capacity=2)
+    assert buffer.size("+1") == 2
+    assert outbox.counts() == {GENERATED: 2, DROPPED: 1}
+    outbox.close()
+
+
+def test_replayed_near_duplicates_are_not_replayed_again(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    text = "Good morning sunshine! I hope your coffee is strong and your day is full of little wins."
+    outbox = Outbox(path)
+    outbox.record_generated("+1", [text])
+    outbox.close()
+
+    history = MessageHistory(path=None)
+    history.record(text, "+1")  # Sent by another route since it was generated
+    outbox, buffer = _restart(path, history=history)
+    assert buffer.size("+1") == 0
+    assert outbox.counts() == {DROPPED: 1}
+    outbox.close()
+
+
+def test_expired_messages_are_dropped_on_recovery(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.record_generated("+1", ["old"])
+    outbox.close()
+    _backdate(path, 120)
+
+    outbox, buffer = _restart(path, max_age=60)
+    assert buffer.size("+1") == 0
+    assert outbox.counts() == {DROPPED: 1}
+    outbox.close()
@@ -0,0 +1,124 @@
+"""
+Tests for the adaptive limiter and how it combines with the circuit breaker
+"""
+import asyncio
+
+import pytest
+
+import message_generator
+from circuit_breaker import CLOSED, HALF_OPEN, CircuitBreaker, CircuitOpenError, guarded_by
+from rate_limiter import BackendLimiter, QueueTimeout, limited_by
+
+
+@pytest.fixture
+def lm_studio():
+    """The LM Studio breaker and limiter with a short queue timeout, restored afterwards."""
+    breaker = message_generator.LM_STUDIO_BREAKER
+    limiter = message_generator.LM_STUDIO_LIMITER
+    queue_timeout = limiter.queue_timeout
+    limiter.queue_timeout = 0.05
+    breaker.reset()
+    yield breaker, limiter
+    limiter.queue_timeout = queue_timeout
+    breaker.reset()
+
+
+def _fill(limiter: BackendLimiter) -> int:
+    """Take every free slot; returns how many were taken."""
+    taken = int(limiter.limit) - limiter.in_flight
+    for _ in range(taken):
+        limiter.acquire()
+    return taken
+
+
+def _drain(limiter: BackendLimiter, taken: int) -> None:
+    for _ in range(taken):
+        limiter.release()
+
+
+def test_queue_timeouts_do_not_open_the_circuit(lm_studio):
+    breaker, limiter = lm_studio
+    taken = _fill(limiter)
+    try:
+        for _ in range(breaker.failure_threshold + 1):
+            with pytest.raises(QueueTimeout):
+                message_generator._lm_studio_completion([{"role": "user", "content": "hi"}])
+    finally:
+        _drain(limiter, taken)
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_async_queue_timeouts_do_not_open_the_circuit(lm_studio):
+    breaker, limiter = lm_studio
+    taken = _fill(limiter)
+
+    async def call():
+        await message_generator._lm_studio_completion_async([{"role": "user", "content": "hi"}])
+
+    try:
+        for _ in range(breaker.failure_threshold + 1):
+            with pytest.raises(QueueTimeout):
+                asyncio.run(call())
+    finally:
+        _drain(limiter, taken)
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_half_open_trial_is_not_claimed_while_queueing():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    limiter = BackendLimiter("test", max_concurrency=1, initial_concurrency=1, queue_timeout=0.05)
+
+    @limited_by(limiter)
+    @guarded_by(breaker)
+    def complete(messages, max_tokens=10):
+        return "ok"
+
+    breaker.trip()
+    assert breaker.state == HALF_OPEN
+    limiter.acquire()
+    with pytest.raises(QueueTimeout):
+        complete([])
+    limiter.release()
+    assert complete([]) == "ok"  # The trial slot was still free
+    assert breaker.state == CLOSED
+
+
+def test_refused_call_gets_its_reservation_back():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+    limiter = BackendLimiter("test", requests_per_minute=60, tokens_per_minute=6000, max_concurrency=2)
+
+    @limited_by(limiter)
+    @guarded_by(breaker)
+    def complete(messages, max_tokens=10):
+        return "ok"
+
+    breaker.trip()
+    requests, tokens = limiter.requests._tokens, limiter.tokens._tokens
+    with pytest.raises(CircuitOpenError):
+        complete([{"role": "user", "content": "hello there"}], max_tokens=100)
+    assert limiter.in_flight == 0
+    assert limiter.requests._tokens == pytest.approx(requests, abs=0.1)
+    assert limiter.tokens._tokens == pytest.approx(tokens, abs=1)
+
+
+def test_completion_length_alone_does_not_lower_the_limit():
+    limiter = BackendLimiter("test", max_concurrency=8, initial_concurrency=4)
+    for i in range(60):
+        tokens = 5 if i % 2 else 150  # Same speed per token, very different request times
+        limiter.acquire()
+        limiter.release(0.05 + tokens * 0.01, tokens=tokens)
+    assert limiter.limit == 8
+
+
+def test_slow_tokens_lower_the_limit():
+    limiter = BackendLimiter("test", max_concurrency=8, initial_concurrency=8)
+    for _ in range(30):
+        limiter.acquire()
+        limiter.release(0.5, tokens=50)
+    for _ in range(5):
+        limiter._last_decrease = float("-inf")
+        limiter.acquire()
+        limiter.release(2.0, tokens=50)  # Four times slower per token
+    assert limiter.limit < 8
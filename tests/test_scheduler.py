@@ -0,0 +1,139 @@
+"""
+Tests for the scheduler's drift correction and quiet hours, on a fake clock
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler
+from scheduler import Scheduler, in_quiet_hours
+
+HOUR = 3600.0
+
+
+class Clock:
+    """time.monotonic() and datetime.now() that only move when a test moves them."""
+
+    def __init__(self, start: datetime):
+        self.start = start
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def wall(self) -> datetime:
+        return self.start + timedelta(seconds=self.now - 1000.0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock(datetime(2026, 3, 2, 21, 0))
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return fake.wall()
+
+    # Patch the scheduler's names only: asyncio keeps using the real clock
+    monkeypatch.setattr(scheduler, "time", SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(scheduler, "datetime", FakeDatetime)
+    return fake
+
+
+async def _noop():
+    pass
+
+
+def test_late_runs_keep_the_planned_cadence(clock):
+    async def main():
+        sched = Scheduler()
+        job = sched.add_job(_noop, 60, start_in=60)
+        first = job.next_run
+        for run in range(1, 6):
+            clock.now = job.next_run + 7  # Every run fires 7 seconds late
+            sched._fire(job, job.next_run)
+            assert job.next_run == first + run * 60  # Not 7 seconds later per run
+        await sched.wait_for_running_jobs()
+        assert job.runs == 5
+        assert job.average_lateness == pytest.approx(7)
+
+    asyncio.run(main())
+
+
+def test_missed_runs_are_skipped_onto_the_original_grid(clock, caplog):
+    async def main():
+        sched = Scheduler()
+        job = sched.add_job(_noop, 60, start_in=60)
+        first = job.next_run
+        clock.now = first + 3.5 * 60  # The loop was blocked for three and a half intervals
+        with caplog.at_level(logging.WARNING, logger="scheduler"):
+            sched._fire(job, first)
+        await sched.wait_for_running_jobs()
+        assert job.next_run == first + 4 * 60
+        assert [r.missed for r in caplog.records] == [3]
+
+    asyncio.run(main())
+
+
+def test_jitter_does_not_accumulate(clock, monkeypatch):
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: high)
+
+    async def main():
+        sched = Scheduler()
+        job = sched.add_job(_noop, 60, start_in=60, jitter=10)
+        first = job.planned
+        for run in range(1, 4):
+            assert job.next_run == job.planned + 10
+            clock.now = job.next_run
+            sched._fire(job, job.next_run)
+            assert job.planned == first + run * 60
+        await sched.wait_for_running_jobs()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("hour, quiet", [
+    (23, True), (0, True), (6, True), (7, False), (12, False), (21, False), (22, True),
+])
+def test_quiet_hours_wrap_midnight(hour, quiet):
+    assert in_quiet_hours(datetime(2026, 3, 2, hour, 30), (22, 7)) is quiet
+
+
+def test_quiet_hours_within_a_day_and_disabled():
+    assert in_quiet_hours(datetime(2026, 3, 2, 13, 0), (12, 14))
+    assert not in_quiet_hours(datetime(2026, 3, 2, 14, 0), (12, 14))
+    assert not in_quiet_hours(datetime(2026, 3, 2, 13, 0), (12, 12))
+    assert not in_quiet_hours(datetime(2026, 3, 2, 13, 0), None)
+
+
+def test_a_run_due_in_quiet_hours_moves_to_the_end_of_the_window(clock):
+    sched = Scheduler()
+    outside = sched.add_job(_noop, None, start_in=0.5 * HOUR, quiet_hours=(22, 7))
+    inside = sched.add_job(_noop, None, start_in=2 * HOUR, quiet_hours=(22, 7))  # 23:00
+    assert outside.next_run - clock.now == 0.5 * HOUR
+    assert inside.next_run - clock.now == 10 * HOUR  # 07:00 the next morning
+
+
+def test_jitter_cannot_push_a_run_into_quiet_hours(clock, monkeypatch):
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: high)
+    sched = Scheduler()
+    job = sched.add_job(_noop, None, start_in=HOUR - 60, jitter=120, quiet_hours=(22, 7))
+    assert job.next_run - clock.now == 10 * HOUR
+
+
+def test_a_periodic_job_resumes_its_cadence_after_quiet_hours(clock):
+    async def main():
+        sched = Scheduler()
+        job = sched.add_job(_noop, HOUR, start_in=0.5 * HOUR, quiet_hours=(22, 7))  # 21:30
+        clock.now = job.next_run
+        sched._fire(job, job.next_run)  # The next one, 22:30, is quiet
+        assert scheduler.datetime.now() + timedelta(seconds=job.next_run - clock.now) == datetime(2026, 3, 3, 7, 0)
+        clock.now = job.next_run
+        sched._fire(job, job.next_run)
+        assert job.next_run - clock.now == HOUR
+        await sched.wait_for_running_jobs()
+
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+"""
+Tests for cutting and aborting streamed messages
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import stream_guard
+from stream_guard import RECENT_OPENERS, StreamGuard, consume_stream, consume_stream_async, cut_at_boundary
+
+
+@pytest.fixture(autouse=True)
+def no_recent_openers():
+    RECENT_OPENERS.clear()
+    yield
+    RECENT_OPENERS.clear()
+
+
+def _chunk(content=None, usage=None):
+    choices = [] if content is None else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeStream:
+    """A streamed completion that records how much of it was read and whether it was closed."""
+
+    def __init__(self, deltas, usage=None):
+        self.chunks = [_chunk(delta) for delta in deltas]
+        if usage is not None:
+            self.chunks.append(_chunk(usage=usage))
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    def __aiter__(self):
+        return self._async_chunks()
+
+    async def _async_chunks(self):
+        for chunk in self:
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncFakeStream(FakeStream):
+    async def close(self):
+        self.closed = True
+
+
+def _words(text):
+    """Split text into word-sized deltas, like a model streams it."""
+    return [word + " " for word in text.split(" ")]
+
+
+def test_cuts_at_the_last_sentence_once_over_the_limit():
+    text = "Hope your week is off to a good start. The weather has been lovely here lately. Talk soon!"
+    stream = FakeStream(_words(text))
+    guard = StreamGuard(max_length=60)
+    message = consume_stream(stream, guard)
+    assert message == "Hope your week is off to a good start."
+    assert guard.truncated and guard.violation is None
+    assert stream.closed
+    assert stream.read < len(stream.chunks)  # Stopped reading instead of paying for the rest
+
+
+def test_keeps_a_message_under_the_limit_whole():
+    stream = FakeStream(_words("Good morning! Thinking of you today 😊"), usage=SimpleNamespace(total_tokens=12))
+    guard = StreamGuard(max_length=120)
+    assert consume_stream(stream, guard) == "Good morning! Thinking of you today 😊"
+    assert not guard.truncated
+    assert guard.usage.total_tokens == 12
+
+
+def test_cut_keeps_emojis_after_the_sentence_and_falls_back_to_words():
+    assert cut_at_boundary("Have a lovely day! 🌞 And also one more thing", 25) == "Have a lovely day! 🌞"
+    assert cut_at_boundary("no punctuation anywhere in this message", 20) == "no punctuation"
+
+
+def test_strips_quotes_wrapped_around_the_whole_message():
+    guard = StreamGuard(max_length=120)
+    for delta in ["\"Hey", " there, how", " are you?\"", "  "]:
+        assert guard.feed(delta)
+    assert guard.result() == "Hey there, how are you?"
+
+
+@pytest.mark.parametrize("text, violation", [
+    ("Remember what they told us: \"never give up\" and keep going", "quotation"),
+    ("\"Hi there!\" she said with a smile", "quotation"),
+    ("Once upon a time there was a little cat", "story or idiom"),
+    ("Well, as the saying goes, better late than never", "story or idiom"),
+])
+def test_aborts_on_a_broken_rule(text, violation):
+    stream = FakeStream(_words(text))
+    guard = StreamGuard(max_length=200)
+    assert consume_stream(stream, guard) is None
+    assert guard.violation == violation
+    assert stream.closed
+    assert stream.read < len(stream.chunks)
+
+
+def test_aborts_on_an_opening_used_recently():
+    RECENT_OPENERS.add("Just wanted to say hi and see how you are.")
+    guard = StreamGuard(max_length=200)
+    assert consume_stream(FakeStream(_words("Just wanted to check in on you!")), guard) is None
+    assert guard.violation == "repeated opening \"just wanted to\""
+
+    guard = StreamGuard(max_length=200)
+    assert consume_stream(FakeStream(_words("Just wanting everything to go well!")), guard) is not None
+
+
+def test_does_not_judge_an_opening_while_its_last_word_streams_in():
+    RECENT_OPENERS.add("Good morning sunshine, how are you?")
+    guard = StreamGuard(max_length=200)
+    for delta in ["Good", " morning", " sun"]:
+        assert guard.feed(delta)  # "sun" may still become "sunday"
+    assert guard.feed("day!") and guard.violation is None
+
+
+def test_recent_openers_forget_old_messages():
+    recent = stream_guard._RecentOpeners(size=2)
+    for text in ["One two three four", "Five six seven eight", "Nine ten eleven twelve"]:
+        recent.add(text)
+    assert "one two three" not in recent
+    assert "nine ten eleven" in recent
+
+
+def test_async_stream_is_cut_and_closed():
+    text = "Thanks for yesterday. It was great to catch up again after so long. See you soon!"
+    stream = AsyncFakeStream(_words(text))
+    guard = StreamGuard(max_length=30)
+    assert asyncio.run(consume_stream_async(stream, guard)) == "Thanks for yesterday."
+    assert stream.closed and guard.truncated
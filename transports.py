@@ -0,0 +1,364 @@
+"""
+Send transports for the WhatsApp Bot
+The WhatsApp Web (browser automation) path, a direct HTTP transport shaped like the
+WhatsApp Cloud API, and an in-process mock server for offline throughput tests
+"""
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import threading
+import time
+import webbrowser
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Set
+from urllib.parse import quote, urlsplit
+
+from metrics import stage
+from screen_ready import UI_READY_TIMEOUT, ScreenWatcher
+
+log = logging.getLogger(__name__)
+
+# Configuration
+SEND_TRANSPORT = os.getenv("SEND_TRANSPORT", "whatsapp_web")  # whatsapp_web, cloud_api or mock
+WHATSAPP_WEB_SEND_ATTEMPTS = int(os.getenv("WHATSAPP_WEB_SEND_ATTEMPTS", "2"))  # Enter presses before giving up
+WHATSAPP_WEB_CLOSE_TAB = os.getenv("WHATSAPP_WEB_CLOSE_TAB", "true").lower() == "true"  # Close the chat tab after each send
+# WhatsApp Cloud API settings (only needed for the cloud_api transport)
+WHATSAPP_API_URL = os.getenv("WHATSAPP_API_URL", "https://graph.facebook.com/v19.0")
+WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "")
+WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN", "")
+WHATSAPP_API_TIMEOUT = float(os.getenv("WHATSAPP_API_TIMEOUT", "10"))
+
+
+@dataclass
+class SendResult:
+    """
+    Outcome of a send.
+
+    Args:
+        confirmed: Whether delivery was confirmed (API accepted it, or the sent tick was seen)
+        message_id: Id assigned by the transport, if any
+        elapsed: Seconds the send took
+    """
+    confirmed: bool
+    message_id: Optional[str] = None
+    elapsed: float = 0.0
+
+
+class Transport:
+    """
+    Base class for ways of sending a WhatsApp message.
+    send() raises an exception when the message could not be sent.
+    """
+
+    name = "transport"
+    # True when sends share one screen, mouse and keyboard and must not overlap
+    exclusive = False
+
+    def send(self, phone_number: str, message: str) -> SendResult:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release connections or other resources."""
+
+
+class WhatsAppWebTransport(Transport):
+    """
+    Sends through WhatsApp Web in the default browser, driven with pyautogui.
+    Each step waits on what the screen shows (see screen_ready.py) instead of fixed sleeps.
+    Needs a display and a logged-in WhatsApp Web session.
+
+    Args:
+        browser: Command that opens a URL in a specific browser or profile, e.g.
+            ["chromium", "--user-data-dir=profiles/a"] (None uses the default browser)
+    """
+
+    name = "whatsapp_web"
+    exclusive = True
+
+    def __init__(self, browser: Optional[List[str]] = None):
+        import pyautogui  # type: ignore
+
+        # Configure pyautogui for better reliability
+        pyautogui.FAILSAFE = False  # Disable failsafe so it doesn't stop if mouse moves to corner
+        pyautogui.PAUSE = 0.1  # Small pause between actions - readiness is detected, not waited for
+        self._pyautogui = pyautogui
+        self._watcher = ScreenWatcher(pyautogui)
+        self._browser = browser
+
+    def send(self, phone_number: str, message: str) -> SendResult:
+        pyautogui = self._pyautogui
+        watcher = self._watcher
+        started = time.monotonic()
+
+        log.info("⚠️  Keep WhatsApp Web tab active and don't move your mouse during sending!")
+        before = watcher.grab()
+        # Opens the chat with the message already typed into the input box
+        url = f"https://web.whatsapp.com/send?phone={quote(phone_number)}&text={quote(message)}"
+        if self._browser:
+            subprocess.Popen(self._browser + [url], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            webbrowser.open(url)
+        ready = confirmed = False
+        try:
+            with stage("ui_ready"):
+                ready = watcher.wait_for_ready(before)
+            if not ready:
+                raise Exception(f"WhatsApp Web chat did not load within {UI_READY_TIMEOUT:.0f}s")
+            log.info("Chat ready, sending...", extra={"after_s": round(time.monotonic() - started, 2)})
+
+            for attempt in range(WHATSAPP_WEB_SEND_ATTEMPTS):
+                typed = watcher.grab()
+                if attempt > 0:
+                    # Enter changed nothing, so the input box probably isn't focused
+                    log.info("Message still in the input box, focusing it and retrying...")
+                    pyautogui.click(*watcher.input_center())
+                # One Enter per attempt - extra presses could send the message twice
+                pyautogui.press('enter')
+                with stage("ui_confirm"):
+                    sent = watcher.wait_for_sent(typed)
+                if sent:
+                    confirmed = True
+                    break
+        finally:
+            if WHATSAPP_WEB_CLOSE_TAB and ready:
+                # A second WhatsApp Web tab would ask to "Use here" and block the next send, so
+                # the tab is closed whether or not the send went through - but only once it is
+                # known to be the focused window, or ctrl+w would close whatever else is
+                pyautogui.hotkey('ctrl', 'w')
+
+        if confirmed:
+            log.info("✓ Delivery confirmed")
+        elif WHATSAPP_WEB_CLOSE_TAB:
+            log.warning("⚠️  Could not confirm the message was sent, closed the chat tab - check WhatsApp Web")
+        else:
+            log.warning(
+                "⚠️  Could not confirm the message was sent. "
+                "💡 Please manually click the send button or press Enter in WhatsApp Web"
+            )
+        return SendResult(confirmed=confirmed, elapsed=time.monotonic() - started)
+
+
+class CloudApiTransport(Transport):
+    """
+    Sends with one HTTPS request per message to a WhatsApp Cloud API-style endpoint:
+    POST {base_url}/{phone_number_id}/messages with a bearer token.
+    The connection is kept alive between messages, so a send takes milliseconds.
+
+    Args:
+        base_url: API root, e.g. https://graph.facebook.com/v19.0
+        phone_number_id: Sender phone number id
+        access_token: Bearer token
+        timeout: Seconds to wait for the API
+    """
+
+    name = "cloud_api"
+
+    def __init__(
+        self,
+        base_url: str = WHATSAPP_API_URL,
+        phone_number_id: str = WHATSAPP_PHONE_NUMBER_ID,
+        access_token: str = WHATSAPP_ACCESS_TOKEN,
+        timeout: float = WHATSAPP_API_TIMEOUT
+    ):
+        if not phone_number_id or not access_token:
+            raise ValueError(
+                "WHATSAPP_PHONE_NUMBER_ID and WHATSAPP_ACCESS_TOKEN must be set for the cloud_api transport"
+            )
+        url = urlsplit(base_url)
+        self._scheme = url.scheme
+        self._host = url.netloc
+        self._path = f"{url.path.rstrip('/')}/{phone_number_id}/messages"
+        self._headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        }
+        self.timeout = timeout
+        self._local = threading.local()  # One keep-alive connection per sending thread
+        self._connections: Set[http.client.HTTPConnection] = set()  # All of them, so close() reaches every thread's
+        self._connections_lock = threading.Lock()
+
+    def send(self, phone_number: str, message: str) -> SendResult:
+        started = time.monotonic()
+        body = json.dumps({
+            "messaging_product": "whatsapp",
+            "to": phone_number.lstrip("+"),
+            "type": "text",
+            "text": {"body": message},
+        }).encode("utf-8")
+
+        reused = getattr(self._local, "connection", None) is not None
+        try:
+            status, payload = self._post(body)
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # The server closed the kept-alive connection before answering - retry once on a new one.
+            # A fresh connection failing this way, or any timeout, may mean the message went out,
+            # so it is raised for the outbox to record rather than sent again
+            self._reset()
+            if not reused:
+                raise
+            status, payload = self._post(body)
+        except (http.client.HTTPException, OSError):
+            self._reset()
+            raise
+
+        if status >= 400:
+            raise Exception(f"WhatsApp API returned {status}: {payload.get('error', payload)}")
+        messages = payload.get("messages") or [{}]
+        return SendResult(
+            confirmed=True,
+            message_id=messages[0].get("id"),
+            elapsed=time.monotonic() - started
+        )
+
+    def close(self) -> None:
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self._scheme == "https" else http.client.HTTPConnection
+            connection = connection_class(self._host, timeout=self.timeout)
+            connection.connect()
+            # Headers and body go out in separate writes; without this Nagle delays every request
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.add(connection)
+        return connection
+
+    def _post(self, body: bytes):
+        connection = self._connection()
+        connection.request("POST", self._path, body=body, headers=self._headers)
+        response = connection.getresponse()
+        raw = response.read()
+        try:
+            payload = json.loads(raw) if raw else {}
+        except ValueError:
+            payload = {"error": raw.decode("utf-8", "replace")}
+        return response.status, payload
+
+    def _reset(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            with self._connections_lock:
+                self._connections.discard(connection)
+
+
+class MockTransport(CloudApiTransport):
+    """Cloud API transport pointed at a local MockWhatsAppServer, for offline runs."""
+
+    name = "mock"
+
+    def __init__(self, server: Optional["MockWhatsAppServer"] = None):
+        self.server = server or MockWhatsAppServer().start()
+        super().__init__(base_url=self.server.url, phone_number_id="mock", access_token="mock")
+
+
+class MockWhatsAppServer:
+    """
+    In-process HTTP server that accepts Cloud API-style send requests and records them.
+
+    Args:
+        latency: Seconds added to every response
+        failure_rate: Share of requests answered with a 500 error
+        port: Port to listen on (0 picks a free one)
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, port: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.received: List[dict] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockWhatsAppServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-whatsapp", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive
+            disable_nagle_algorithm = True  # Don't hold small responses back waiting for ACKs
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                data = json.loads(self.rfile.read(length) or b"{}")
+                if server.latency:
+                    time.sleep(server.latency)
+                if random.random() < server.failure_rate:
+                    self._reply(500, {"error": {"message": "mock failure"}})
+                    return
+                if not self.path.endswith("/messages") or data.get("type") != "text":
+                    self._reply(400, {"error": {"message": "unsupported request"}})
+                    return
+                with server._lock:
+                    server.received.append(data)
+                    message_id = f"wamid.mock{len(server.received)}"
+                self._reply(200, {
+                    "messaging_product": "whatsapp",
+                    "contacts": [{"input": data.get("to"), "wa_id": data.get("to")}],
+                    "messages": [{"id": message_id}],
+                })
+
+            def _reply(self, status: int, payload: dict):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep test output quiet
+
+        return Handler
+
+
+def get_transport(name: str = SEND_TRANSPORT) -> Transport:
+    """Create the transport selected by name (whatsapp_web, cloud_api or mock)."""
+    if name in ("whatsapp_web", "pywhatkit"):  # "pywhatkit" kept for existing configurations
+        return WhatsAppWebTransport()
+    if name == "cloud_api":
+        return CloudApiTransport()
+    if name == "mock":
+        return MockTransport()
+    raise ValueError(f"Unknown transport {name!r}. Use whatsapp_web, cloud_api or mock.")
+
+
+if __name__ == "__main__":
+    # Offline throughput check against the mock server
+    count = 500
+    transport = MockTransport()
+    print(f"Sending {count} messages through the mock WhatsApp API at {transport.server.url}...")
+    start = time.perf_counter()
+    for i in range(count):
+        transport.send("+1234567890", f"Test message {i}")
+    elapsed = time.perf_counter() - start
+    print(f"✅ {count} messages in {elapsed:.2f}s ({count / elapsed:.0f} messages/sec)")
+    transport.close()
+    transport.server.stop()
@@ -1,16 +1,32 @@
-import pywhatkit
-import schedule
 import time
-import pyautogui
-from datetime import datetime, timedelta
-from message_generator import generate_message
 
-# Configure pyautogui for better reliability
-pyautogui.FAILSAFE = False  # Disable failsafe so it doesn't stop if mouse moves to corner
-pyautogui.PAUSE = 0.5  # Add small pause between actions
+_STARTED = time.perf_counter()  # Startup time is measured from here
+
+import argparse
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+
+from llm_clients import close_async_clients, close_clients
+from log_setup import configure_logging
+from message_buffer import MessageBuffer
+from message_generator import OPENAI_AVAILABLE, generate_message_hedged_async, generate_message_simple, start_health_probe
+from message_history import MessageHistory
+from metrics import MESSAGES_SENT, STAGE_SECONDS, stage, start_metrics_exporter
+from outbox import Outbox
+from recipient_memory import FACT, MESSAGE, MemoryStore, get_memory, memory_available, set_memory
+from recipients import RECIPIENTS_FILE, Recipient, generate_for_recipients_async, load_recipients
+from scheduler import Scheduler
+
+# Importing this module has no side effects: nothing is scheduled, sent or opened, and the
+# GUI (pyautogui), transport and LLM (openai) backends are only imported once they are used
+log = logging.getLogger("whatsapp_bot")
 
 # 🔧 Configuration
 phone_number = "+2348133919605"  # replace with recipient number (include country code)
+# 📇 To message several contacts, list them in recipients.json (see recipients.example.json)
+# When that file exists it replaces the single recipient configured below
 
 # 🤖 LLM Configuration
 USE_LLM = True  # Set to False to use simple template-based messages
@@ -18,115 +34,388 @@ RECIPIENT_NAME = "darling"  # Name of the recipient
 RELATIONSHIP = "romantic partner"  # Your relationship with them
 MESSAGE_STYLE = "sweet and loving, romantic, funny, and cute"  # Style of messages (e.g., "funny", "romantic", "casual")
 MAX_MESSAGE_LENGTH = 200  # Maximum characters in the message (increased for longer, more detailed messages)
+# When the message buffer is empty, race LM Studio and OpenAI (hedged request) instead of sending a template
+HEDGED_GENERATION = False
+GENERATION_DEADLINE = 20  # Seconds a hedged generation may take before a template message is used
+# Fresh messages tried when one repeats a message already sent, before the send is skipped
+DUPLICATE_REDRAWS = 3
 
-# 📱 Function to send WhatsApp message instantly
-def send_whatsapp_message():
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] Generating and sending message...")
-    print(f"   Phone: {phone_number}")
-    
-    # Generate a new message each time
-    try:
-        message = generate_message(
-            use_llm=USE_LLM,
-            recipient_name=RECIPIENT_NAME,
-            relationship=RELATIONSHIP,
-            style=MESSAGE_STYLE,
-            max_length=MAX_MESSAGE_LENGTH
-        )
-        print(f"   Generated message: {message}")
-    except Exception as e:
-        print(f"❌ Error generating message: {e}")
-        return
-    
-    try:
-        # Calculate time at least 2 minutes from now to ensure it's in the future
-        now = datetime.now()
-        send_time = now + timedelta(minutes=2)
-        hour = send_time.hour
-        minute = send_time.minute
-        
-        print(f"   Scheduled for {hour:02d}:{minute:02d} (in ~2 minutes)")
-        print("   ⚠️  Keep WhatsApp Web tab active and don't move your mouse during sending!")
-        
-        # Send the message - keep tab open so we can verify it was sent
-        pywhatkit.sendwhatmsg(  # type: ignore
-            phone_no=phone_number,
-            message=message,
-            time_hour=hour,
-            time_min=minute,
-            wait_time=20,  # Increased wait time for better reliability
-            tab_close=False,  # Keep tab open to verify sending
-            close_time=3  # Close after 3 seconds (gives time to see it was sent)
-        )
-        
-        # Additional safety: Ensure message is sent
-        # This helps if pywhatkit didn't automatically send it
-        print("   Waiting for message to be typed and ensuring it's sent...")
-        time.sleep(10)  # Wait longer for pywhatkit to finish typing and opening WhatsApp
-        
+SEND_INTERVAL_MINUTES = 30  # Minutes between messages for the single recipient
+FIRST_SEND_DELAY = 5  # Seconds after startup before recipients who are due get a message
+
+# ⏱️ Seconds from launch until the scheduler is running; slower startups are logged as a warning
+STARTUP_TARGET = float(os.getenv("STARTUP_TARGET", "1.0"))
+
+# 🧪 Dry run (--dry-run): the full pipeline against in-process mocks - no display, network or files
+DRY_RUN_INTERVAL = 1.0  # Seconds between sends to each recipient
+DRY_RUN_SENDS = 2  # Messages sent to each recipient before the dry run ends
+
+
+def configured_recipients(path: str = RECIPIENTS_FILE) -> List[Recipient]:
+    """The contacts from the recipients file, or the single recipient configured above."""
+    if os.path.exists(path):
+        recipients = load_recipients(path)
+        log.info("📇 Loaded recipients", extra={"count": len(recipients), "path": path})
+        return recipients
+    return [Recipient(
+        number=phone_number,
+        name=RECIPIENT_NAME,
+        relationship=RELATIONSHIP,
+        style=MESSAGE_STYLE,
+        cadence_minutes=SEND_INTERVAL_MINUTES,
+        max_length=MAX_MESSAGE_LENGTH
+    )]
+
+
+class WhatsAppBot:
+    """
+    Generates messages ahead of time and sends them to each recipient at their own cadence.
+
+    Args:
+        recipients: Contacts to message
+        transport: How messages are delivered (see transports.py)
+        outbox: Journal of every message, so a crash neither loses nor repeats one
+        history: Sent messages; near-duplicates of them are regenerated
+        use_llm: Generate messages with an LLM instead of templates
+        memory: Facts about each recipient and the messages sent to them, for the prompts
+            (None to not remember anything)
+    """
+
+    def __init__(
+        self,
+        recipients: List[Recipient],
+        transport,
+        outbox: Outbox,
+        history: MessageHistory,
+        use_llm: bool = USE_LLM,
+        memory: Optional[MemoryStore] = None
+    ):
+        self.recipients = recipients
+        self.transport = transport
+        self.outbox = outbox
+        self.history = history
+        self.use_llm = use_llm
+        self.memory = memory
+        self.scheduler = Scheduler()
+        self.sends: Dict[str, int] = {}
+        # 📦 Messages are generated ahead of time in the background, so sends never wait on the LLM
+        self.message_buffer = MessageBuffer(history=history, outbox=outbox)
+        for recipient in recipients:
+            self.message_buffer.register(recipient.number, **recipient.generation_params(use_llm))
+        # 🖱️ WhatsApp Web sends drive one shared browser, mouse and keyboard, so only one send may
+        # run at a time. API transports have no such limit and send concurrently
+        self._send_lock: Optional[asyncio.Lock] = None
+        self._ready: Optional[asyncio.Event] = None
+
+    def recover(self) -> None:
+        """Put messages generated before a crash or restart back into the buffer."""
+        for number, entries in self.outbox.recover(self.message_buffer.max_age).items():
+            messages, created = zip(*entries)
+            self.message_buffer.put(number, list(messages), created=list(created))
+
+    # 📱 Send one message to a recipient right now
+    def send_message(self, recipient: Recipient, message: Optional[str] = None) -> None:
+        """
+        Send a message to a recipient: the given one, or else a pre-generated one, or else
+        a template message if the buffer ran dry. Whichever it is, a near-duplicate of a
+        message already sent to them is replaced, and the send is skipped if no fresh one is found.
+        """
+        phone_number = recipient.number
+        log.info("Generating and sending message...", extra={"recipient": phone_number})
+
+        try:
+            if message is None:
+                message = self.message_buffer.pop(phone_number)
+            if message is not None and self._repeats(message, phone_number):
+                self.outbox.mark_dropped(phone_number, [message], "near-duplicate")  # If it was buffered
+                message = None
+            if message is None:
+                log.warning("⚠️  No fresh message ready, using simple message generation...", extra={"recipient": phone_number})
+                message = self._template_message(recipient)
+            if message is None:
+                log.warning(
+                    "⏭️  Every message drawn repeats one already sent, skipping this send",
+                    extra={"recipient": phone_number, "draws": DUPLICATE_REDRAWS}
+                )
+                return
+            log.info("Generated message", extra={"recipient": phone_number, "text": message})
+        except Exception:
+            log.exception("❌ Error generating message", extra={"recipient": phone_number})
+            return
+
+        # The outbox hands each message to the transport at most once
+        entry = self.outbox.schedule(phone_number, message)
+        if not self.outbox.begin_send(entry.key):
+            log.info("⏭️  This message was already sent, skipping", extra={"recipient": phone_number, "key": entry.key})
+            return
+
+        transport = self.transport
         try:
-            # Try multiple methods to ensure the message is sent
-            print("   Attempting to send message...")
-            
-            # Get screen size to help with clicking
-            screen_width, screen_height = pyautogui.size()
-            
-            # Method 1: Click in the message input area to ensure focus
-            # WhatsApp Web input is usually at the bottom center
-            input_x = screen_width // 2
-            input_y = screen_height - 150  # Adjust based on your screen
-            print(f"   Clicking message input area at ({input_x}, {input_y})...")
-            pyautogui.click(input_x, input_y)
-            time.sleep(1)
-            
-            # Method 2: Press Enter multiple times
-            print("   Pressing Enter to send...")
-            for i in range(5):  # Try 5 times
-                pyautogui.press('enter')
-                time.sleep(0.5)
-                print(f"   ✓ Enter pressed (attempt {i+1}/5)")
-            
-            # Method 3: Try Ctrl+Enter (some browsers use this)
-            print("   Trying Ctrl+Enter...")
-            pyautogui.hotkey('ctrl', 'enter')
-            time.sleep(0.5)
-            
-            # Method 4: Try clicking the send button area (right side of input)
-            send_button_x = screen_width - 200
-            send_button_y = screen_height - 150
-            print(f"   Clicking send button area at ({send_button_x}, {send_button_y})...")
-            pyautogui.click(send_button_x, send_button_y)
-            time.sleep(0.5)
-            
-            # Final Enter press
-            pyautogui.press('enter')
-            
-            print("   ✓ Multiple send attempts completed")
-            
+            with stage("send", transport=transport.name):
+                result = transport.send(phone_number, message)
+            self.outbox.mark_sent(entry.key, result.message_id)
+            self.history.record(message, phone_number)
+            self._remember(phone_number, [message], MESSAGE)
+            self.sends[phone_number] = self.sends.get(phone_number, 0) + 1
+            MESSAGES_SENT.inc(transport=transport.name, confirmed=result.confirmed)
+            log.info(
+                "✅ Message sent successfully!",
+                extra={
+                    "recipient": phone_number,
+                    "transport": transport.name,
+                    "confirmed": result.confirmed,
+                    "elapsed_s": round(result.elapsed, 3),
+                }
+            )
         except Exception as e:
-            print(f"   ⚠️  Could not send automatically: {e}")
-            print("   💡 Please manually click the send button or press Enter in WhatsApp Web")
-        
-        print("✅ Message sent successfully!")
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        print("Full error details:")
-        traceback.print_exc()
-
-# ⏰ Schedule message every 30 minutes
-schedule.every(30).minutes.do(send_whatsapp_message)
-
-print("🤖 WhatsApp bot started... Press Ctrl+C to stop.")
-print("⚠️  Make sure WhatsApp Web is open and logged in in your default browser!")
-print("📤 Sending a test message in 5 seconds...")
-
-# Send a test message immediately (after 5 seconds)
-time.sleep(5)
-send_whatsapp_message()
-
-# ♻️ Keep running
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+            self.outbox.mark_failed(entry.key, str(e))
+            log.exception("❌ Error sending message", extra={"recipient": phone_number, "transport": transport.name})
+
+    def _repeats(self, message: str, phone_number: str) -> bool:
+        """Whether a message is a near-duplicate of one already sent to the recipient."""
+        with stage("duplicate_check"):
+            repeated = self.history.is_duplicate(message, phone_number)
+        if repeated:
+            log.info("♻️  Message repeats one already sent, drawing another", extra={"recipient": phone_number})
+        return repeated
+
+    def _template_message(self, recipient: Recipient) -> Optional[str]:
+        """A template message that doesn't repeat a sent one, or None after DUPLICATE_REDRAWS draws."""
+        for _ in range(DUPLICATE_REDRAWS):
+            message = generate_message_simple(
+                recipient_name=recipient.name,
+                relationship=recipient.relationship,
+                style=recipient.style
+            )
+            if not self._repeats(message, recipient.number):
+                return message
+        return None
+
+    def _remember(self, phone_number: str, texts: List[str], kind: str) -> None:
+        """🧠 Add to a recipient's memory; a failure here never fails the send."""
+        if self.memory is None:
+            return
+        try:
+            self.memory.add(phone_number, texts, kind)
+        except Exception as e:
+            log.warning("⚠️  Could not update the recipient's memory", extra={"recipient": phone_number, "error": str(e)})
+
+    async def _race_llms(self, recipient: Recipient) -> Optional[str]:
+        """Generate a message on the spot by racing the LLM backends (hedged request)."""
+        log.warning("⚠️  Message buffer is empty, racing the LLM backends...", extra={"recipient": recipient.number})
+        try:
+            # On the bot's own loop, so the pooled async clients are reused
+            return await generate_message_hedged_async(
+                recipient_name=recipient.name,
+                relationship=recipient.relationship,
+                style=recipient.style,
+                max_length=recipient.max_length,
+                deadline=GENERATION_DEADLINE,
+                recipient_id=recipient.number
+            )
+        except Exception:
+            log.exception("❌ Error generating message", extra={"recipient": recipient.number})
+            return None
+
+    async def send_job(self, recipient: Recipient) -> None:
+        await self._ready.wait()  # The first messages are still being generated
+        message = None
+        if self.use_llm and HEDGED_GENERATION:
+            message = self.message_buffer.pop(recipient.number)
+            if message is None:
+                # Near-duplicates are generated again; send_message checks whatever is left once more
+                for _ in range(DUPLICATE_REDRAWS):
+                    message = await self._race_llms(recipient)
+                    if message is None or not self._repeats(message, recipient.number):
+                        break
+                    message = None
+        loop = asyncio.get_running_loop()
+        if self.transport.exclusive:
+            async with self._send_lock:
+                await loop.run_in_executor(None, self.send_message, recipient, message)
+        else:
+            await loop.run_in_executor(None, self.send_message, recipient, message)
+
+    def schedule(self, first_send_delay: float = FIRST_SEND_DELAY, interval: Optional[float] = None) -> List[str]:
+        """
+        ⏰ Schedule each recipient at their own cadence, picking up where the last run left off:
+        a recipient who is due (or was never messaged) gets a message after first_send_delay,
+        and a restart shortly after a send doesn't send again.
+
+        Args:
+            first_send_delay: Seconds until recipients who are due get a message
+            interval: Seconds between sends for everyone, instead of each recipient's cadence
+
+        Returns:
+            Numbers of the recipients who are due now
+        """
+        due_now = []
+        for recipient in self.recipients:
+            cadence = interval or recipient.cadence_minutes * 60
+            last_sent = self.outbox.last_sent(recipient.number)
+            start_in = first_send_delay if last_sent is None else max(first_send_delay, cadence - (time.time() - last_sent))
+            if start_in == first_send_delay:
+                due_now.append(recipient.number)
+            self.scheduler.add_job(
+                self.send_job,
+                cadence,
+                recipient,
+                start_in=start_in,
+                jitter=0.0 if interval else recipient.jitter_minutes * 60,
+                quiet_hours=None if interval else recipient.quiet_hours,
+                name=f"send to {recipient.number}"
+            )
+        return due_now
+
+    async def run(self, stop_after: Optional[int] = None) -> None:
+        """
+        Run the scheduler until cancelled, or until every recipient got stop_after messages.
+        The first message for each recipient with nothing buffered is generated concurrently
+        while the scheduler already runs; sends wait for it, then the buffer keeps itself topped up.
+        """
+        self._send_lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+        scheduler = asyncio.create_task(self.scheduler.run())
+        elapsed = time.perf_counter() - _STARTED
+        STAGE_SECONDS.observe(elapsed, stage="startup")
+        log.log(
+            logging.WARNING if elapsed > STARTUP_TARGET else logging.INFO,
+            "🚀 Started" if elapsed <= STARTUP_TARGET else "🐢 Startup was slower than the target",
+            extra={"startup_ms": round(elapsed * 1000, 1), "target_ms": round(STARTUP_TARGET * 1000)}
+        )
+
+        try:
+            await self._prefill()
+            while stop_after is not None and not scheduler.done():
+                if all(self.sends.get(r.number, 0) >= stop_after for r in self.recipients):
+                    self.scheduler.stop()
+                    break
+                await asyncio.sleep(0.05)
+            await scheduler
+            await self.scheduler.wait_for_running_jobs()
+        finally:
+            self.scheduler.stop()
+            self.message_buffer.stop()
+            await close_async_clients()
+
+    async def _prefill(self) -> None:
+        # Facts from the recipients file go into memory before the first prompts are built
+        loop = asyncio.get_running_loop()
+        for recipient in self.recipients:
+            if recipient.facts:
+                await loop.run_in_executor(None, self._remember, recipient.number, list(recipient.facts), FACT)
+        empty = [recipient for recipient in self.recipients if self.message_buffer.size(recipient.number) == 0]
+        try:
+            first_messages = await generate_for_recipients_async(empty, use_llm=self.use_llm)
+            for number, message in first_messages.items():
+                self.message_buffer.put(number, [message])
+        except Exception:
+            log.exception("❌ Error generating the first messages")
+        finally:
+            self._ready.set()
+        self.message_buffer.start()
+
+
+def _use_mock_llm():
+    """Point LM Studio at an in-process mock server and turn OpenAI off, for dry runs."""
+    import message_generator
+    from mock_llm import MockLLMServer
+
+    server = MockLLMServer(latency=0.05, jitter=0.05).start()
+    message_generator.USE_LM_STUDIO = True
+    message_generator.LM_STUDIO_BASE_URL = server.url
+    message_generator.OPENAI_API_KEY = ""
+    return server
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Send generated WhatsApp messages on a schedule")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=f"Run the whole pipeline headless against in-process mocks, send {DRY_RUN_SENDS} messages "
+             f"per recipient and exit (no display, network, outbox or history files)"
+    )
+    args = parser.parse_args(argv)
+
+    # 📝 Structured logs go to stderr - set LOG_FORMAT=json for JSON lines, LOG_LEVEL=DEBUG for more detail
+    configure_logging()
+
+    # 📮 How messages are delivered: "whatsapp_web" (browser), "cloud_api" (WhatsApp Cloud API) or "mock"
+    # Set with the SEND_TRANSPORT environment variable; cloud_api also needs
+    # WHATSAPP_PHONE_NUMBER_ID and WHATSAPP_ACCESS_TOKEN
+    from transports import get_transport
+    from sender_pool import SENDER_WORKERS, SenderPool, load_sessions
+
+    # 📮 Several isolated sessions (sessions.json, or SENDER_WORKERS copies of an API transport)
+    # send in parallel from their own worker processes; see sender_pool.py
+    sessions = load_sessions(None, SENDER_WORKERS, "mock") if args.dry_run else load_sessions()
+
+    mock_llm = None
+    if args.dry_run:
+        transport = SenderPool(sessions) if sessions else get_transport("mock")
+        outbox = Outbox(":memory:")
+        history = MessageHistory(path=None)
+        memory = set_memory(MemoryStore(directory=None)) if memory_available() else None
+        if USE_LLM and OPENAI_AVAILABLE:
+            mock_llm = _use_mock_llm()
+    else:
+        transport = SenderPool(sessions) if sessions else get_transport()
+        # 📒 Every message is journaled in the outbox (outbox.db), so a crash neither loses nor repeats one
+        # 🗂️ Every sent message is remembered, and near-duplicates of them are regenerated
+        outbox = Outbox()
+        history = MessageHistory()
+        # 🧠 Facts about each recipient and the messages sent to them are kept in MEMORY_DIR (needs numpy)
+        memory = get_memory()
+
+    bot = WhatsAppBot(configured_recipients(), transport, outbox, history, use_llm=USE_LLM, memory=memory)
+    bot.recover()
+    if args.dry_run:
+        due_now = bot.schedule(first_send_delay=0, interval=DRY_RUN_INTERVAL)
+        log.info("🧪 Dry run: sending to the mock transport", extra={"recipients": len(bot.recipients)})
+    else:
+        due_now = bot.schedule()
+        log.info("🤖 WhatsApp bot started... Press Ctrl+C to stop.")
+        if transport.exclusive:
+            log.warning("⚠️  Make sure WhatsApp Web is open and logged in in your default browser!")
+        if due_now:
+            log.info(f"📤 Sending to recipients who are due in {FIRST_SEND_DELAY} seconds...", extra={"count": len(due_now)})
+
+    # 📊 Stage timings, token usage and fallback counts - set METRICS_FILE to export them
+    metrics_exporter = start_metrics_exporter()
+
+    # Keep an eye on LM Studio in the background so a dead server is skipped instantly
+    if USE_LLM and not args.dry_run:
+        start_health_probe()
+
+    # ♻️ Keep running - the scheduler sleeps until the next job is due
+    try:
+        asyncio.run(bot.run(stop_after=DRY_RUN_SENDS if args.dry_run else None))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        outbox.close()  # Commit any journal writes still waiting to be batched
+        if memory is not None:
+            memory.flush()
+        transport.close()
+        close_clients()
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+        if mock_llm is not None:
+            mock_llm.stop()
+
+    if args.dry_run:
+        print(f"🧪 Dry run finished: {sum(bot.sends.values())} messages sent to {len(bot.sends)} recipient(s)")
+        for number, count in sorted(bot.sends.items()):
+            print(f"   {number}: {count}")
+        if isinstance(transport, SenderPool):
+            for name, stats in transport.stats().items():
+                print(f"   session {name}: {stats['sent']} sent, {stats['errors']} failed")
+        if getattr(transport, "server", None) is not None:
+            transport.server.stop()
+        return 0 if len(bot.sends) == len(bot.recipients) else 1
+    return 0
+
 
+if __name__ == "__main__":
+    raise SystemExit(main())